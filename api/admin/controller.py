@@ -84,7 +84,7 @@ from core.classifier import (
 )
 from datetime import datetime, timedelta
 from sqlalchemy.sql import func
-from sqlalchemy.sql.expression import desc, nullslast, or_, and_, distinct, select, join
+from sqlalchemy.sql.expression import desc, nullslast, or_, and_, distinct, select, join, case
 from sqlalchemy.orm import lazyload
 
 from templates import admin as admin_template
@@ -807,105 +807,107 @@ class FeedController(CirculationManagerController):
 
 class DashboardController(CirculationManagerController):
 
+    def __init__(self, manager):
+        super(DashboardController, self).__init__(manager)
+        # The most recently calculated statistics, and when they
+        # were calculated.
+        self._stats = None
+        self._stats_calculated = None
+
     def stats(self):
-        patron_count = self._db.query(Patron).count()
+        """Summarize the patrons and inventory on this site.
 
-        active_loans_patron_count = self._db.query(
-            distinct(Patron.id)
-        ).join(
-            Patron.loans
-        ).filter(
-            Loan.end >= datetime.now(),
-        ).count()
+        The statistics are expensive to calculate over large tables,
+        so if the site is configured to do so, they're reused for a
+        while. The 'as_of' field says when they were calculated.
+        """
+        max_age = ConfigurationSetting.sitewide(
+            self._db, Configuration.DASHBOARD_STATS_MAX_AGE
+        ).int_value
+        now = datetime.utcnow()
+        if (not max_age or not self._stats
+            or self._stats_calculated < now - timedelta(seconds=max_age)):
+            self._stats = self.calculate_stats()
+            self._stats_calculated = now
+
+        stats = dict(self._stats)
+        stats['as_of'] = self._stats_calculated.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return stats
+
+    def calculate_stats(self):
+        """Calculate the dashboard statistics with a handful of aggregate
+        queries.
+        """
+        now = datetime.now()
 
+        # Everything about patrons is calculated in a single query.
         active_patrons = select(
-            [Patron.id]
-        ).select_from(
-            join(
-                Loan,
-                Patron,
-                and_(
-                    Patron.id == Loan.patron_id,
-                    Loan.id != None,
-                    Loan.end >= datetime.now()
-                )
-            )
+            [Loan.patron_id]
+        ).where(
+            Loan.end >= now
         ).union(
-            select(
-                [Patron.id]
-            ).select_from(
-                join(
-                    Hold,
-                    Patron,
-                    Patron.id == Hold.patron_id
-                )
-            )
+            select([Hold.patron_id])
         ).alias()
-        
-
-        active_loans_or_holds_patron_count_query = select(
-            [func.count(distinct(active_patrons.c.id))]
-        ).select_from(
-            active_patrons
-        )
-
-        result = self._db.execute(active_loans_or_holds_patron_count_query)
-        active_loans_or_holds_patron_count = [r[0] for r in result][0]
-
-        loan_count = self._db.query(
-            Loan
-        ).filter(
-            Loan.end >= datetime.now()
-        ).count()
-
-        hold_count = self._db.query(Hold).count()
 
+        patron_counts = select([
+            select([func.count(Patron.id)]).as_scalar(),
+            select(
+                [func.count(distinct(Loan.patron_id))]
+            ).where(
+                Loan.end >= now
+            ).as_scalar(),
+            select(
+                [func.count(distinct(active_patrons.c.patron_id))]
+            ).select_from(
+                active_patrons
+            ).as_scalar(),
+            select([func.count(Loan.id)]).where(Loan.end >= now).as_scalar(),
+            select([func.count(Hold.id)]).as_scalar(),
+        ])
+        (patron_count, active_loans_patron_count,
+         active_loans_or_holds_patron_count, loan_count,
+         hold_count) = self._db.execute(patron_counts).first()
+
+        # So is everything about the inventory as a whole. The sum
+        # queries return None instead of 0 if there are no license
+        # pools in the db.
+        (title_count, open_access_count, license_count,
+         available_license_count) = self._db.query(
+            func.count(LicensePool.id),
+            func.sum(case([(LicensePool.open_access == True, 1)], else_=0)),
+            func.sum(case([(LicensePool.open_access == False,
+                            LicensePool.licenses_owned)], else_=0)),
+            func.sum(case([(LicensePool.open_access == False,
+                            LicensePool.licenses_available)], else_=0)),
+        ).one()
+
+        # Titles from each vendor are counted with one GROUP BY.
         data_sources = dict(
             overdrive=DataSource.OVERDRIVE,
             bibliotheca=DataSource.BIBLIOTHECA,
             axis360=DataSource.AXIS_360,
         )
+        keys = dict((v, k) for k, v in data_sources.iteritems())
         vendor_counts = dict()
-
-        for key, data_source in data_sources.iteritems():
-            data_source_count = self._db.query(
-                LicensePool
-            ).join(
-                DataSource
-            ).filter(
-                LicensePool.licenses_owned > 0
-            ).filter(
-                DataSource.name == data_source
-            ).count()
-
-            if data_source_count > 0:
-                vendor_counts[key] = data_source_count
-
-        open_access_count = self._db.query(
+        qu = self._db.query(
+            DataSource.name, func.count(LicensePool.id)
+        ).select_from(
             LicensePool
-         ).filter(
-            LicensePool.open_access == True
-         ).count()
-
-        if open_access_count > 0:
-            vendor_counts['open_access'] = open_access_count
-
-        title_count = self._db.query(LicensePool).count()
-
-        # The sum queries return None instead of 0 if there are
-        # no license pools in the db.
-
-        license_count = self._db.query(
-            func.sum(LicensePool.licenses_owned)
+        ).join(
+            DataSource, LicensePool.data_source_id==DataSource.id
         ).filter(
-            LicensePool.open_access == False,
-        ).all()[0][0] or 0
-
-        available_license_count = self._db.query(
-            func.sum(LicensePool.licenses_available)
+            LicensePool.licenses_owned > 0
         ).filter(
-            LicensePool.open_access == False,
-        ).all()[0][0] or 0
+            DataSource.name.in_(data_sources.values())
+        ).group_by(
+            DataSource.name
+        )
+        for name, data_source_count in qu:
+            if data_source_count > 0:
+                vendor_counts[keys[name]] = data_source_count
+
+        if open_access_count:
+            vendor_counts['open_access'] = open_access_count
 
         return dict(
             patrons=dict(
@@ -917,8 +919,8 @@ class DashboardController(CirculationManagerController):
             ),
             inventory=dict(
                 titles=title_count,
-                licenses=license_count,
-                available_licenses=available_license_count,
+                licenses=license_count or 0,
+                available_licenses=available_license_count or 0,
             ),
             vendors=vendor_counts,
         )
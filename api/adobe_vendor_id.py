@@ -19,6 +19,7 @@ from config import (
 )
 from api.base_controller import BaseCirculationManagerController
 from problem_details import *
+from sqlalchemy import event
 from sqlalchemy.orm.session import Session
 from core.util.xmlparser import XMLParser
 from core.util.problem_detail import ProblemDetail
@@ -33,17 +34,23 @@ from core.model import (
     Library,
 )
 from core.scripts import Script
+from token_cache import TokenCache
 
 class AdobeVendorIDController(object):
 
     """Flask controllers that implement the Account Service and
     Authorization Service portions of the Adobe Vendor ID protocol.
     """
-    def __init__(self, _db, library, vendor_id, node_value, authenticator):
+    def __init__(self, _db, library, vendor_id, node_value, authenticator,
+                 authdata_utility=None):
+        self.log = logging.getLogger("Adobe Vendor ID controller")
         self._db = _db
         self.library = library
         self.request_handler = AdobeVendorIDRequestHandler(vendor_id)
-        self.model = AdobeVendorIDModel(_db, library, authenticator, node_value)
+        self.model = AdobeVendorIDModel(
+            _db, library, authenticator, node_value,
+            authdata_utility=authdata_utility
+        )
 
     def create_authdata_handler(self, patron):
         """Create an authdata token for the given patron.
@@ -64,6 +71,9 @@ class AdobeVendorIDController(object):
             flask.request.data, self.model.standard_lookup,
             self.model.authdata_lookup)
         __transaction.commit()
+        self.model.delegated_identifiers.log_stats(
+            self.log, "Adobe account ID"
+        )
         return Response(output, 200, {"Content-Type": "application/xml"})
 
     def userinfo_handler(self):
@@ -337,8 +347,19 @@ class AdobeVendorIDModel(object):
     AUTHDATA_TOKEN_TYPE = "Authdata for Adobe Vendor ID"
     VENDOR_ID_UUID_TOKEN_TYPE = "Vendor ID UUID"
 
+    # The number of Adobe account IDs to keep in memory.
+    DELEGATED_IDENTIFIER_CACHE_SIZE = 10000
+
     def __init__(self, _db, library, authenticator, node_value,
-                 temporary_token_duration=None):
+                 temporary_token_duration=None, authdata_utility=None):
+        """Constructor.
+
+        :param authdata_utility: A function that takes a Library and
+        returns its AuthdataUtility (or None). The CirculationManager
+        provides one that reuses AuthdataUtility objects until the
+        site configuration changes. By default, a new AuthdataUtility
+        is created from the configuration every time one is needed.
+        """
         self.library = library
         self._db = _db
         self.authenticator = authenticator
@@ -347,11 +368,31 @@ class AdobeVendorIDModel(object):
         if isinstance(node_value, basestring):
             node_value = int(node_value, 16)
         self.node_value = node_value
+        self._authdata_utility = authdata_utility
+
+        # Maps (library URI, foreign patron identifier) to the Adobe
+        # account ID stored in the corresponding
+        # DelegatedPatronIdentifier. Once created, an Adobe account
+        # ID never changes, so a patron who activates another device
+        # can be given their ID without a trip to the database.
+        self.delegated_identifiers = TokenCache(
+            max_size=self.DELEGATED_IDENTIFIER_CACHE_SIZE
+        )
+
+        # Adobe account IDs that have been created but not yet
+        # committed, keyed the same way.
+        self.uncommitted_identifiers = {}
 
     @property
     def data_source(self):
         return DataSource.lookup(self._db, DataSource.ADOBE)
 
+    def authdata_utility(self, library):
+        """Find the AuthdataUtility for the given library."""
+        if self._authdata_utility:
+            return self._authdata_utility(library)
+        return AuthdataUtility.from_config(library, self._db)
+
     def uuid_and_label(self, patron):
         """Create or retrieve a Vendor ID UUID and human-readable Vendor ID
         label for the given patron.
@@ -375,30 +416,30 @@ class AdobeVendorIDModel(object):
             patron
         )
 
-        # Look up a Credential containing the patron's Adobe account
-        # ID created under the old system. We don't use
-        # Credential.lookup because we don't want to create a
-        # Credential if it doesn't exist.
-        old_style_adobe_account_id_credential = get_one(
-            self._db, Credential, patron=patron, data_source=self.data_source,
-            type=self.VENDOR_ID_UUID_TOKEN_TYPE
-        )
-        
-        if old_style_adobe_account_id_credential:
-            # The value of the old-style credential will become the
-            # default value of the DelegatedPatronIdentifier, assuming
-            # we have to create one.
-            def new_value():
+        def new_value():
+            # We have to create a new DelegatedPatronIdentifier. Look
+            # up a Credential containing the patron's Adobe account
+            # ID created under the old system. We don't use
+            # Credential.lookup because we don't want to create a
+            # Credential if it doesn't exist.
+            old_style_adobe_account_id_credential = get_one(
+                self._db, Credential, patron=patron,
+                data_source=self.data_source,
+                type=self.VENDOR_ID_UUID_TOKEN_TYPE
+            )
+            if old_style_adobe_account_id_credential:
+                # The value of the old-style credential becomes the
+                # value of the DelegatedPatronIdentifier.
                 return old_style_adobe_account_id_credential.credential
-        else:
-            # There is no old-style credential. If we have to create a
-            # new DelegatedPatronIdentifier we will give it a value
-            # using the default mechanism.
-            new_value = None
+
+            # There is no old-style credential. Give the
+            # DelegatedPatronIdentifier a value using the default
+            # mechanism.
+            return self.uuid()
 
         # Look up or create a DelegatedPatronIdentifier using the 
         # anonymized patron identifier we just looked up or created.
-        utility = AuthdataUtility.from_config(patron.library, self._db)
+        utility = self.authdata_utility(patron.library)
         return self.to_delegated_patron_identifier_uuid(
             utility.library_uri, adobe_account_id_patron_identifier_credential.credential,
             value_generator=new_value
@@ -458,7 +499,7 @@ class AdobeVendorIDModel(object):
             return None, None
         
         library_uri = foreign_patron_identifier = None
-        utility = AuthdataUtility.from_config(self.library, self._db)
+        utility = self.authdata_utility(self.library)
         if utility:
             # Hopefully this is an authdata JWT generated by another
             # library's circulation manager.
@@ -494,7 +535,7 @@ class AdobeVendorIDModel(object):
 
     def short_client_token_lookup(self, token, signature):
         """Validate a short client token that came in as username/password."""
-        utility = AuthdataUtility.from_config(self.library, self._db)
+        utility = self.authdata_utility(self.library)
         library_uri = foreign_patron_identifier = None
         if utility:
             # Hopefully this is a short client token generated by
@@ -532,15 +573,83 @@ class AdobeVendorIDModel(object):
         if not library_uri or not foreign_patron_identifier:
             return None, None
         value_generator = value_generator or self.uuid
-        identifier, is_new = DelegatedPatronIdentifier.get_one_or_create(
-            self._db, library_uri, foreign_patron_identifier,
-            DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID, value_generator
-        )
-
-        if identifier is None:
+        key = (library_uri, foreign_patron_identifier)
+        cache = self.delegated_identifiers
+
+        def find():
+            # Almost always, the patron has activated a device before
+            # and reading their DelegatedPatronIdentifier is enough.
+            identifier = get_one(
+                self._db, DelegatedPatronIdentifier,
+                type=DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID,
+                library_uri=library_uri,
+                patron_identifier=foreign_patron_identifier
+            )
+            if not identifier:
+                identifier, is_new = DelegatedPatronIdentifier.get_one_or_create(
+                    self._db, library_uri, foreign_patron_identifier,
+                    DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID, value_generator
+                )
+                if identifier is None:
+                    return None
+                self._cache_after_commit(key, identifier)
+            return identifier.delegated_identifier
+
+        def lookup():
+            value = find()
+            if value is None or self._uncommitted(key):
+                return value, cache.DO_NOT_STORE
+            return value, None
+
+        if self._uncommitted(key):
+            # The DelegatedPatronIdentifier was created in a
+            # transaction that hasn't been committed, so it's not in
+            # the cache yet and may never be.
+            delegated_identifier = find()
+        else:
+            delegated_identifier = cache.token(key, lookup)
+        if delegated_identifier is None:
             return None, None
-        return (identifier.delegated_identifier,
-                self.urn_to_label(identifier.delegated_identifier))
+        return delegated_identifier, self.urn_to_label(delegated_identifier)
+
+    def _cache_after_commit(self, key, identifier):
+        """Cache a new DelegatedPatronIdentifier once the transaction
+        that created it has been committed.
+
+        If the transaction is rolled back instead, it's never cached;
+        otherwise the cache would hand out an Adobe account ID that
+        isn't in the database.
+        """
+        cache = self.delegated_identifiers
+        value = identifier.delegated_identifier
+        with cache.lock:
+            self.uncommitted_identifiers[key] = value
+
+        def forget():
+            """Stop treating the identifier as uncommitted.
+
+            :return: True if it was still uncommitted.
+            """
+            with cache.lock:
+                if self.uncommitted_identifiers.get(key) != value:
+                    return False
+                del self.uncommitted_identifiers[key]
+                return True
+
+        def committed(session):
+            if forget():
+                cache.store(key, value, None)
+
+        def rolled_back(session):
+            forget()
+
+        session = Session.object_session(identifier)
+        event.listen(session, "after_commit", committed, once=True)
+        event.listen(session, "after_rollback", rolled_back, once=True)
+
+    def _uncommitted(self, key):
+        with self.delegated_identifiers.lock:
+            return key in self.uncommitted_identifiers
 
     def patron_from_authdata_lookup(self, authdata):
         """Look up a patron by their persistent authdata token."""
@@ -601,6 +710,9 @@ class AuthdataUtility(object):
     ADOBE_ACCOUNT_ID_PATRON_IDENTIFIER = "Identifier for Adobe account ID purposes"
     
     ALGORITHM = 'HS256'
+
+    # The number of verified tokens to remember.
+    VERIFIED_TOKEN_CACHE_SIZE = 10000
    
     def __init__(self, vendor_id, library_uri, library_short_name, secret,
                  other_libraries={}):
@@ -670,6 +782,14 @@ class AuthdataUtility(object):
             self.secret
         )
 
+        # Clients and ACS servers send the same token over and over
+        # again. Once a token has been verified, the result is kept
+        # until the token expires, so the signature doesn't have to
+        # be checked every time.
+        self.verified_tokens = TokenCache(
+            max_size=self.VERIFIED_TOKEN_CACHE_SIZE
+        )
+
     VENDOR_ID_KEY = u'vendor_id'
     OTHER_LIBRARIES_KEY = u'other_libraries'
 
@@ -805,6 +925,15 @@ class AuthdataUtility(object):
         """
 
         self.log.info("Authdata.decode() received authdata %s", authdata)
+        return self.verified_tokens.token(
+            ("authdata", authdata), lambda: self._verify(authdata)
+        )
+
+    def _verify(self, authdata):
+        """Decode and verify an authdata JWT.
+
+        :return: A 2-tuple ((library_uri, patron_identifier), expires)
+        """
         # We are going to try to verify the authdata as is (in case
         # Adobe secretly decoded it en route), but we're also going to
         # try to decode it ourselves and verify it that way.
@@ -820,7 +949,8 @@ class AuthdataUtility(object):
         library_uri = subject = None
         for authdata in potential_tokens:
             try:
-                return self._decode(authdata)
+                library_uri, subject, expires = self._decode(authdata)
+                return (library_uri, subject), expires
             except Exception, e:
                 self.log.error("Error decoding %s", authdata, exc_info=e)
                 exceptions.append(e)
@@ -851,7 +981,10 @@ class AuthdataUtility(object):
         decoded = jwt.decode(authdata, secret, algorithm=self.ALGORITHM)
         if not 'sub' in decoded:
             raise jwt.exceptions.DecodeError("No subject specified.")
-        return library_uri, decoded['sub']
+        expires = None
+        if 'exp' in decoded:
+            expires = self.EPOCH + datetime.timedelta(seconds=decoded['exp'])
+        return library_uri, decoded['sub'], expires
 
     def encode_short_client_token(self, patron_identifier):
         """Generate a short client token suitable for putting in an OPDS feed,
@@ -906,8 +1039,26 @@ class AuthdataUtility(object):
         """Decode a short client token that has already been split into
         two parts.
         """
-        signature = self.adobe_base64_decode(password)
-        return self._decode_short_client_token(username, signature)
+        def verify():
+            signature = self.adobe_base64_decode(password)
+            decoded = self._decode_short_client_token(username, signature)
+            return decoded, self._short_client_token_expires(username)
+        return self.verified_tokens.token(
+            ("short client token", username, password), verify
+        )
+
+    def _short_client_token_expires(self, token):
+        """Find when a short client token expires.
+
+        :return: A datetime. If the expiration time can't be
+        determined, the current time is returned, so that the token
+        isn't cached.
+        """
+        try:
+            expiration = float(token.split("|")[1])
+        except (IndexError, ValueError):
+            return datetime.datetime.utcnow()
+        return self.EPOCH + datetime.timedelta(seconds=expiration)
 
     def _decode_short_client_token(self, token, supposed_signature):
         """Make sure a client token is properly formatted, correctly signed,
@@ -32,6 +32,8 @@ from util.patron import PatronUtility
 from api.opds import CirculationManagerAnnotator
 
 import datetime
+import hashlib
+import hmac
 import logging
 from money import Money
 import os
@@ -50,6 +52,8 @@ from flask import (
 from werkzeug.datastructures import Headers
 from flask.ext.babel import lazy_gettext as _
 import importlib
+import threading
+import time
 
 
 class PatronData(object):
@@ -1091,6 +1095,75 @@ class AuthenticationProvider(OPDSAuthenticationFlow):
         raise NotImplementedError()
 
 
+class CredentialCache(object):
+    """Remember, for a short time, which username/password combinations
+    were recently verified by the source of truth.
+
+    Passwords are never stored. Instead, each entry holds a random salt
+    and a hash of the password with that salt.
+    """
+
+    # Once the cache holds this many entries, expired entries are
+    # cleared out.
+    MAX_ENTRIES = 10000
+
+    def __init__(self, ttl):
+        """Constructor.
+
+        :param ttl: A verified password is remembered for this many
+        seconds.
+        """
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def hash_password(cls, salt, password):
+        if isinstance(password, unicode):
+            password = password.encode("utf8")
+        return hashlib.sha256(salt + (password or "")).hexdigest()
+
+    def lookup(self, library_id, username, password, now=None):
+        """If the given credentials were verified recently, return the ID
+        of the corresponding Patron.
+
+        :return: A Patron ID, or None.
+        """
+        now = now or time.time()
+        entry = self.entries.get((library_id, username))
+        if not entry:
+            return None
+        salt, hashed, patron_id, expires = entry
+        if now > expires:
+            self.remove(library_id, username)
+            return None
+        if not hmac.compare_digest(
+                hashed, self.hash_password(salt, password)
+        ):
+            return None
+        return patron_id
+
+    def store(self, library_id, username, password, patron_id, now=None):
+        """Remember that the given credentials belong to the given Patron."""
+        now = now or time.time()
+        salt = os.urandom(16)
+        entry = (salt, self.hash_password(salt, password), patron_id,
+                 now + self.ttl)
+        with self.lock:
+            if len(self.entries) >= self.MAX_ENTRIES:
+                self._prune(now)
+            self.entries[(library_id, username)] = entry
+
+    def remove(self, library_id, username):
+        with self.lock:
+            self.entries.pop((library_id, username), None)
+
+    def _prune(self, now):
+        for key, entry in self.entries.items():
+            if now > entry[-1]:
+                del self.entries[key]
+
+
 class BasicAuthenticationProvider(AuthenticationProvider):
     """Verify a username/password, obtained through HTTP Basic Auth, with
     a remote source of truth.
@@ -1191,6 +1264,11 @@ class BasicAuthenticationProvider(AuthenticationProvider):
     TEST_IDENTIFIER = 'test_identifier'
     TEST_PASSWORD = 'test_password'
 
+    # Once the source of truth has approved a username and password,
+    # we may choose to trust them for this many seconds without
+    # asking again.
+    CREDENTIAL_CACHE_TIME = 'credential_cache_time'
+
     SETTINGS = [
         { "key": TEST_IDENTIFIER,
           "label": _("Test Identifier"),
@@ -1242,6 +1320,12 @@ class BasicAuthenticationProvider(AuthenticationProvider):
           "label": _("Label for password entry"),
           "optional": True,
         },
+        { "key": CREDENTIAL_CACHE_TIME,
+          "label": _("Number of seconds to trust a verified password without checking it again"),
+          "description": _("If this is not set, every request is checked with the source of truth."),
+          "type": "number",
+          "optional": True,
+        },
     ] + AuthenticationProvider.SETTINGS
     
     # Used in the constructor to signify that the default argument
@@ -1302,6 +1386,13 @@ class BasicAuthenticationProvider(AuthenticationProvider):
             integration.setting(self.PASSWORD_LABEL).value
             or self.DEFAULT_PASSWORD_LABEL
         )
+
+        credential_cache_time = integration.setting(
+            self.CREDENTIAL_CACHE_TIME).int_value
+        if credential_cache_time:
+            self.credential_cache = CredentialCache(credential_cache_time)
+        else:
+            self.credential_cache = None
         
     def testing_patron(self, _db):
         """Look up a Patron object reserved for testing purposes.
@@ -1336,6 +1427,51 @@ class BasicAuthenticationProvider(AuthenticationProvider):
             # need to be checked with the source of truth.
             return server_side_validation_result
 
+        # If the source of truth approved these credentials very
+        # recently, there's no need to ask it again. If the patron's
+        # metadata needs refreshing, authenticated_patron() will take
+        # care of that.
+        patron = self.cached_patron(_db, username, password)
+        if patron:
+            return patron
+
+        patron = self.authenticate_with_source_of_truth(
+            _db, username, password
+        )
+        if self.credential_cache:
+            if isinstance(patron, Patron):
+                self.credential_cache.store(
+                    self.library_id, username, password, patron.id
+                )
+            elif not patron:
+                # The credentials are wrong, and anything we remember
+                # about this username is out of date.
+                self.credential_cache.remove(self.library_id, username)
+        return patron
+
+    def cached_patron(self, _db, username, password):
+        """Find the Patron whose credentials these are, if the source of
+        truth approved them recently.
+
+        :return: A Patron, or None if the credentials need to be checked
+        with the source of truth.
+        """
+        if not self.credential_cache:
+            return None
+        patron_id = self.credential_cache.lookup(
+            self.library_id, username, password
+        )
+        if not patron_id:
+            return None
+        return get_one(_db, Patron, id=patron_id, library_id=self.library_id)
+
+    def authenticate_with_source_of_truth(self, _db, username, password):
+        """Check a username and password with the source of truth, and
+        turn them into a Patron object.
+
+        :return: A Patron if one can be authenticated; a ProblemDetail
+        if an error occurs; None if the credentials are wrong.
+        """
         # Check these credentials with the source of truth.
         patrondata = self.remote_authenticate(username, password)
 
@@ -1,5 +1,6 @@
 from nose.tools import set_trace
 from datetime import datetime, timedelta
+import itertools
 from flask.ext.babel import lazy_gettext as _
 from sqlalchemy.orm import contains_eager
 
@@ -31,6 +32,7 @@ from core.model import (
     get_one_or_create,
     Collection,
     Contributor,
+    CoverageRecord,
     DataSource,
     DeliveryMechanism,
     Edition,
@@ -57,6 +59,7 @@ from circulation import (
     BaseCirculationAPI
 )
 from circulation_exceptions import *
+from util.xmlparser import StreamingXMLParser
 
 
 class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI):
@@ -198,7 +201,7 @@ class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI):
         identifier_strings = self.create_identifier_strings(identifiers)
         response = self.availability(title_ids=identifier_strings)
         collection = self.collection
-        parser = BibliographicParser(collection)
+        parser = StreamingBibliographicParser(collection)
         remainder = set(identifiers)
         for bibliographic, availability in parser.process_all(response.content):
             identifier, is_new = bibliographic.primary_identifier.load(self._db)
@@ -268,6 +271,17 @@ class Axis360CirculationMonitor(CollectionMonitor):
             Axis360BibliographicCoverageProvider(collection, api_class=self.api)
         )
 
+        # Looking up the analytics integrations is expensive, so it's
+        # done once, rather than once per book.
+        self.analytics = Analytics(_db)
+        self.replacement_policy = ReplacementPolicy(
+            identifiers=False,
+            subjects=True,
+            contributions=True,
+            formats=True,
+            analytics=self.analytics,
+        )
+
     def run_once(self, start, cutoff):
         # Give us five minutes of overlap because it's very important
         # we don't miss anything.
@@ -275,50 +289,190 @@ class Axis360CirculationMonitor(CollectionMonitor):
         availability = self.api.availability(since=since)
         status_code = availability.status_code
         content = availability.content
-        count = 0
-        for bibliographic, circulation in BibliographicParser(self.collection).process_all(
-                content):
-            self.process_book(bibliographic, circulation)
-            count += 1
-            if count % self.batch_size == 0:
-                self._db.commit()
+        books = StreamingBibliographicParser(self.collection).process_all(
+            content
+        )
+        while True:
+            batch = list(itertools.islice(books, self.batch_size))
+            if not batch:
+                break
+            self.process_batch(batch)
+            self._db.commit()
+
+    def process_batch(self, batch):
+        """Bring a batch of books up to date.
+
+        :param batch: A list of (Metadata, CirculationData) 2-tuples.
+        :return: A list of (Edition, LicensePool) 2-tuples.
+        """
+        pools, editions = self.existing_records(
+            [bibliographic for bibliographic, availability in batch]
+        )
+        results = []
+        needs_coverage = []
+        for bibliographic, availability in batch:
+            key = bibliographic.primary_identifier.identifier
+            edition, license_pool, is_new = self._process_book(
+                bibliographic, availability,
+                pools.get(key), editions.get(key)
+            )
+            if is_new:
+                # At this point we have done work equivalent to that
+                # done by the Axis360BibliographicCoverageProvider.
+                identifier = edition.primary_identifier
+                self.bibliographic_coverage_provider.handle_success(
+                    identifier
+                )
+                needs_coverage.append(identifier)
+            results.append((edition, license_pool))
 
-    def process_book(self, bibliographic, availability):
+        # Register that the work has been done so we don't have to do
+        # it again.
+        self.add_coverage_records_for(needs_coverage)
+        return results
 
-        analytics = Analytics(self._db)
-        license_pool, new_license_pool = availability.license_pool(
-            self._db, self.collection, analytics
+    def process_book(self, bibliographic, availability):
+        [(edition, license_pool)] = self.process_batch(
+            [(bibliographic, availability)]
         )
-        edition, new_edition = bibliographic.edition(self._db)
+        return edition, license_pool
+
+    def _process_book(self, bibliographic, availability,
+                      license_pool=None, edition=None):
+        """Apply bibliographic and circulation information to a book.
+
+        :param license_pool: The book's LicensePool, if it was found
+        ahead of time.
+        :param edition: The book's Axis 360 Edition, if it was found
+        ahead of time.
+
+        :return: A 3-tuple (Edition, LicensePool, is_new). `is_new` is
+        True if either the Edition or the LicensePool had to be created.
+        """
+        new_license_pool = new_edition = False
+        if license_pool is None:
+            license_pool, new_license_pool = availability.license_pool(
+                self._db, self.collection, self.analytics
+            )
+        if edition is None:
+            edition, new_edition = bibliographic.edition(self._db)
         license_pool.edition = edition
-        policy = ReplacementPolicy(
-            identifiers=False,
-            subjects=True,
-            contributions=True,
-            formats=True,
-            analytics=analytics,
-        )
+        policy = self.replacement_policy
         availability.apply(self._db, self.collection, replace=policy)
         if new_edition:
             bibliographic.apply(edition, self.collection, replace=policy)
+        return edition, license_pool, (new_license_pool or new_edition)
 
-        if new_license_pool or new_edition:
-            # At this point we have done work equivalent to that done by 
-            # the Axis360BibliographicCoverageProvider. Register that the
-            # work has been done so we don't have to do it again.
-            identifier = edition.primary_identifier
-            self.bibliographic_coverage_provider.handle_success(identifier)
-            self.bibliographic_coverage_provider.add_coverage_record_for(
-                identifier
-            )
-            
-        return edition, license_pool
+    def existing_records(self, books):
+        """Look up the LicensePools and Axis 360 Editions that already
+        exist for a batch of books.
+
+        :param books: A list of Metadata objects.
+        :return: A 2-tuple of dictionaries (pools, editions), each keyed
+        by Axis 360 ID.
+        """
+        axis_ids = [x.primary_identifier.identifier for x in books]
+        if not axis_ids:
+            return {}, {}
+        pools = self._db.query(LicensePool).join(
+            LicensePool.identifier
+        ).filter(
+            LicensePool.collection==self.collection
+        ).filter(
+            Identifier.type==Identifier.AXIS_360_ID
+        ).filter(
+            Identifier.identifier.in_(axis_ids)
+        ).options(contains_eager(LicensePool.identifier))
+
+        data_source = DataSource.lookup(self._db, DataSource.AXIS_360)
+        editions = self._db.query(Edition).join(
+            Edition.primary_identifier
+        ).filter(
+            Edition.data_source==data_source
+        ).filter(
+            Identifier.type==Identifier.AXIS_360_ID
+        ).filter(
+            Identifier.identifier.in_(axis_ids)
+        ).options(contains_eager(Edition.primary_identifier))
+
+        return (
+            dict((x.identifier.identifier, x) for x in pools),
+            dict((x.primary_identifier.identifier, x) for x in editions),
+        )
+
+    def add_coverage_records_for(self, identifiers):
+        """Record that the Axis 360 bibliographic coverage provider has
+        covered a batch of Identifiers.
+
+        This is equivalent to calling add_coverage_record_for() on
+        each Identifier, but the new CoverageRecords are created with
+        a single INSERT.
+        """
+        if not identifiers:
+            return
+        # Make sure every Identifier has an ID.
+        self._db.flush()
+        provider = self.bibliographic_coverage_provider
+        data_source = provider.data_source
+        operation = provider.operation
+        # The records are tied to the provider's Collection only if
+        # its coverage doesn't count for every Collection.
+        collection = provider.collection_or_not
+        collection_id = collection.id if collection else None
+        now = datetime.utcnow()
+        by_id = dict((x.id, x) for x in identifiers)
+
+        existing = self._db.query(CoverageRecord).filter(
+            CoverageRecord.identifier_id.in_(by_id.keys())
+        ).filter(
+            CoverageRecord.data_source==data_source
+        ).filter(
+            CoverageRecord.operation==operation
+        ).filter(
+            CoverageRecord.collection_id==collection_id
+        )
+        covered = set()
+        for record in existing:
+            record.timestamp = now
+            record.status = CoverageRecord.SUCCESS
+            record.exception = None
+            covered.add(record.identifier_id)
+
+        new_records = [
+            dict(identifier_id=identifier_id, data_source_id=data_source.id,
+                 operation=operation, collection_id=collection_id,
+                 timestamp=now,
+                 status=CoverageRecord.SUCCESS)
+            for identifier_id in by_id if identifier_id not in covered
+        ]
+        if new_records:
+            self._db.bulk_insert_mappings(CoverageRecord, new_records)
+            for identifier in identifiers:
+                # The bulk insert bypassed the session, so any loaded
+                # list of coverage records is now out of date.
+                self._db.expire(identifier, ['coverage_records'])
 
 
 class MockAxis360API(BaseMockAxis360API, Axis360API):
     pass
 
 
+class StreamingBibliographicParser(StreamingXMLParser, BibliographicParser):
+    """Turn each title in an Axis 360 availability document into a
+    (Metadata, CirculationData) 2-tuple as soon as it's read.
+
+    A full catalog can run to hundreds of megabytes, so the document is
+    never turned into a tree all at once. (The document itself is
+    still held in memory; see StreamingXMLParser.)
+    """
+
+    def process_all(self, source):
+        """:param source: A string or a file-like object."""
+        return self.process_all_streaming(
+            source, "{%s}title" % self.NS['axis'], self.NS
+        )
+
+
 class AxisCollectionReaper(IdentifierSweepMonitor):
     """Check for books that are in the local collection but have left our
     Axis 360 collection.
@@ -1,16 +1,19 @@
 from lxml import etree
 
 from cStringIO import StringIO
+from collections import deque
 import itertools
 import datetime
 import os
 import re
 import logging
+from multiprocessing.pool import ThreadPool
 from flask.ext.babel import lazy_gettext as _
 
 from nose.tools import set_trace
 
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 
 from circulation import (
     FulfillmentInfo,
@@ -41,6 +44,7 @@ from core.monitor import (
     IdentifierSweepMonitor,
 )
 from core.util.xmlparser import XMLParser
+from util.xmlparser import StreamingXMLParser
 from core.util.http import (
     BadResponseException
 )
@@ -63,6 +67,10 @@ class BibliothecaAPI(BaseBibliothecaAPI, BaseCirculationAPI):
     ] + BaseCirculationAPI.SETTINGS
 
     MAX_AGE = datetime.timedelta(days=730).seconds
+
+    # Ask about the circulation of at most this many items in a
+    # single request, to keep the URL a reasonable length.
+    MAX_CIRCULATION_ITEMS_PER_REQUEST = 25
     CAN_REVOKE_HOLD_WHEN_RESERVED = False
     SET_DELIVERY_MECHANISM_AT = None
 
@@ -110,10 +118,13 @@ class BibliothecaAPI(BaseBibliothecaAPI, BaseCirculationAPI):
 
     def get_circulation_for(self, identifiers):
         """Return circulation objects for the selected identifiers."""
-        response = self.circulation_request(identifiers)
-        for circ in CirculationParser().process_all(response.content):
-            if circ:
-                yield circ
+        identifiers = list(identifiers)
+        size = self.MAX_CIRCULATION_ITEMS_PER_REQUEST
+        for i in range(0, len(identifiers), size):
+            response = self.circulation_request(identifiers[i:i+size])
+            for circ in CirculationParser().process_all(response.content):
+                if circ:
+                    yield circ
 
     def update_availability(self, licensepool):
         """Update the availability information for a single LicensePool."""
@@ -288,7 +299,7 @@ class MockBibliothecaAPI(BaseMockBibliothecaAPI, BibliothecaAPI):
     pass
 
 
-class BibliothecaParser(XMLParser):
+class BibliothecaParser(StreamingXMLParser):
 
     INPUT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
@@ -324,10 +335,12 @@ class CirculationParser(BibliothecaParser):
 
     """Parse Bibliotheca's circulation XML dialect into something we can apply to a LicensePool."""
 
-    def process_all(self, string):
-        for i in super(CirculationParser, self).process_all(
-                string, "//ItemCirculation"):
-            yield i
+    def process_all(self, source):
+        """Yield circulation information for each item as it's read.
+
+        :param source: A string or a file-like object.
+        """
+        return self.process_all_streaming(source, "ItemCirculation")
 
     def process_one(self, tag, namespaces):
         if not tag.xpath("ItemId"):
@@ -594,10 +607,12 @@ class EventParser(BibliothecaParser):
         "REMOVED" : CirculationEvent.DISTRIBUTOR_LICENSE_REMOVE,
     }
 
-    def process_all(self, string):
-        for i in super(EventParser, self).process_all(
-                string, "//CloudLibraryEvent"):
-            yield i
+    def process_all(self, source):
+        """Yield each event as it's read.
+
+        :param source: A string or a file-like object.
+        """
+        return self.process_all_streaming(source, "CloudLibraryEvent")
 
     def process_one(self, tag, namespaces):
         isbn = self.text_of_subtag(tag, "ISBN")
@@ -625,7 +640,11 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
     view of our Bibliotheca circulation, which is more important.
     """
     SERVICE_NAME = "Bibliotheca Circulation Sweep"
-    DEFAULT_BATCH_SIZE = 25
+
+    # BibliothecaAPI.get_circulation_for splits each batch into
+    # requests of a size Bibliotheca can handle, so the batch size
+    # only controls how much database work is done at once.
+    DEFAULT_BATCH_SIZE = 100
     PROTOCOL = ExternalIntegration.BIBLIOTHECA
 
     def __init__(self, _db, collection, api_class=BibliothecaAPI, **kwargs):
@@ -648,6 +667,7 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
 
         identifiers_not_mentioned_by_bibliotheca = set(identifiers)
         now = datetime.datetime.utcnow()
+        pools_by_identifier = self.license_pools_for(identifiers)
 
         for circ in self.api.get_circulation_for(bibliotheca_ids):
             if not circ:
@@ -655,6 +675,7 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
             self._process_circulation_data(
                 circ, identifiers_by_bibliotheca_id,
                 identifiers_not_mentioned_by_bibliotheca,
+                pools_by_identifier
             )
 
         # At this point there may be some license pools left over
@@ -662,38 +683,59 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
         # indication that we no longer own any licenses to the
         # book.
         for identifier in identifiers_not_mentioned_by_bibliotheca:
-            pools = [lp for lp in identifier.licensed_through
-                     if lp.data_source.name==DataSource.BIBLIOTHECA
-                     and lp.collection == self.collection]
-            if not pools:
+            pool = pools_by_identifier.get(identifier.id)
+            if not pool:
                 continue
-            for pool in pools:
-                if pool.licenses_owned > 0:
-                    if pool.presentation_edition:
-                        self.log.warn("Removing %s (%s) from circulation",
-                                      pool.presentation_edition.title, pool.presentation_edition.author)
-                    else:
-                        self.log.warn(
-                            "Removing unknown work %s from circulation.",
-                            identifier.identifier
-                        )
-                pool.update_availability(0, 0, 0, 0, self.analytics)
-                pool.last_checked = now
+            if pool.licenses_owned > 0:
+                if pool.presentation_edition:
+                    self.log.warn("Removing %s (%s) from circulation",
+                                  pool.presentation_edition.title, pool.presentation_edition.author)
+                else:
+                    self.log.warn(
+                        "Removing unknown work %s from circulation.",
+                        identifier.identifier
+                    )
+            pool.update_availability(0, 0, 0, 0, self.analytics)
+            pool.last_checked = now
+
+    def license_pools_for(self, identifiers):
+        """Find this collection's Bibliotheca LicensePools for a number of
+        identifiers with a single query.
+
+        :return: A dictionary mapping Identifier IDs to LicensePools.
+        """
+        identifier_ids = [x.id for x in identifiers]
+        if not identifier_ids:
+            return {}
+        data_source = DataSource.lookup(self._db, DataSource.BIBLIOTHECA)
+        qu = self._db.query(LicensePool).filter(
+            LicensePool.identifier_id.in_(identifier_ids)
+        ).filter(
+            LicensePool.collection_id==self.collection.id
+        ).filter(
+            LicensePool.data_source_id==data_source.id
+        ).options(
+            joinedload(LicensePool.presentation_edition)
+        )
+        return dict((pool.identifier_id, pool) for pool in qu)
 
     def _process_circulation_data(
         self, circ, identifiers_by_bibliotheca_id, 
-        identifiers_not_mentioned_by_bibliotheca
+        identifiers_not_mentioned_by_bibliotheca, pools_by_identifier=None
     ):
         """Process a single CirculationData object retrieved from
         Bibliotheca.
+
+        :param pools_by_identifier: The output of license_pools_for(),
+        if it's already been called for this batch.
         """
         bibliotheca_id = circ[Identifier][Identifier.BIBLIOTHECA_ID]
         identifier = identifiers_by_bibliotheca_id[bibliotheca_id]
         identifiers_not_mentioned_by_bibliotheca.remove(identifier)
-        pools = [lp for lp in identifier.licensed_through
-                 if lp.data_source.name==DataSource.BIBLIOTHECA
-                 and lp.collection == self.collection]
-        if not pools:
+        if pools_by_identifier is None:
+            pools_by_identifier = self.license_pools_for([identifier])
+        pool = pools_by_identifier.get(identifier.id)
+        if not pool:
             # We don't have a license pool for this work. That
             # shouldn't happen--how did we know about the
             # identifier?--but it shouldn't be a big deal to
@@ -711,9 +753,8 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
                     library, pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, 
                     datetime.datetime.utcnow()
                 )
-        else:
-            [pool] = pools
-                
+            pools_by_identifier[identifier.id] = pool
+
         self.api.apply_circulation_information_to_licensepool(
             circ, pool, self.analytics
         )
@@ -740,9 +781,17 @@ class BibliothecaEventMonitor(CollectionMonitor):
     DEFAULT_START_TIME = datetime.timedelta(365*3)
     PROTOCOL = ExternalIntegration.BIBLIOTHECA
 
+    # When catching up on more than one day of events, fetch and
+    # parse this many upcoming days in the background while the
+    # current day's events are handled.
+    DEFAULT_PREFETCH_SLICES = 3
+
     def __init__(self, _db, collection, api_class=BibliothecaAPI, 
-                 cli_date=None, analytics=None):
+                 cli_date=None, analytics=None, prefetch_slices=None):
         self.analytics = analytics or Analytics(_db)
+        if prefetch_slices is None:
+            prefetch_slices = self.DEFAULT_PREFETCH_SLICES
+        self.prefetch_slices = prefetch_slices
         super(BibliothecaEventMonitor, self).__init__(_db, collection)
         if isinstance(api_class, BibliothecaAPI):
             # We were given an actual API object. Just use it.
@@ -808,13 +857,17 @@ class BibliothecaEventMonitor(CollectionMonitor):
         i = 0
         one_day = datetime.timedelta(days=1)
         most_recent_timestamp = start
-        for start, cutoff, full_slice in self.slice_timespan(
-                start, cutoff, one_day):
+        slices = list(self.slice_timespan(start, cutoff, one_day))
+        if self.prefetch_slices and len(slices) > 1:
+            fetches = self.prefetch_events(slices)
+        else:
+            fetches = self.fetch_events(slices)
+        for (start, cutoff, full_slice), get_events in fetches:
             most_recent_timestamp = start
             self.log.info("Asking for events between %r and %r", start, cutoff)
             try:
                 event = None
-                events = self.api.get_events_between(start, cutoff, full_slice)
+                events = get_events()
                 for event in events:
                     event_timestamp = self.handle_event(*event)
                     if (not most_recent_timestamp or
@@ -823,6 +876,14 @@ class BibliothecaEventMonitor(CollectionMonitor):
                     i += 1
                     if not i % 1000:
                         self._db.commit()
+
+                # Every event in this slice has been handled. If we
+                # crash after this point, the next run can pick up
+                # here rather than at the beginning of the timespan.
+                timestamp = Timestamp.stamp(
+                    self._db, self.service_name, self.collection
+                )
+                timestamp.timestamp = most_recent_timestamp
                 self._db.commit()
             except Exception, e:
                 if event:
@@ -839,6 +900,53 @@ class BibliothecaEventMonitor(CollectionMonitor):
         self.log.info("Handled %d events total", i)
         return most_recent_timestamp
 
+    def fetch_events(self, slices):
+        """Get the events for each slice of time when it's needed.
+
+        :yield: A 2-tuple (slice, get_events) for each slice. Calling
+        get_events() returns the events in the slice.
+        """
+        for start, cutoff, full_slice in slices:
+            def get_events(start=start, cutoff=cutoff, full_slice=full_slice):
+                return self.api.get_events_between(start, cutoff, full_slice)
+            yield (start, cutoff, full_slice), get_events
+
+    def prefetch_events(self, slices):
+        """Fetch and parse the events for upcoming slices of time in the
+        background, while the events in the current slice are handled.
+
+        The background threads don't touch the database, so responses
+        aren't cached as Representations in this mode.
+
+        :yield: A 2-tuple (slice, get_events) for each slice, in order.
+        Calling get_events() waits for the slice's events to arrive.
+        """
+        pool = ThreadPool(self.prefetch_slices)
+        try:
+            slices = iter(slices)
+            pending = deque()
+            def fetch(timespan):
+                start, cutoff, full_slice = timespan
+                pending.append(
+                    (timespan, pool.apply_async(
+                        self._fetch_and_parse_events, (start, cutoff)
+                    ))
+                )
+            for timespan in itertools.islice(slices, self.prefetch_slices):
+                fetch(timespan)
+            while pending:
+                timespan, result = pending.popleft()
+                upcoming = next(slices, None)
+                if upcoming:
+                    fetch(upcoming)
+                yield timespan, result.get
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _fetch_and_parse_events(self, start, cutoff):
+        return list(self.api.get_events_between(start, cutoff, False))
+
     def handle_event(self, bibliotheca_id, isbn, foreign_patron_id,
                      start_time, end_time, internal_event_type):
         # Find or lookup the LicensePool for this event.
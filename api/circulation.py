@@ -2,11 +2,24 @@ from nose.tools import set_trace
 from circulation_exceptions import *
 import datetime
 from collections import defaultdict
-from threading import Thread
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
 import logging
+import Queue
 import re
 import time
 from flask.ext.babel import lazy_gettext as _
+from sqlalchemy import (
+    and_,
+    or_,
+)
+from sqlalchemy.orm import (
+    contains_eager,
+    joinedload,
+)
 
 from core.config import CannotLoadConfiguration
 from core.cdn import cdnify
@@ -27,6 +40,7 @@ from core.model import (
     Session,
 )
 from util.patron import PatronUtility
+from util.query_counter import QueryCounter
 from config import Configuration
 
 class CirculationInfo(object):
@@ -168,13 +182,294 @@ class HoldInfo(CirculationInfo):
         )
 
 
+class PatronActivityTask(object):
+    """A request to a single circulation API for a patron's activity,
+    to be run by a PatronActivityPool.
+    """
+
+    def __init__(self, api, patron, pin, deadline=None):
+        """Constructor.
+
+        :param deadline: If the task hasn't started by this time (as
+        returned by time.time()), nobody is waiting for its result
+        any more, and it won't be run at all.
+        """
+        self.api = api
+        self.patron = patron
+        self.pin = pin
+        self.deadline = deadline
+        self.activity = None
+        self.exception = None
+        self.duration = None
+        self._finished = Event()
+
+    def run(self):
+        before = time.time()
+        if self.deadline is not None and before > self.deadline:
+            self.fail(
+                Exception("Deadline passed before the lookup could start.")
+            )
+            return
+        try:
+            self.activity = self.api.patron_activity(self.patron, self.pin)
+        except Exception, e:
+            self.exception = e
+        self.duration = time.time() - before
+        self._finished.set()
+
+    def fail(self, exception):
+        """Finish the task without running it."""
+        self.exception = exception
+        self.duration = 0
+        self._finished.set()
+
+    def wait(self, timeout=None):
+        """Wait for the task to finish.
+
+        :param timeout: Give up after this many seconds. If this is
+        None, wait as long as it takes.
+
+        :return: True if the task finished, False if we gave up.
+        """
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+
+class PatronActivityPool(object):
+    """A fixed-size pool of long-lived worker threads that run
+    PatronActivityTasks.
+
+    One of these is shared by every CirculationAPI in a process, so
+    that syncing a patron's bookshelf doesn't mean starting a new
+    thread for every collection.
+
+    Only a limited number of tasks may wait for a worker. If a vendor
+    stops responding and ties up every worker, new lookups fail right
+    away instead of piling up behind the ones that are stuck.
+    """
+
+    DEFAULT_SIZE = 10
+
+    # By default, this many tasks per worker may wait in the queue.
+    DEFAULT_QUEUE_SIZE_PER_WORKER = 10
+
+    # The pool used by CirculationAPIs that weren't given one
+    # explicitly.
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self, size=None, queue_size=None):
+        """Constructor.
+
+        :param size: The number of worker threads.
+        :param queue_size: The number of tasks that may wait for a
+        worker before submit() starts turning tasks away.
+        """
+        self.size = size or self.DEFAULT_SIZE
+        self.queue_size = (
+            queue_size or self.size * self.DEFAULT_QUEUE_SIZE_PER_WORKER
+        )
+        self.tasks = Queue.Queue(self.queue_size)
+        self.log = logging.getLogger("Patron activity pool")
+        self.workers = []
+        for i in range(self.size):
+            worker = Thread(
+                target=self._work, name="PatronActivityWorker-%d" % i
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    @classmethod
+    def shared(cls):
+        """Find or create the process-wide PatronActivityPool."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+        return cls._shared
+
+    def submit(self, api, patron, pin, deadline=None):
+        """Ask a worker to look up a patron's activity with the given API.
+
+        :param deadline: Don't bother running the task if it hasn't
+        started by this time.
+
+        :return: A PatronActivityTask. If the queue is full, the task
+        has already failed with a PatronActivityPoolFull exception.
+        """
+        task = PatronActivityTask(api, patron, pin, deadline)
+        try:
+            self.tasks.put_nowait(task)
+        except Queue.Full:
+            task.fail(PatronActivityPoolFull(
+                "%d patron activity lookups are already waiting." %
+                self.queue_size
+            ))
+        return task
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                task.run()
+                self.log.debug(
+                    "Synced %s in %.2f sec", task.api.__class__.__name__,
+                    task.duration
+                )
+            finally:
+                self._end_session(task.api)
+                self.tasks.task_done()
+
+    def _end_session(self, api):
+        """Commit any changes the task made through this worker's
+        database session, and give the session back, so the worker
+        doesn't sit on an open transaction until its next task.
+
+        This only applies to scoped sessions. A plain session is
+        shared with the thread that submitted the task, and is left
+        for that thread to deal with.
+        """
+        _db = getattr(api, '_db', None)
+        if not hasattr(_db, 'remove'):
+            return
+        try:
+            _db.commit()
+        except Exception, e:
+            self.log.error(
+                "Could not commit patron activity changes: %s", e, exc_info=e
+            )
+            _db.rollback()
+        finally:
+            _db.remove()
+
+
+class BookshelfSyncCache(object):
+    """Keep track of when each patron's bookshelf was last synced with
+    each Collection, and of which patrons' bookshelves are being
+    synced right now.
+
+    This lets us skip the remote APIs when a patron's bookshelf is
+    known to be up to date, and lets several simultaneous requests
+    from the same patron share one sync.
+
+    All of this is kept in memory, so it only covers requests handled
+    by the same process. Requests handled by different processes (or
+    different servers) may still sync the same bookshelf at the same
+    time.
+    """
+
+    # Once we're keeping track of this many (patron, collection)
+    # pairs, start throwing out information that's no longer fresh.
+    MAX_ENTRIES = 10000
+
+    def __init__(self, freshness):
+        """Constructor.
+
+        :param freshness: A bookshelf is considered up to date for
+        this many seconds after it's synced.
+        """
+        self.freshness = freshness
+        self.last_sync = {}
+        self.invalidated = {}
+        self.in_progress = {}
+        self.lock = Lock()
+
+    def is_fresh(self, patron, collection_ids, now=None):
+        """Has the patron's bookshelf been synced with all of these
+        Collections recently?
+        """
+        if not self.freshness:
+            return False
+        now = now or time.time()
+        with self.lock:
+            for collection_id in collection_ids:
+                synced = self.last_sync.get((patron.id, collection_id))
+                if synced is None or now - synced > self.freshness:
+                    return False
+        return True
+
+    def record_sync(self, patron, collection_ids, started):
+        """Note that the patron's bookshelf was synced with the given
+        Collections, in a sync that started at `started`.
+
+        If any of the Collections were invalidated while the sync was
+        running, they're not considered fresh.
+        """
+        with self.lock:
+            for collection_id in collection_ids:
+                key = (patron.id, collection_id)
+                if self.invalidated.get(key, 0) >= started:
+                    continue
+                self.last_sync[key] = started
+                self.invalidated.pop(key, None)
+            if len(self.last_sync) > self.MAX_ENTRIES:
+                self._prune(time.time())
+
+    def invalidate(self, patron, collection_id):
+        """The patron's bookshelf has changed in a way that means we
+        need to sync with the given Collection next time.
+        """
+        with self.lock:
+            key = (patron.id, collection_id)
+            self.last_sync.pop(key, None)
+            self.invalidated[key] = time.time()
+
+    def start_sync(self, patron):
+        """Try to become the thread responsible for syncing the patron's
+        bookshelf.
+
+        :return: A 2-tuple (leader, event). If `leader` is True, the
+        caller must sync the bookshelf and then call finish_sync(). If
+        not, another thread is already syncing the bookshelf and
+        `event` will be set when it's done.
+        """
+        with self.lock:
+            event = self.in_progress.get(patron.id)
+            if event:
+                return False, event
+            event = Event()
+            self.in_progress[patron.id] = event
+            return True, event
+
+    def finish_sync(self, patron):
+        """Wake up anyone who was waiting on this patron's sync."""
+        with self.lock:
+            event = self.in_progress.pop(patron.id, None)
+        if event:
+            event.set()
+
+    def _prune(self, now):
+        for cache in (self.last_sync, self.invalidated):
+            for key, value in cache.items():
+                if now - value > self.freshness:
+                    del cache[key]
+
+
 class CirculationAPI(object):
     """Implement basic circulation logic and abstract away the details
     between different circulation APIs behind generic operations like
     'borrow'.
     """
 
-    def __init__(self, _db, library, analytics=None, api_map=None):
+    # If a collection doesn't configure a deadline for patron
+    # activity lookups, give up on it after this many seconds.
+    DEFAULT_PATRON_ACTIVITY_TIMEOUT = 20
+
+    # If another thread is syncing a patron's bookshelf, wait this
+    # many seconds for it to finish before giving up and syncing the
+    # bookshelf ourselves.
+    BOOKSHELF_SYNC_WAIT_TIMEOUT = 30
+
+    # If a library doesn't say otherwise, a patron's bookshelf is
+    # considered up to date for this many seconds after it's synced.
+    DEFAULT_BOOKSHELF_SYNC_FRESHNESS = 30
+
+    def __init__(self, _db, library, analytics=None, api_map=None,
+                 patron_activity_pool=None):
         """Constructor.
 
         :param _db: A database session (probably a scoped session, which is
@@ -194,12 +489,30 @@ class CirculationAPI(object):
            Since instantiating these API classes may result in API
            calls, we only instantiate one CirculationAPI per library,
            and keep them around as long as possible.
+
+        :param patron_activity_pool: A PatronActivityPool to use when
+           asking the APIs about a patron's activity. By default, the
+           process-wide pool is used.
         """
         self._db = _db
         self.library_id = library.id
         self.analytics = analytics
         self.initialization_exceptions = dict()
         api_map = api_map or self.default_api_map
+        self.patron_activity_pool = (
+            patron_activity_pool or PatronActivityPool.shared()
+        )
+
+        # How long we're willing to wait for each Collection's API to
+        # tell us about a patron's activity.
+        self.patron_activity_timeout_for_collection = {}
+
+        freshness = ConfigurationSetting.for_library(
+            Configuration.BOOKSHELF_SYNC_FRESHNESS, library
+        ).int_value
+        if freshness is None:
+            freshness = self.DEFAULT_BOOKSHELF_SYNC_FRESHNESS
+        self.bookshelf_sync_cache = BookshelfSyncCache(freshness)
 
         # Each of the Library's relevant Collections is going to be
         # associated with an API object.
@@ -226,6 +539,21 @@ class CirculationAPI(object):
                 if api:
                     self.api_for_collection[collection.id] = api
                     self.collection_ids_for_sync.append(collection.id)
+                    self.patron_activity_timeout_for_collection[
+                        collection.id
+                    ] = self.patron_activity_timeout(collection)
+
+    def patron_activity_timeout(self, collection):
+        """How many seconds should we wait for the given Collection's
+        API to report on a patron's activity?
+        """
+        timeout = None
+        integration = collection.external_integration
+        if integration:
+            timeout = integration.setting(
+                BaseCirculationAPI.PATRON_ACTIVITY_TIMEOUT
+            ).int_value
+        return timeout or self.DEFAULT_PATRON_ACTIVITY_TIMEOUT
 
     @property
     def library(self):
@@ -278,6 +606,10 @@ class CirculationAPI(object):
         # Short-circuit the request if the patron lacks borrowing
         # privileges.
         PatronUtility.assert_borrowing_privileges(patron)        
+
+        # Whatever happens, the patron's bookshelf will need to be
+        # synced with this collection next time.
+        self.bookshelf_sync_cache.invalidate(patron, licensepool.collection_id)
         
         now = datetime.datetime.utcnow()
         if licensepool.open_access:
@@ -327,10 +659,12 @@ class CirculationAPI(object):
             # certain error conditions (like NoAvailableCopies) mean
             # something different if you already have a confirmed
             # active loan.
-
-            # TODO: This would be a great place to pass in only the
-            # single API that needs to be synced.
-            self.sync_bookshelf(patron, pin)
+            #
+            # Only the collection that provides this book needs to be
+            # synced.
+            self.sync_bookshelf(
+                patron, pin, collection_ids=[licensepool.collection_id]
+            )
             existing_loan = get_one(
                 self._db, Loan, patron=patron, license_pool=licensepool,
                 on_multiple='interchangeable'
@@ -482,6 +816,7 @@ class CirculationAPI(object):
 
         :return: A FulfillmentInfo object.
         """
+        self.bookshelf_sync_cache.invalidate(patron, licensepool.collection_id)
         fulfillment = None
         loan = get_one(
             self._db, Loan, patron=patron, license_pool=licensepool,
@@ -489,10 +824,11 @@ class CirculationAPI(object):
         )
         if not loan:
             if sync_on_failure:
-                # Sync and try again.
-                # TODO: Pass in only the single collection or LicensePool
-                # that needs to be synced.
-                self.sync_bookshelf(patron, pin)
+                # Sync the collection that provides this book and
+                # try again.
+                self.sync_bookshelf(
+                    patron, pin, collection_ids=[licensepool.collection_id]
+                )
                 return self.fulfill(
                     patron, pin, licensepool=licensepool,
                     delivery_mechanism=delivery_mechanism,
@@ -580,6 +916,7 @@ class CirculationAPI(object):
 
     def revoke_loan(self, patron, pin, licensepool):
         """Revoke a patron's loan for a book."""
+        self.bookshelf_sync_cache.invalidate(patron, licensepool.collection_id)
         loan = get_one(
             self._db, Loan, patron=patron, license_pool=licensepool,
             on_multiple='interchangeable'
@@ -613,6 +950,7 @@ class CirculationAPI(object):
 
     def release_hold(self, patron, pin, licensepool):
         """Remove a patron's hold on a book."""
+        self.bookshelf_sync_cache.invalidate(patron, licensepool.collection_id)
         hold = get_one(
             self._db, Hold, patron=patron, license_pool=licensepool,
             on_multiple='interchangeable'
@@ -643,62 +981,63 @@ class CirculationAPI(object):
 
         return True
 
-    def patron_activity(self, patron, pin):
+    def patron_activity(self, patron, pin, collection_ids=None):
         """Return a record of the patron's current activity
         vis-a-vis all relevant external loan sources.
 
-        We check each source in a separate thread for speed.
+        We check each source in parallel, using the worker threads of
+        our PatronActivityPool. If a source doesn't respond within its
+        deadline, we give up on it and return whatever the other
+        sources told us.
 
-        :return: A 2-tuple (loans, holds) containing `HoldInfo` and
-        `LoanInfo` objects.
-        """
-        log = self.log
-        class PatronActivityThread(Thread):
-            def __init__(self, api, patron, pin):
-                self.api = api
-                self.patron = patron
-                self.pin = pin
-                self.activity = None
-                self.exception = None
-                super(PatronActivityThread, self).__init__()
+        :param collection_ids: Only check the sources for these
+        Collections. By default, every source is checked.
 
-            def run(self):
-                before = time.time()
-                try:
-                    self.activity = self.api.patron_activity(
-                        self.patron, self.pin)
-                except Exception, e:
-                    self.exception = e
-                after = time.time()
-                log.debug(
-                    "Synced %s in %.2f sec", self.api.__class__.__name__,
-                    after-before
-                )
-
-        threads = []
+        :return: A 3-tuple (loans, holds, complete) containing
+        `LoanInfo` objects, `HoldInfo` objects, and a boolean that is
+        False if any source errored out or missed its deadline (in
+        which case we don't have a complete picture of the patron's
+        loans and holds).
+        """
         before = time.time()
-        for api in self.api_for_collection.values():
-            thread = PatronActivityThread(api, patron, pin)
-            threads.append(thread)
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
+        tasks = []
+        for collection_id, api in self.api_for_collection.items():
+            if collection_ids is not None and collection_id not in collection_ids:
+                continue
+            timeout = self.patron_activity_timeout_for_collection.get(
+                collection_id, self.DEFAULT_PATRON_ACTIVITY_TIMEOUT
+            )
+            deadline = before + timeout
+            task = self.patron_activity_pool.submit(
+                api, patron, pin, deadline
+            )
+            tasks.append((task, deadline))
+
         loans = []
         holds = []
         complete = True
-        for thread in threads:
-            if thread.exception:
+        for task, deadline in tasks:
+            if not task.wait(max(deadline - time.time(), 0)):
+                # This source is taking too long. We'll leave it
+                # running, but we won't wait for it, which means we
+                # don't have a complete picture of the patron's loans.
+                complete = False
+                self.log.warn(
+                    "%s did not report patron activity within %.2f sec",
+                    task.api.__class__.__name__, deadline - before
+                )
+                continue
+            if task.exception:
                 # Something went wrong, so we don't have a complete
                 # picture of the patron's loans.
                 complete = False
                 self.log.error(
-                    "%s errored out: %s", thread.api.__class__.__name__,
-                    thread.exception,
-                    exc_info=thread.exception
+                    "%s errored out: %s", task.api.__class__.__name__,
+                    task.exception,
+                    exc_info=task.exception
                 )
-            if thread.activity:
-                for i in thread.activity:
+            if task.activity:
+                for i in task.activity:
                     l = None
                     if isinstance(i, LoanInfo):
                         l = loans
@@ -715,66 +1054,140 @@ class CirculationAPI(object):
         self.log.debug("Full sync took %.2f sec", after-before)
         return loans, holds, complete
 
-    def local_loans(self, patron):
+    def local_loans(self, patron, collection_ids=None):
+        if collection_ids is None:
+            collection_ids = self.collection_ids_for_sync
         return self._db.query(Loan).join(Loan.license_pool).filter(
-            LicensePool.collection_id.in_(self.collection_ids_for_sync)
+            LicensePool.collection_id.in_(collection_ids)
         ).filter(
             Loan.patron==patron
         )
 
-    def local_holds(self, patron):
+    def local_holds(self, patron, collection_ids=None):
+        if collection_ids is None:
+            collection_ids = self.collection_ids_for_sync
         return self._db.query(Hold).join(Hold.license_pool).filter(
-            LicensePool.collection_id.in_(self.collection_ids_for_sync)
+            LicensePool.collection_id.in_(collection_ids)
         ).filter(
             Hold.patron==patron
         )
 
-    def sync_bookshelf(self, patron, pin):
+    def sync_bookshelf(self, patron, pin, use_cache=False,
+                       collection_ids=None):
+        """Bring our local record of the patron's loans and holds into
+        line with what the remote APIs say.
+
+        :param use_cache: If this is True and the patron's bookshelf
+        was synced recently, don't contact the remote APIs at all. If
+        another thread is already syncing this patron's bookshelf,
+        wait for it to finish instead of starting a second sync.
 
-        # Get the external view of the patron's current state.
-        remote_loans, remote_holds, complete = self.patron_activity(patron, pin)
+        :param collection_ids: Only sync the patron's loans and holds
+        from these Collections. Loans and holds from other Collections
+        are left alone. By default, every Collection is synced.
 
+        :return: A 2-tuple (loans, holds).
+        """
+        cache = self.bookshelf_sync_cache
+        if collection_ids is None:
+            collection_ids = list(self.collection_ids_for_sync)
+        else:
+            collection_ids = [x for x in collection_ids
+                              if x in self.collection_ids_for_sync]
+        leader = False
+        if use_cache:
+            if cache.is_fresh(patron, collection_ids):
+                return (self.local_loans(patron, collection_ids).all(),
+                        self.local_holds(patron, collection_ids).all())
+            leader, in_progress = cache.start_sync(patron)
+            if not leader:
+                # Someone else is syncing this bookshelf right now.
+                # Once they're done, our local view is as good as
+                # theirs.
+                if in_progress.wait(self.BOOKSHELF_SYNC_WAIT_TIMEOUT):
+                    return (self.local_loans(patron, collection_ids).all(),
+                            self.local_holds(patron, collection_ids).all())
+                # They're taking too long. Sync the bookshelf
+                # ourselves.
+                self.log.warn(
+                    "Gave up waiting for another sync of patron %s's bookshelf.",
+                    patron.id
+                )
+
+        started = time.time()
+        try:
+            # Get the external view of the patron's current state.
+            remote_loans, remote_holds, complete = self.patron_activity(
+                patron, pin, collection_ids=collection_ids
+            )
+            with QueryCounter(self._db) as queries:
+                active_loans, active_holds = self._reconcile_bookshelf(
+                    patron, remote_loans, remote_holds, complete,
+                    collection_ids
+                )
+            self.log.info(
+                "Reconciled %d loans and %d holds for patron %s with %d queries",
+                len(active_loans), len(active_holds), patron.id,
+                queries.count
+            )
+            if leader:
+                # Anyone waiting on this sync will look at the
+                # database through their own session, so they
+                # can't be woken up until our changes are committed.
+                self._db.commit()
+            if complete:
+                cache.record_sync(patron, collection_ids, started)
+        finally:
+            if leader:
+                cache.finish_sync(patron)
+        return active_loans, active_holds
+
+    def _reconcile_bookshelf(self, patron, remote_loans, remote_holds,
+                             complete, collection_ids):
+        """Update the patron's local loans and holds to match
+        the remote loans and holds.
+
+        Loans and holds we already know about are handled with a
+        fixed number of queries, no matter how many of them the
+        patron has: one query each for the local loans and holds, one
+        query for all the LicensePools mentioned by the remotes, and a
+        single flush for all the resulting updates and deletes.
+
+        New loans and holds are created one at a time through
+        LicensePool.loan_to() and LicensePool.on_hold_to(), which
+        cope with another request creating the same loan or hold at
+        the same time.
+
+        :param complete: If this is False, we don't have a complete
+        view of the patron's remote loans and holds, so no local loans
+        or holds will be deleted.
+
+        :param collection_ids: The remote loans and holds represent
+        the patron's activity in these Collections. Local loans and
+        holds from other Collections are left alone.
+
+        :return: A 2-tuple (loans, holds).
+        """
         # Get our internal view of the patron's current state.
         __transaction = self._db.begin_nested()
-        local_loans = self.local_loans(patron)
-        local_holds = self.local_holds(patron)
+        eager = joinedload('license_pool').joinedload('identifier')
+        local_loans = self.local_loans(patron, collection_ids).options(eager)
+        local_holds = self.local_holds(patron, collection_ids).options(eager)
 
         now = datetime.datetime.utcnow()
-        local_loans_by_identifier = {}
-        local_holds_by_identifier = {}
-        for l in local_loans:
-            if not l.license_pool:
-                self.log.error("Active loan with no license pool!")
-                continue
-            i = l.license_pool.identifier
-            if not i:
-                self.log.error(
-                    "Active loan on license pool %s, which has no identifier!",
-                    l.license_pool
-                )
-                continue
-            key = (i.type, i.identifier)
-            local_loans_by_identifier[key] = l
-        for h in local_holds:
-            if not h.license_pool:
-                self.log.error("Active hold with no license pool!")
-                continue
-            i = h.license_pool.identifier
-            if not i:
-                self.log.error(
-                    "Active hold on license pool %r, which has no identifier!",
-                    h.license_pool
-                )
-                continue
-            key = (i.type, i.identifier)
-            local_holds_by_identifier[key] = h
+        local_loans_by_identifier = self._by_identifier(local_loans, "loan")
+        local_holds_by_identifier = self._by_identifier(local_holds, "hold")
+
+        # Look up every LicensePool mentioned by the remotes at once.
+        pools = self._license_pools_for(list(remote_loans) + list(remote_holds))
 
         active_loans = []
         active_holds = []
+        new_loans_by_identifier = {}
+        new_holds_by_identifier = {}
         for loan in remote_loans:
             # This is a remote loan. Find or create the corresponding
             # local loan.
-            pool = loan.license_pool(self._db)
             start = loan.start_date
             end = loan.end_date
             key = (loan.identifier_type, loan.identifier)
@@ -789,20 +1202,22 @@ class CirculationAPI(object):
                     local_loan.start = start
                 if end:
                     local_loan.end = end
-            else:
-                local_loan, new = pool.loan_to(patron, start, end)
-            active_loans.append(local_loan)
 
-            # Check the local loan off the list we're keeping so we
-            # don't delete it later.
-            key = (loan.identifier_type, loan.identifier)
-            if key in local_loans_by_identifier:
+                # Check the local loan off the list we're keeping so
+                # we don't delete it later.
                 del local_loans_by_identifier[key]
+            elif key in new_loans_by_identifier:
+                # The remote mentioned this loan twice.
+                continue
+            else:
+                pool = self._license_pool_for(loan, pools)
+                local_loan, is_new = pool.loan_to(patron, start, end)
+                new_loans_by_identifier[key] = local_loan
+            active_loans.append(local_loan)
 
         for hold in remote_holds:
             # This is a remote hold. Find or create the corresponding
             # local hold.
-            pool = hold.license_pool(self._db)
             start = hold.start_date
             end = hold.end_date
             position = hold.hold_position
@@ -815,14 +1230,20 @@ class CirculationAPI(object):
                 # But maybe the remote's opinions as to the hold's
                 # start or end date have changed.
                 local_hold.update(start, end, position)
-            else:
-                local_hold, new = pool.on_hold_to(patron, start, end, position)
-            active_holds.append(local_hold)
 
-            # Check the local hold off the list we're keeping so that
-            # we don't delete it later.
-            if key in local_holds_by_identifier:
+                # Check the local hold off the list we're keeping so
+                # that we don't delete it later.
                 del local_holds_by_identifier[key]
+            elif key in new_holds_by_identifier:
+                # The remote mentioned this hold twice.
+                continue
+            else:
+                pool = self._license_pool_for(hold, pools)
+                local_hold, is_new = pool.on_hold_to(
+                    patron, start, end, position
+                )
+                new_holds_by_identifier[key] = local_hold
+            active_holds.append(local_hold)
 
         # We only want to delete local loans and holds if we were able to
         # successfully sync with all the providers. If there was an error,
@@ -835,11 +1256,11 @@ class CirculationAPI(object):
             # borrowing a book and syncing their bookshelf at the same time,
             # and the local loan was created after we got the remote loans.
             # If the loan's start date is less than a minute ago, we'll keep it.
+            one_minute_ago = now - datetime.timedelta(minutes=1)
             for loan in local_loans_by_identifier.values():
-                if loan.license_pool.collection_id in self.collection_ids_for_sync:
-                    one_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+                if loan.license_pool.collection_id in collection_ids:
                     if loan.start < one_minute_ago:
-                        logging.info("In sync_bookshelf for patron %s, deleting loan %d (patron %s)" % (patron.authorization_identifier, loan.id, loan.patron.authorization_identifier))
+                        logging.info("In sync_bookshelf for patron %s, deleting loan %d (patron %s)" % (patron.authorization_identifier, loan.id, patron.authorization_identifier))
                         self._db.delete(loan)
                     else:
                         logging.info("In sync_bookshelf for patron %s, found local loan %d created in the past minute that wasn't in remote loans" % (patron.authorization_identifier, loan.id))
@@ -848,22 +1269,89 @@ class CirculationAPI(object):
             # the provider doesn't know about, which means it's expired
             # and we should get rid of it.
             for hold in local_holds_by_identifier.values():
-                if hold.license_pool.collection_id in self.collection_ids_for_sync:
+                if hold.license_pool.collection_id in collection_ids:
                     self._db.delete(hold)
 
+        # All of the updates and deletes go out in one flush.
         __transaction.commit()
         return active_loans, active_holds
 
+    def _by_identifier(self, records, name):
+        """Index a patron's local loans or holds by the type and
+        identifier of the book involved.
+        """
+        by_identifier = {}
+        for record in records:
+            if not record.license_pool:
+                self.log.error("Active %s with no license pool!", name)
+                continue
+            i = record.license_pool.identifier
+            if not i:
+                self.log.error(
+                    "Active %s on license pool %r, which has no identifier!",
+                    name, record.license_pool
+                )
+                continue
+            key = (i.type, i.identifier)
+            by_identifier[key] = record
+        return by_identifier
+
+    def _license_pools_for(self, infos):
+        """Find the LicensePools for a number of CirculationInfo objects
+        in a single query.
+
+        :return: A dictionary mapping (collection ID, identifier type,
+        identifier) to LicensePool.
+        """
+        if not infos:
+            return {}
+        identifiers_by_type = defaultdict(set)
+        collection_ids = set()
+        for info in infos:
+            identifiers_by_type[info.identifier_type].add(info.identifier)
+            collection_ids.add(info.collection_id)
+        clauses = [
+            and_(Identifier.type==type, Identifier.identifier.in_(identifiers))
+            for type, identifiers in identifiers_by_type.items()
+        ]
+        qu = self._db.query(LicensePool).join(LicensePool.identifier).filter(
+            LicensePool.collection_id.in_(collection_ids)
+        ).filter(
+            or_(*clauses)
+        ).options(
+            contains_eager(LicensePool.identifier)
+        )
+        pools = {}
+        for pool in qu:
+            i = pool.identifier
+            pools[(pool.collection_id, i.type, i.identifier)] = pool
+        return pools
+
+    def _license_pool_for(self, info, pools):
+        """Find the LicensePool for a CirculationInfo, using the output
+        of _license_pools_for if possible.
+
+        If the LicensePool doesn't exist yet, it's created.
+        """
+        key = (info.collection_id, info.identifier_type, info.identifier)
+        pool = pools.get(key)
+        if not pool:
+            pool = info.license_pool(self._db)
+            pools[key] = pool
+        return pool
+
 
 class BaseCirculationAPI(object):
     """Encapsulates logic common to all circulation APIs."""
 
     DEFAULT_LOAN_PERIOD = "default_loan_period"
     DEFAULT_RESERVATION_PERIOD = "default_reservation_period"
+    PATRON_ACTIVITY_TIMEOUT = "patron_activity_timeout"
 
     SETTINGS = [
         { "key": DEFAULT_LOAN_PERIOD, "label": _("Default Loan Period (in Days)"), "optional": True, "type": "number" },
         { "key": DEFAULT_RESERVATION_PERIOD, "label": _("Default Reservation Period (in Days)"), "optional": True, "type": "number" },
+        { "key": PATRON_ACTIVITY_TIMEOUT, "label": _("Maximum time to wait for a patron's loans and holds (in seconds)"), "optional": True, "type": "number" },
     ]
 
     BORROW_STEP = 'borrow'
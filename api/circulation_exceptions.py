@@ -34,6 +34,11 @@ class RemoteInitiatedServerError(InternalServerError):
         msg = _("Integration error communicating with %(service_name)s", service_name=self.service_name)
         return INTEGRATION_ERROR.detailed(msg)
 
+class PatronActivityPoolFull(InternalServerError):
+    """So many patron activity lookups are waiting for a worker thread
+    that no more are being accepted.
+    """
+
 class NoOpenAccessDownload(CirculationException):
     """We expected a book to have an open-access download, but it didn't."""
     status_code = 500
@@ -31,6 +31,15 @@ class Configuration(CoreConfiguration):
     # The name of the setting that controls how long static files are cached.
     STATIC_FILE_CACHE_TIME = u"static_file_cache_time"
 
+    # The name of the setting that controls how long (in seconds) the
+    # statistics shown on the admin dashboard may be reused before
+    # they're calculated again.
+    DASHBOARD_STATS_MAX_AGE = u"dashboard_stats_max_age"
+
+    # The name of the setting that controls how many threads are used
+    # to ask the remote circulation APIs about patron activity.
+    PATRON_ACTIVITY_POOL_SIZE = u"patron_activity_pool_size"
+
     # A short description of the library, used in its Authentication
     # for OPDS document.
     LIBRARY_DESCRIPTION = 'library_description'
@@ -43,6 +52,16 @@ class Configuration(CoreConfiguration):
     # address to use when notifying patrons of changes.
     DEFAULT_NOTIFICATION_EMAIL_ADDRESS = u"default_notification_email_address"
 
+    # The name of the per-library setting that controls how long
+    # (in seconds) a patron's bookshelf is considered up to date after
+    # it's been synced with the remote circulation APIs.
+    BOOKSHELF_SYNC_FRESHNESS = u"bookshelf_sync_freshness"
+
+    # The name of the per-library setting that controls how old (in
+    # seconds) an out-of-date cached feed may be and still be served
+    # while a fresh one is generated in the background.
+    STALE_FEED_MAX_AGE = u"stale_feed_max_age"
+
     # Name of the site-wide ConfigurationSetting containing the secret
     # used to sign bearer tokens.
     BEARER_TOKEN_SIGNING_SECRET = "bearer_token_signing_secret"
@@ -114,6 +133,19 @@ class Configuration(CoreConfiguration):
             "key": STATIC_FILE_CACHE_TIME,
             "label": _("Cache time for static JS and CSS files for the admin interface"),
         },
+        {
+            "key": DASHBOARD_STATS_MAX_AGE,
+            "label": _("Number of seconds to reuse the statistics shown on the admin dashboard"),
+            "type": "number",
+            "optional": True,
+        },
+        {
+            "key": PATRON_ACTIVITY_POOL_SIZE,
+            "label": _("Number of threads used to check patrons' loans and holds with the book vendors"),
+            "description": _("Takes effect when the circulation manager is restarted."),
+            "type": "number",
+            "optional": True,
+        },
     ]
 
     LIBRARY_SETTINGS = CoreConfiguration.LIBRARY_SETTINGS + [
@@ -151,6 +183,19 @@ class Configuration(CoreConfiguration):
             "key": DEFAULT_NOTIFICATION_EMAIL_ADDRESS,
             "label": _("Default email address to use when notifying patrons of changes"),
         },
+        {
+            "key": BOOKSHELF_SYNC_FRESHNESS,
+            "label": _("Number of seconds a patron's bookshelf stays up to date after syncing with the book vendors"),
+            "type": "number",
+            "optional": True,
+        },
+        {
+            "key": STALE_FEED_MAX_AGE,
+            "label": _("Maximum age in seconds of an out-of-date feed that may be served while a new one is generated"),
+            "description": _("If this is not set, out-of-date feeds are always regenerated before they are served."),
+            "type": "number",
+            "optional": True,
+        },
         {
             "key": TERMS_OF_SERVICE,
             "label": _("Terms of Service URL"),
@@ -121,7 +121,14 @@ from adobe_vendor_id import (
 from axis import Axis360API
 from overdrive import OverdriveAPI
 from bibliotheca import BibliothecaAPI
-from circulation import CirculationAPI
+from circulation import (
+    CirculationAPI,
+    PatronActivityPool,
+)
+from feed_cache import (
+    FeedCacheStats,
+    FeedRegenerator,
+)
 from novelist import (
     NoveListAPI,
     MockNoveListAPI,
@@ -129,6 +136,7 @@ from novelist import (
 from base_controller import BaseCirculationManagerController
 from testing import MockCirculationAPI
 from services import ServiceStatus
+from util.query_counter import QueryCounter
 from core.analytics import Analytics
 
 class CirculationManager(object):
@@ -146,6 +154,20 @@ class CirculationManager(object):
                 sys.exit()
 
         self.testing = testing
+
+        # Every CirculationAPI created by this CirculationManager
+        # shares one pool of threads for talking to the remote APIs
+        # about patron activity. It survives configuration reloads.
+        pool_size = ConfigurationSetting.sitewide(
+            self._db, Configuration.PATRON_ACTIVITY_POOL_SIZE
+        ).int_value
+        self.patron_activity_pool = PatronActivityPool(size=pool_size)
+
+        # Keep track of how cached feeds are used, and regenerate
+        # stale ones in the background.
+        self.feed_cache_stats = FeedCacheStats()
+        self.feed_regenerator = FeedRegenerator()
+
         self.site_configuration_last_update = (
             Configuration.site_configuration_last_update(self._db, timeout=0)
         )
@@ -182,7 +204,11 @@ class CirculationManager(object):
         new_top_level_lanes = {}
         # Create a CirculationAPI for each library.
         new_circulation_apis = {}
-        
+        # Keep the AuthdataUtility for each library around until the
+        # configuration changes, so it's not rebuilt for every Adobe
+        # ID request and every loans feed.
+        new_authdata_utilities = {}
+
         new_adobe_device_management = None
         for library in self._db.query(Library):
             lanes = make_lanes(self._db, library, self.lane_descriptions)
@@ -197,6 +223,7 @@ class CirculationManager(object):
                 library, self.analytics
             )
             authdata = self.setup_adobe_vendor_id(self._db, library)
+            new_authdata_utilities[library.id] = authdata
             if authdata and not new_adobe_device_management:
                 # There's at least one library on this system that
                 # wants Vendor IDs. This means we need to advertise support
@@ -205,6 +232,7 @@ class CirculationManager(object):
         self.adobe_device_management = new_adobe_device_management
         self.top_level_lanes = new_top_level_lanes
         self.circulation_apis = new_circulation_apis
+        self.authdata_utilities = new_authdata_utilities
         self.lending_policy = load_lending_policy(
             Configuration.policy('lending', {})
         )
@@ -284,7 +312,10 @@ class CirculationManager(object):
             cls = MockCirculationAPI
         else:
             cls = CirculationAPI
-        return cls(self._db, library, analytics)
+        return cls(
+            self._db, library, analytics,
+            patron_activity_pool=self.patron_activity_pool
+        )
         
     def setup_one_time_controllers(self):
         """Set up all the controllers that will be used by the web app.
@@ -344,7 +375,8 @@ class CirculationManager(object):
                     library,
                     vendor_id,
                     node_value,
-                    self.auth
+                    self.auth,
+                    authdata_utility=self.authdata_utility
                 )
             else:
                 self.log.warn("Adobe Vendor ID controller is disabled due to missing or incomplete configuration. This is probably nothing to worry about.")
@@ -371,15 +403,37 @@ class CirculationManager(object):
         self.short_client_token_initialization_exceptions = short_client_token_initialization_exceptions
         return authdata
 
+    def authdata_utility(self, library):
+        """Find the AuthdataUtility for `library`, as it was configured
+        when the site configuration was last loaded.
+
+        :return: An AuthdataUtility, or None if Short Client Tokens
+        aren't configured for `library`.
+        """
+        if library.id in self.authdata_utilities:
+            return self.authdata_utilities[library.id]
+
+        # This library was created after the configuration was loaded.
+        return AuthdataUtility.from_config(library, self._db)
+
     def annotator(self, lane, *args, **kwargs):
-        """Create an appropriate OPDS annotator for the given lane."""
-        if lane:
+        """Create an appropriate OPDS annotator for the given lane.
+
+        :param library: The Library the feed is for. By default, this
+        is the lane's library, or the current request's library if
+        there's no lane.
+        """
+        library = kwargs.pop('library', None)
+        if library:
+            pass
+        elif lane:
             library = lane.library
         else:
             library = flask.request.library
         return CirculationManagerAnnotator(
             self.circulation_apis[library.id], lane, library,
-            top_level_title='All Books', *args, **kwargs
+            top_level_title='All Books',
+            authdata=self.authdata_utility(library), *args, **kwargs
         )
 
     @property
@@ -414,10 +468,19 @@ class CirculationManagerController(BaseCirculationManagerController):
         """Return the appropriate CirculationAPI for the request Library."""
         library_id = flask.request.library.id
         return self.manager.circulation_apis[library_id]
+
+    @property
+    def authdata(self):
+        """Return the AuthdataUtility for the request Library."""
+        return self.manager.authdata_utility(flask.request.library)
     
-    def load_lane(self, language_key, name):
-        """Turn user input into a Lane object."""
-        library_id = flask.request.library.id
+    def load_lane(self, language_key, name, library=None):
+        """Turn user input into a Lane object.
+
+        :param library: Look for the lane in this Library. By default,
+        the current request's library is used.
+        """
+        library_id = (library or flask.request.library).id
         top_level_lane = self.manager.top_level_lanes[library_id]
 
         if language_key is None and name is None:
@@ -603,11 +666,17 @@ class OPDSFeedController(CirculationManagerController):
             "acquisition_groups", languages=languages, lane_name=lane_name, library_short_name=library_short_name,
         )
 
-        title = lane.display_name
-
         annotator = self.manager.annotator(lane)
-        feed = AcquisitionFeed.groups(self._db, title, url, lane, annotator)
-        return feed_response(feed.content)
+        def generate(_db, lane, annotator, force_refresh=False):
+            return AcquisitionFeed.groups(
+                _db, lane.display_name, url, lane, annotator,
+                force_refresh=force_refresh
+            )
+        content = self.cached_feed_content(
+            lane, languages, lane_name, CachedFeed.GROUPS_TYPE, None, None,
+            annotator, generate
+        )
+        return feed_response(content)
 
     def feed(self, languages, lane_name):
         """Build or retrieve a paginated acquisition feed."""
@@ -621,8 +690,6 @@ class OPDSFeedController(CirculationManagerController):
             library_short_name=library_short_name,
         )
 
-        title = lane.display_name
-
         annotator = self.manager.annotator(lane)
         facets = load_facets_from_request()
         if isinstance(facets, ProblemDetail):
@@ -630,12 +697,95 @@ class OPDSFeedController(CirculationManagerController):
         pagination = load_pagination_from_request()
         if isinstance(pagination, ProblemDetail):
             return pagination
-        feed = AcquisitionFeed.page(
-            self._db, title, url, lane, annotator=annotator,
-            facets=facets,
-            pagination=pagination,
+        def generate(_db, lane, annotator, force_refresh=False):
+            return AcquisitionFeed.page(
+                _db, lane.display_name, url, lane, annotator=annotator,
+                facets=facets,
+                pagination=pagination,
+                force_refresh=force_refresh
+            )
+        content = self.cached_feed_content(
+            lane, languages, lane_name, CachedFeed.PAGE_TYPE, facets,
+            pagination, annotator, generate
         )
-        return feed_response(feed.content)
+        return feed_response(content)
+
+    def cached_feed_content(self, lane, languages, lane_name, cache_type,
+                            facets, pagination, annotator, generate):
+        """Find the content of a feed, preferably in the cache.
+
+        If the library allows it, an out-of-date CachedFeed is served
+        as-is and regenerated in the background, rather than making
+        the client wait while it's regenerated.
+
+        :param languages: The language key `lane` was loaded with.
+        :param lane_name: The name `lane` was loaded with. Together
+        with `languages`, this lets the lane be found again when the
+        feed is regenerated in the background.
+        :param generate: A callable that builds the feed (or finds it
+        in the cache). It's called with a database session, a lane and
+        an annotator, and must accept a `force_refresh` argument.
+        :return: The content of the feed.
+        """
+        library = flask.request.library
+        stale_feed_max_age = ConfigurationSetting.for_library(
+            Configuration.STALE_FEED_MAX_AGE, library
+        ).int_value
+        if not stale_feed_max_age:
+            return self.generate_feed(
+                self._db, lane, annotator, generate
+            ).content
+
+        stats = self.manager.feed_cache_stats
+        cached, usable = CachedFeed.fetch(
+            self._db, lane=lane, type=cache_type, facets=facets,
+            pagination=pagination, annotator=annotator
+        )
+        if usable:
+            stats.record(library, lane, stats.HIT)
+            return cached.content
+
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=stale_feed_max_age
+        )
+        regenerator = self.manager.feed_regenerator
+        if (cached and cached.content and cached.timestamp
+            and cached.timestamp > cutoff
+            and not regenerator.failing(cached.id)):
+            stats.record(library, lane, stats.STALE)
+
+            # The feed is regenerated with a database session of its
+            # own, so nothing loaded through this request's session
+            # can be passed along--only IDs and the names the lane
+            # was found with.
+            library_id = library.id
+            @flask.copy_current_request_context
+            def regenerate(_db):
+                library = get_one(_db, Library, id=library_id)
+                lane = self.load_lane(languages, lane_name, library)
+                if isinstance(lane, ProblemDetail):
+                    # The lane configuration changed in the meantime.
+                    return
+                annotator = self.manager.annotator(lane, library=library)
+                self.generate_feed(
+                    _db, lane, annotator, generate, force_refresh=True
+                )
+            regenerator.schedule(self._db, cached.id, regenerate)
+            return cached.content
+
+        stats.record(library, lane, stats.MISS)
+        return self.generate_feed(
+            self._db, lane, annotator, generate
+        ).content
+
+    def generate_feed(self, _db, lane, annotator, generate, **kwargs):
+        """Call `generate` and log how many database queries it took."""
+        with QueryCounter(_db) as queries:
+            feed = generate(_db, lane, annotator, **kwargs)
+        self.manager.log.info(
+            "Feed for %s took %d queries.", lane.display_name, queries.count
+        )
+        return feed
 
     def search(self, languages, lane_name):
 
@@ -704,7 +854,9 @@ class LoanController(CirculationManagerController):
             header = self.authorization_header()
             credential = self.manager.auth.get_credential_from_header(header)
             try:
-                self.circulation.sync_bookshelf(patron, credential)
+                self.circulation.sync_bookshelf(
+                    patron, credential, use_cache=True
+                )
             except Exception, e:
                 # If anything goes wrong, omit the sync step and just
                 # display the current active loans, as we understand them.
@@ -714,7 +866,7 @@ class LoanController(CirculationManagerController):
 
         # Then make the feed.
         feed = CirculationManagerLoanAndHoldAnnotator.active_loans_for(
-            self.circulation, patron)
+            self.circulation, patron, authdata=self.authdata)
         return feed_response(feed, cache_for=None)
 
     def borrow(self, identifier_type, identifier, mechanism_id=None):
@@ -790,10 +942,10 @@ class LoanController(CirculationManagerController):
         # serve a feed that talks about the hold.
         if loan:
             feed = CirculationManagerLoanAndHoldAnnotator.single_loan_feed(
-                self.circulation, loan)
+                self.circulation, loan, authdata=self.authdata)
         elif hold:
             feed = CirculationManagerLoanAndHoldAnnotator.single_hold_feed(
-                self.circulation, hold)
+                self.circulation, hold, authdata=self.authdata)
         else:
             # This should never happen -- we should have sent a more specific
             # error earlier.
@@ -945,7 +1097,7 @@ class LoanController(CirculationManagerController):
             # If this is a streaming delivery mechanism, create an OPDS entry
             # with a fulfillment link to the streaming reader url.
             feed = CirculationManagerLoanAndHoldAnnotator.single_fulfillment_feed(
-                self.circulation, loan, fulfillment)
+                self.circulation, loan, fulfillment, authdata=self.authdata)
             if isinstance(feed, OPDSFeed):
                 content = unicode(feed)
             else:
@@ -1045,10 +1197,10 @@ class LoanController(CirculationManagerController):
         if flask.request.method=='GET':
             if loan:
                 feed = CirculationManagerLoanAndHoldAnnotator.single_loan_feed(
-                    self.circulation, loan)
+                    self.circulation, loan, authdata=self.authdata)
             else:
                 feed = CirculationManagerLoanAndHoldAnnotator.single_hold_feed(
-                    self.circulation, hold)
+                    self.circulation, hold, authdata=self.authdata)
             feed = unicode(feed)
             return feed_response(feed, None)
 
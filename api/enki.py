@@ -1,5 +1,9 @@
 from nose.tools import set_trace
-from collections import defaultdict
+from collections import (
+    defaultdict,
+    deque,
+)
+import itertools
 import time
 import datetime
 import base64
@@ -7,6 +11,7 @@ import os
 import json
 import logging
 import re
+from multiprocessing.pool import ThreadPool
 from flask.ext.babel import lazy_gettext as _
 
 from sqlalchemy.orm import contains_eager
@@ -223,32 +228,42 @@ class EnkiAPI(BaseCirculationAPI):
         except:
             # Get this collection's license pool for this identifier.
             pool = identifier.licensed_through_collection(self.collection)
-            if pool and (pool.licenses_owned > 0):
-                if pool.presentation_edition:
-                    self.log.warn("Removing %s (%s) from circulation",
-                                  pool.presentation_edition.title, pool.presentation_edition.author)
-                else:
-                    self.log.warn(
-                        "Removing unknown work %s from circulation.",
-                        identifier.identifier
-                    )
+            return self.remove_from_circulation(identifier, pool, now)
 
-            circulationdata = CirculationData(
-                data_source=DataSource.ENKI,
-                primary_identifier= IdentifierData(EnkiAPI.ENKI_ID, identifier.identifier),
-                licenses_owned = 0,
-                licenses_available = 0,
-                patrons_in_hold_queue = 0,
-                last_checked = now
-            )
+    def remove_from_circulation(self, identifier, pool, now, replace=None):
+        """Record that this collection no longer has any licenses for a book.
 
-            circulationdata.apply(
-                self._db,
-                self.collection,
-                replace=ReplacementPolicy.from_license_source(self._db)
-            )
+        :param pool: The book's LicensePool in this collection, if any.
+        :param replace: A ReplacementPolicy to use when applying the
+        change. Passing one in saves looking it up for every book.
+        :return: A CirculationData.
+        """
+        if pool and (pool.licenses_owned > 0):
+            if pool.presentation_edition:
+                self.log.warn("Removing %s (%s) from circulation",
+                              pool.presentation_edition.title, pool.presentation_edition.author)
+            else:
+                self.log.warn(
+                    "Removing unknown work %s from circulation.",
+                    identifier.identifier
+                )
 
-            return circulationdata
+        circulationdata = CirculationData(
+            data_source=DataSource.ENKI,
+            primary_identifier= IdentifierData(EnkiAPI.ENKI_ID, identifier.identifier),
+            licenses_owned = 0,
+            licenses_available = 0,
+            patrons_in_hold_queue = 0,
+            last_checked = now
+        )
+
+        circulationdata.apply(
+            self._db,
+            self.collection,
+            replace=replace or ReplacementPolicy.from_license_source(self._db)
+        )
+
+        return circulationdata
 
     def epoch_to_struct(self, epoch_string):
         # This will turn the time string we get from Enki into a
@@ -608,13 +623,39 @@ class EnkiImport(CollectionMonitor):
     PROTOCOL = EnkiAPI.ENKI_EXTERNAL
     DEFAULT_BATCH_SIZE = 100 
     FIVE_MINUTES = datetime.timedelta(minutes=5)
-    
-    def __init__(self, _db, collection, api_class=EnkiAPI):
-        """Constructor."""
+
+    # Keep this many pages of titles in flight while the current page
+    # is applied to the database.
+    DEFAULT_PREFETCH_PAGES = 4
+
+    # Ask for a page this many times before giving up on the import.
+    MAX_PAGE_ATTEMPTS = 4
+
+    # Wait this long before asking for a page again. The wait doubles
+    # with every failed attempt.
+    BACKOFF_SECONDS = 2
+
+    def __init__(self, _db, collection, api_class=EnkiAPI, page_size=None,
+                 prefetch_pages=None):
+        """Constructor.
+
+        :param page_size: Ask Enki for this many titles at a time.
+        :param prefetch_pages: Keep this many requests for upcoming
+        pages in flight at once.
+        """
         super(EnkiImport, self).__init__(_db, collection)
         self._db = _db
-        self.api = api_class(_db, collection)
+        if isinstance(api_class, EnkiAPI):
+            # Use a preexisting EnkiAPI instance rather than
+            # creating a new one.
+            self.api = api_class
+        else:
+            self.api = api_class(_db, collection)
         self.collection_id = collection.id
+        self.page_size = page_size or self.DEFAULT_BATCH_SIZE
+        self.prefetch_pages = max(
+            1, prefetch_pages or self.DEFAULT_PREFETCH_PAGES
+        )
         self.analytics = Analytics(_db)
         self.bibliographic_coverage_provider = (
             EnkiBibliographicCoverageProvider(collection, api_class=self.api)
@@ -631,23 +672,79 @@ class EnkiImport(CollectionMonitor):
         # Give us five minutes of overlap because it's very important
         # we don't miss anything.
         since = start-self.FIVE_MINUTES
-        id_start = 0
-        while True:
-            availability = self.api.availability(since=since, strt=id_start, qty=self.DEFAULT_BATCH_SIZE)
-            if availability.status_code != 200:
-                self.log.error(
-                    "Could not contact Enki server for content availability. Status: %d",
-                    availability.status_code
-                )
-            content = availability.content
-            count = 0
-            for bibliographic, circulation in BibliographicParser().process_all(content):
+        for books in self.pages(since):
+            for bibliographic, circulation in books:
                 self.process_book(bibliographic, circulation)
-                count += 1
-            if count == 0:
-                break
             self._db.commit()
-            id_start += self.DEFAULT_BATCH_SIZE
+
+    def pages(self, since):
+        """Page through the titles in the Enki collection.
+
+        Upcoming pages are fetched and parsed in the background while
+        the current page is being applied to the database.
+
+        :yield: A list of (Metadata, CirculationData) 2-tuples for each
+        page, in order, until Enki runs out of titles.
+        """
+        pool = ThreadPool(self.prefetch_pages)
+        try:
+            starts = itertools.count(0, self.page_size)
+            pending = deque()
+            def fetch():
+                pending.append(
+                    pool.apply_async(self.fetch_page, (since, next(starts)))
+                )
+            for i in range(self.prefetch_pages):
+                fetch()
+            while True:
+                books = pending.popleft().get()
+                if not books:
+                    break
+                fetch()
+                yield books
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def fetch_page(self, since, strt):
+        """Get and parse one page of titles, trying again (with an
+        increasing delay) if Enki can't provide it.
+
+        This runs outside the main thread, so it must not touch the
+        database.
+
+        :return: A list of (Metadata, CirculationData) 2-tuples. An
+        empty list means there are no more titles.
+        :raise: RemoteIntegrationException if the page couldn't be
+        retrieved after MAX_PAGE_ATTEMPTS tries.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.api.availability(
+                    since=since, strt=strt, qty=self.page_size
+                )
+                if response.status_code == 200:
+                    return list(
+                        BibliographicParser().process_all(response.content)
+                    )
+                error = "status code %d" % response.status_code
+            except RemoteIntegrationException, e:
+                error = e.message
+            if attempt >= self.MAX_PAGE_ATTEMPTS:
+                raise RemoteIntegrationException(
+                    self.api.base_url,
+                    "Could not get titles starting at %d after %d attempts: %s" % (
+                        strt, attempt, error
+                    )
+                )
+            delay = self.BACKOFF_SECONDS * (2 ** (attempt-1))
+            self.log.warn(
+                "Could not get titles starting at %d (%s). Trying again in %d sec.",
+                strt, error, delay
+            )
+            time.sleep(delay)
 
     def process_book(self, bibliographic, availability):
         license_pool, new_license_pool = availability.license_pool(self._db, self.collection)
@@ -682,17 +779,116 @@ class EnkiImport(CollectionMonitor):
 
         return edition, license_pool
 
-class EnkiCollectionReaper(IdentifierSweepMonitor):
-    """Check for books that are in the local collection but have left the Enki collection."""
+class EnkiCollectionReaper(CollectionMonitor):
+    """Check for books that are in the local collection but have left the Enki collection.
+
+    Rather than asking Enki about one book at a time, this pages
+    through Enki's list of every title in the collection, and removes
+    any book that's not on the list.
+    """
 
     SERVICE_NAME = "Enki Collection Reaper"
     INTERVAL_SECONDS = 3600*4
     PROTOCOL = "Enki"
 
+    # Ask Enki for this many titles at a time.
+    DEFAULT_BATCH_SIZE = 2000
+
+    # Commit after removing this many books.
+    REMOVAL_BATCH_SIZE = 100
+
     def __init__(self, _db, collection, api_class=EnkiAPI):
         self._db = _db
         super(EnkiCollectionReaper, self).__init__(self._db, collection)
-        self.api = api_class(self._db, collection)
+        self.collection_id = collection.id
+        if isinstance(api_class, EnkiAPI):
+            # Use a preexisting EnkiAPI instance rather than
+            # creating a new one.
+            self.api = api_class
+        else:
+            self.api = api_class(self._db, collection)
 
-    def process_item(self, identifier):
-        self.api.reaper_request(identifier)
+    @property
+    def collection(self):
+        return Collection.by_id(self._db, id=self.collection_id)
+
+    def run_once(self, start, cutoff):
+        a = time.time()
+        enki_ids = self.enki_ids()
+        if enki_ids is None:
+            # We don't know the whole collection, so we can't tell
+            # which books have left it.
+            return
+        checked, removed = self.reap(enki_ids)
+        b = time.time()
+        self.log.info(
+            "Checked %d titles in %.2fsec (%.1f titles/sec). Removed %d.",
+            checked, (b-a), checked / max(b-a, 0.001), removed
+        )
+
+    def enki_ids(self):
+        """Find the ID of every title Enki says is in the collection.
+
+        :return: A set of Enki IDs, or None if the complete list
+        couldn't be retrieved.
+        """
+        enki_ids = set()
+        id_start = 0
+        while True:
+            try:
+                response = self.api.availability(
+                    strt=id_start, qty=self.DEFAULT_BATCH_SIZE
+                )
+            except RemoteIntegrationException, e:
+                self.log.error(
+                    "Could not get the Enki collection listing: %s", e
+                )
+                return None
+            if response.status_code != 200:
+                self.log.error(
+                    "Could not contact Enki server for content availability. Status: %d",
+                    response.status_code
+                )
+                return None
+            titles = json.loads(response.content)["result"]["titles"]
+            if not titles:
+                break
+            for title in titles:
+                enki_ids.add(title["id"])
+            id_start += self.DEFAULT_BATCH_SIZE
+        if not enki_ids:
+            # An empty collection is much more likely to be a problem
+            # on Enki's end than a real change, so don't act on it.
+            self.log.error("Enki says the collection is empty; not reaping.")
+            return None
+        return enki_ids
+
+    def reap(self, enki_ids):
+        """Remove every book in the collection that's not in `enki_ids`.
+
+        :return: A 2-tuple (number of books checked, number removed).
+        """
+        now = datetime.datetime.utcnow()
+        replace = ReplacementPolicy.from_license_source(self._db)
+        qu = self._db.query(LicensePool).join(
+            LicensePool.identifier
+        ).filter(
+            LicensePool.collection_id==self.collection_id
+        ).filter(
+            LicensePool.licenses_owned > 0
+        ).options(
+            contains_eager(LicensePool.identifier)
+        )
+        pools = qu.all()
+        removed = 0
+        for pool in pools:
+            if pool.identifier.identifier in enki_ids:
+                continue
+            self.api.remove_from_circulation(
+                pool.identifier, pool, now, replace=replace
+            )
+            removed += 1
+            if not removed % self.REMOVAL_BATCH_SIZE:
+                self._db.commit()
+        self._db.commit()
+        return len(pools), removed
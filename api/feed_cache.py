@@ -0,0 +1,228 @@
+from nose.tools import set_trace
+from collections import (
+    Counter,
+    defaultdict,
+)
+import logging
+import Queue
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+def lane_path(lane):
+    """The names of a lane and each of its parents, starting at the
+    top.
+
+    Lanes aren't database objects, and display names repeat (adult
+    and YA "Fantasy", for instance), so this is what identifies a
+    lane.
+    """
+    names = []
+    while lane is not None:
+        names.insert(0, lane.name)
+        lane = lane.parent
+    return names
+
+
+class FeedCacheStats(object):
+    """Keep track of how often each lane's cached feeds were used, and
+    log it as it changes.
+    """
+
+    # The cached feed was fresh and was served as-is.
+    HIT = "hit"
+
+    # There was no usable cached feed, so one was generated while the
+    # client waited.
+    MISS = "miss"
+
+    # The cached feed was out of date but was served anyway, while a
+    # fresh one was generated in the background.
+    STALE = "stale"
+
+    def __init__(self):
+        self.log = logging.getLogger("Feed cache")
+        self.counts = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def key(cls, library, lane):
+        return (library.short_name, tuple(lane_path(lane)), lane.language_key)
+
+    def record(self, library, lane, outcome):
+        key = self.key(library, lane)
+        with self.lock:
+            counts = self.counts[key]
+            counts[outcome] += 1
+            hits, stale, misses = [
+                counts[x] for x in (self.HIT, self.STALE, self.MISS)
+            ]
+        total = hits + stale + misses
+        self.log.info(
+            "Feed cache for %s/%s (%s): %d hits, %d stale, %d misses; %.1f%% served from cache.",
+            library.short_name, "/".join(key[1]), lane.language_key,
+            hits, stale, misses, 100.0 * (hits + stale) / total
+        )
+
+    def for_lane(self, library, lane):
+        """How often were this lane's cached feeds hits, misses, or
+        stale?
+
+        :return: A dictionary mapping each outcome to a count.
+        """
+        counts = self.counts.get(self.key(library, lane), Counter())
+        return dict((outcome, counts[outcome])
+                    for outcome in (self.HIT, self.MISS, self.STALE))
+
+
+class FeedRegenerator(object):
+    """Regenerate stale cached feeds in the background.
+
+    Any given CachedFeed is only regenerated by one thread at a time,
+    across every process that shares the database. Within this process
+    that's enforced by keeping track of the feeds being regenerated;
+    across processes, by a Postgres advisory lock on the CachedFeed's
+    ID.
+
+    The work is done by a fixed number of threads, and only a limited
+    number of feeds may wait for one. A feed that can't be scheduled
+    is simply served stale for a while longer.
+    """
+
+    # The first half of every advisory lock key taken by this class,
+    # so they don't collide with locks taken for other purposes.
+    LOCK_NAMESPACE = 8008
+
+    DEFAULT_WORKERS = 2
+    DEFAULT_QUEUE_SIZE = 100
+
+    # Once a feed has failed to regenerate this many times in a row,
+    # stop regenerating it in the background. It'll be regenerated
+    # while a client waits, so the problem is seen by someone.
+    MAX_FAILURES = 3
+
+    def __init__(self, workers=None, queue_size=None):
+        self.log = logging.getLogger("Feed regenerator")
+        self.in_progress = set()
+        self.failures = Counter()
+        self.lock = threading.Lock()
+        self.tasks = Queue.Queue(queue_size or self.DEFAULT_QUEUE_SIZE)
+        self.workers = []
+        for i in range(workers or self.DEFAULT_WORKERS):
+            worker = threading.Thread(
+                target=self._work, name="FeedRegenerator-%d" % i
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def failing(self, cached_feed_id):
+        """Has this CachedFeed failed to regenerate too many times
+        in a row to keep trying in the background?
+        """
+        with self.lock:
+            return self.failures[cached_feed_id] >= self.MAX_FAILURES
+
+    def schedule(self, _db, cached_feed_id, regenerate):
+        """Make sure a CachedFeed is regenerated soon.
+
+        :param _db: A database session. It's only used to find the
+        database; the feed is regenerated with a session of its own.
+        :param cached_feed_id: The ID of the CachedFeed to regenerate.
+        :param regenerate: A callable that regenerates the feed. It's
+        called with a new database session, which is committed
+        afterwards. It must not use any database object loaded through
+        any other session.
+
+        :return: True if the feed will be regenerated; False if it's
+        already being regenerated, or there's no room in the queue.
+        """
+        with self.lock:
+            if cached_feed_id in self.in_progress:
+                return False
+            self.in_progress.add(cached_feed_id)
+        try:
+            self.start(self.run, _db.get_bind(), cached_feed_id, regenerate)
+        except Queue.Full:
+            self.log.warn(
+                "Too many feeds waiting to be regenerated; not regenerating CachedFeed %s.",
+                cached_feed_id
+            )
+            self.finished(cached_feed_id)
+            return False
+        except Exception:
+            self.finished(cached_feed_id)
+            raise
+        return True
+
+    def start(self, target, *args):
+        """Have a worker thread call `target` as soon as one is free.
+
+        :raise Queue.Full: If too many calls are already waiting.
+        """
+        self.tasks.put_nowait((target, args))
+
+    def _work(self):
+        while True:
+            target, args = self.tasks.get()
+            try:
+                target(*args)
+            except Exception, e:
+                self.log.error("Uncaught exception: %r", e, exc_info=e)
+            finally:
+                self.tasks.task_done()
+
+    def run(self, bind, cached_feed_id, regenerate):
+        """Regenerate a CachedFeed, unless some other process is already
+        doing so.
+        """
+        connection = None
+        _db = None
+        try:
+            connection = bind.connect()
+            locked = connection.execute(
+                text("select pg_try_advisory_lock(:namespace, :id)"),
+                namespace=self.LOCK_NAMESPACE, id=cached_feed_id
+            ).scalar()
+            if not locked:
+                self.log.info(
+                    "CachedFeed %s is being regenerated elsewhere.",
+                    cached_feed_id
+                )
+                return
+            # The advisory lock belongs to the connection, not to a
+            # transaction, so committing doesn't release it.
+            _db = Session(bind=connection)
+            try:
+                regenerate(_db)
+                _db.commit()
+            except Exception:
+                _db.rollback()
+                raise
+            finally:
+                connection.execute(
+                    text("select pg_advisory_unlock(:namespace, :id)"),
+                    namespace=self.LOCK_NAMESPACE, id=cached_feed_id
+                )
+            with self.lock:
+                self.failures.pop(cached_feed_id, None)
+        except Exception, e:
+            with self.lock:
+                self.failures[cached_feed_id] += 1
+                failures = self.failures[cached_feed_id]
+            self.log.error(
+                "Could not regenerate CachedFeed %s (%d failures in a row): %r",
+                cached_feed_id, failures, e, exc_info=e
+            )
+        finally:
+            if _db is not None:
+                _db.close()
+            if connection is not None:
+                connection.close()
+            self.finished(cached_feed_id)
+
+    def finished(self, cached_feed_id):
+        with self.lock:
+            self.in_progress.discard(cached_feed_id)
@@ -1,4 +1,8 @@
 from config import CannotLoadConfiguration
+import atexit
+import logging
+import Queue
+import threading
 import uuid
 import unicodedata
 import urllib
@@ -12,6 +16,139 @@ from core.model import (
     get_one,
 )
 
+class EventDispatcher(object):
+    """Send Measurement Protocol hits to Google Analytics from a
+    background thread, several hits to a request.
+
+    Hits wait in a queue of bounded size. If Google can't keep up and
+    the queue fills, new hits are dropped rather than slowing down the
+    requests that generate them. Anything still in the queue when the
+    process exits is sent before it goes.
+    """
+
+    # Google accepts at most this many hits in one batch request...
+    MAX_BATCH_SIZE = 20
+
+    # ...and at most this many bytes.
+    MAX_BATCH_BYTES = 16 * 1024
+
+    # Keep at most this many hits waiting to be sent.
+    MAX_QUEUE_SIZE = 10000
+
+    # Hits sent to this endpoint can instead be sent in batches to the
+    # batch endpoint.
+    COLLECT_ENDPOINT = "/collect"
+    BATCH_ENDPOINT = "/batch"
+
+    def __init__(self, max_queue_size=None):
+        self.log = logging.getLogger("Google Analytics event dispatcher")
+        self.queue = Queue.Queue(max_queue_size or self.MAX_QUEUE_SIZE)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def add(self, url, params):
+        """Arrange for a hit to be sent to `url` soon.
+
+        :param params: The hit's urlencoded Measurement Protocol
+        parameters.
+        """
+        self.start()
+        try:
+            self.queue.put_nowait((url, params))
+        except Queue.Full:
+            self.dropped += 1
+            self.log.warn(
+                "Event queue is full; dropped %d events so far.",
+                self.dropped
+            )
+
+    def start(self):
+        """Make sure the thread that sends hits is running."""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.send(self.next_batch(block=True))
+
+    def flush(self):
+        """Send every hit that's waiting to be sent."""
+        while True:
+            batch = self.next_batch(block=False)
+            if not batch:
+                break
+            self.send(batch)
+
+    def next_batch(self, block):
+        """Take the next batch of hits off the queue.
+
+        :param block: Wait for a hit if there are none in the queue.
+        :return: A list of (url, params) 2-tuples, possibly empty.
+        """
+        batch = []
+        try:
+            batch.append(self.queue.get(block))
+            while len(batch) < self.MAX_BATCH_SIZE:
+                batch.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def send(self, batch):
+        """Send a batch of hits, as few requests as possible."""
+        by_url = {}
+        for url, params in batch:
+            by_url.setdefault(url, []).append(params)
+        for url, hits in by_url.items():
+            batch_url = self.batch_url(url)
+            if batch_url:
+                for body in self.batch_bodies(hits):
+                    self.post(batch_url, body)
+            else:
+                for params in hits:
+                    self.post(url, params)
+
+    @classmethod
+    def batch_url(cls, url):
+        """Find the batch endpoint that corresponds to `url`.
+
+        :return: A URL, or None if hits for `url` can't be batched.
+        """
+        if url.endswith(cls.COLLECT_ENDPOINT):
+            return url[:-len(cls.COLLECT_ENDPOINT)] + cls.BATCH_ENDPOINT
+        return None
+
+    def batch_bodies(self, hits):
+        """Divide hits into request bodies for the batch endpoint, one
+        hit per line.
+        """
+        lines = []
+        size = 0
+        for params in hits:
+            if lines and size + len(params) + 1 > self.MAX_BATCH_BYTES:
+                yield "\n".join(lines)
+                lines = []
+                size = 0
+            lines.append(params)
+            size += len(params) + 1
+        if lines:
+            yield "\n".join(lines)
+
+    def post(self, url, body):
+        try:
+            HTTP.post_with_timeout(url, body)
+        except Exception, e:
+            self.log.error(
+                "Could not send events to %s: %r", url, e, exc_info=e
+            )
+
+
 class GoogleAnalyticsProvider(object):
     NAME = _("Google Analytics")
 
@@ -45,6 +182,10 @@ class GoogleAnalyticsProvider(object):
     LIBRARY_SETTINGS = [
         { "key": TRACKING_ID, "label": _("Tracking ID") },
     ]
+
+    # Hits are sent in the background by a dispatcher shared by every
+    # GoogleAnalyticsProvider in the process.
+    dispatcher = EventDispatcher()
     
     def __init__(self, integration, library=None):
         _db = Session.object_session(integration)
@@ -100,7 +241,7 @@ class GoogleAnalyticsProvider(object):
         self.post(self.url, params)
 
     def post(self, url, params):
-        response = HTTP.post_with_timeout(url, params)
+        self.dispatcher.add(url, params)
 
         
 Provider = GoogleAnalyticsProvider
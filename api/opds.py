@@ -44,6 +44,7 @@ from annotations import AnnotationWriter
 from circulation import BaseCirculationAPI
 from config import Configuration
 from novelist import NoveListAPI
+from url_templates import URLTemplateCache
 
 class CirculationManagerAnnotator(Annotator):
 
@@ -67,13 +68,22 @@ class CirculationManagerAnnotator(Annotator):
         Configuration.HELP_WEB,
         Configuration.HELP_URI,
     ]
-    
+
+    # Distinguishes configuration that hasn't been looked up from
+    # configuration that's been looked up and found to be missing.
+    NOT_LOADED = object()
+
+    # URLs for OPDS entries are made from templates shared by every
+    # annotator in the process.
+    url_templates = URLTemplateCache()
+
     def __init__(self, circulation, lane, library, patron=None,
                  active_loans_by_work={}, active_holds_by_work={},
                  active_fulfillments_by_work={},
                  facet_view='feed',
                  test_mode=False,
-                 top_level_title="All Books"
+                 top_level_title="All Books",
+                 authdata=NOT_LOADED
     ):
         if lane:
             logger_name = "Circulation Manager Annotator for %s" % lane.name
@@ -93,9 +103,56 @@ class CirculationManagerAnnotator(Annotator):
         self._adobe_id_tags = {}
         self._top_level_title = top_level_title
 
+        # Library configuration that's needed for every <entry>. It's
+        # looked up the first time it's needed, and then reused for
+        # the rest of the feed.
+        self._novelist_configured = self.NOT_LOADED
+        self._allow_holds = self.NOT_LOADED
+
+        # The CirculationManager keeps an AuthdataUtility for each
+        # library, and passes it in.
+        self._authdata = authdata
+        self._api_for_collection = {}
+
     def top_level_title(self):
         return self._top_level_title
 
+    @property
+    def novelist_configured(self):
+        if self._novelist_configured is self.NOT_LOADED:
+            self._novelist_configured = NoveListAPI.is_configured(
+                self.library
+            )
+        return self._novelist_configured
+
+    @property
+    def allow_holds(self):
+        if self._allow_holds is self.NOT_LOADED:
+            self._allow_holds = self.library.allow_holds
+        return self._allow_holds
+
+    @property
+    def authdata(self):
+        """The library's AuthdataUtility, or None if Adobe Vendor ID
+        delegation isn't configured.
+        """
+        if self._authdata is self.NOT_LOADED:
+            self._authdata = AuthdataUtility.from_config(self.library)
+        return self._authdata
+
+    def api_for_license_pool(self, license_pool):
+        """Find the circulation API for a LicensePool, without loading
+        the LicensePool's Collection.
+        """
+        if not self.circulation:
+            return None
+        collection_id = license_pool.collection_id
+        if collection_id not in self._api_for_collection:
+            self._api_for_collection[collection_id] = (
+                self.circulation.api_for_license_pool(license_pool)
+            )
+        return self._api_for_collection[collection_id]
+
     def url_for(self, *args, **kwargs):
         if self.test_mode:
             new_kwargs = {}
@@ -104,7 +161,7 @@ class CirculationManagerAnnotator(Annotator):
                     new_kwargs[k] = v
             return self.test_url_for(False, *args, **new_kwargs)
         else:
-            return url_for(*args, **kwargs)
+            return self.url_templates.url_for(*args, **kwargs)
 
     def cdn_url_for(self, *args, **kwargs):
         if self.test_mode:
@@ -301,7 +358,7 @@ class CirculationManagerAnnotator(Annotator):
         if work.series:
             self.add_series_link(work, feed, entry)
 
-        if NoveListAPI.is_configured(self.library):
+        if self.novelist_configured:
             # If NoveList Select is configured, there might be
             # recommendations, too.
             feed.add_link_to_entry(
@@ -319,7 +376,9 @@ class CirculationManagerAnnotator(Annotator):
             )
 
         # Add a link for related books if available.
-        if self.related_books_available(work, self.library):
+        if self.related_books_available(
+                work, self.library, self.novelist_configured
+        ):
             feed.add_link_to_entry(
                 entry,
                 rel='related',
@@ -349,10 +408,19 @@ class CirculationManagerAnnotator(Annotator):
         )
 
     @classmethod
-    def related_books_available(cls, work, library):
+    def related_books_available(cls, work, library, novelist_configured=None):
         """:return: bool asserting whether related books might exist for
         a particular Work
+
+        :param novelist_configured: Whether NoveList is configured for
+        the library, if that's already known.
         """
+        if novelist_configured is None:
+            novelist_configured = NoveListAPI.is_configured(library)
+        if novelist_configured:
+            # There's no need to look at the book itself.
+            return True
+
         if isinstance(work, Work):
             edition = work.presentation_edition
         else:
@@ -360,9 +428,9 @@ class CirculationManagerAnnotator(Annotator):
             # edition where we can.
             edition = work.license_pool.presentation_edition
 
-        contributions = edition.contributions
-        series = edition.series
-        return contributions or series or NoveListAPI.is_configured(library)
+        if edition.series:
+            return True
+        return bool(edition.contributions)
 
     def language_and_audience_key_from_work(self, work):
         language_key = work.language
@@ -512,7 +580,7 @@ class CirculationManagerAnnotator(Annotator):
         can_borrow = False
         can_fulfill = False
         can_revoke = False
-        can_hold = self.library.allow_holds
+        can_hold = self.allow_holds
 
         if active_loan:
             can_fulfill = True
@@ -553,9 +621,7 @@ class CirculationManagerAnnotator(Annotator):
         # Add next-step information for every useful delivery
         # mechanism.
         borrow_links = []
-        api = None
-        if self.circulation:
-            api = self.circulation.api_for_license_pool(active_license_pool)
+        api = self.api_for_license_pool(active_license_pool)
         if api:
             set_mechanism_at_borrow = (
                 api.SET_DELIVERY_MECHANISM_AT == BaseCirculationAPI.BORROW_STEP)
@@ -794,7 +860,7 @@ class CirculationManagerAnnotator(Annotator):
                     patron_identifier
                 )
             cached = []
-            authdata = AuthdataUtility.from_config(self.library)
+            authdata = self.authdata
             if authdata:
                 # TODO: We would like to call encode() here, and have
                 # the client use a JWT as authdata, but we can't,
@@ -869,7 +935,8 @@ class CirculationManagerAnnotator(Annotator):
 class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
 
     @classmethod
-    def active_loans_for(cls, circulation, patron, test_mode=False):
+    def active_loans_for(cls, circulation, patron, test_mode=False,
+                         authdata=CirculationManagerAnnotator.NOT_LOADED):
         db = Session.object_session(patron)
         active_loans_by_work = {}
         for loan in patron.loans:
@@ -884,7 +951,7 @@ class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
 
         annotator = cls(
             circulation, None, patron.library, patron, active_loans_by_work, active_holds_by_work,
-            test_mode=test_mode
+            test_mode=test_mode, authdata=authdata
         )
         url = annotator.url_for('active_loans', library_short_name=patron.library.short_name, _external=True)
         works = patron.works_on_loan_or_on_hold()
@@ -894,13 +961,14 @@ class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
         return feed_obj
     
     @classmethod
-    def single_loan_feed(cls, circulation, loan, test_mode=False):
+    def single_loan_feed(cls, circulation, loan, test_mode=False,
+                         authdata=CirculationManagerAnnotator.NOT_LOADED):
         db = Session.object_session(loan)
         work = loan.license_pool.work or loan.license_pool.presentation_edition.work
         annotator = cls(circulation, None, loan.patron.library,
                         active_loans_by_work={work:loan}, 
                         active_holds_by_work={}, 
-                        test_mode=test_mode)
+                        test_mode=test_mode, authdata=authdata)
         identifier = loan.license_pool.identifier
         url = annotator.url_for(
             'loan_or_hold_detail',
@@ -915,24 +983,26 @@ class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
         return AcquisitionFeed.single_entry(db, work, annotator)
 
     @classmethod
-    def single_hold_feed(cls, circulation, hold, test_mode=False):
+    def single_hold_feed(cls, circulation, hold, test_mode=False,
+                         authdata=CirculationManagerAnnotator.NOT_LOADED):
         db = Session.object_session(hold)
         work = hold.license_pool.work or hold.license_pool.presentation_edition.work
         annotator = cls(circulation, None, hold.patron.library,
                         active_loans_by_work={}, 
                         active_holds_by_work={work:hold}, 
-                        test_mode=test_mode)
+                        test_mode=test_mode, authdata=authdata)
         return AcquisitionFeed.single_entry(db, work, annotator)
 
     @classmethod
-    def single_fulfillment_feed(cls, circulation, loan, fulfillment, test_mode=False):
+    def single_fulfillment_feed(cls, circulation, loan, fulfillment, test_mode=False,
+                                authdata=CirculationManagerAnnotator.NOT_LOADED):
         db = Session.object_session(loan)
         work = loan.license_pool.work or loan.license_pool.presentation_edition.work
         annotator = cls(circulation, None, loan.patron.library,
                         active_loans_by_work={}, 
                         active_holds_by_work={}, 
                         active_fulfillments_by_work={work:fulfillment},
-                        test_mode=test_mode)
+                        test_mode=test_mode, authdata=authdata)
         identifier = loan.license_pool.identifier
         url = annotator.url_for(
             'loan_or_hold_detail',
@@ -37,6 +37,7 @@ from core.testing import (
     MockRequestsResponse,
 )
 from circulation_exceptions import *
+from token_cache import TokenCache
 
 class OPDSForDistributorsAPI(BaseCirculationAPI):
     NAME = "OPDS for Distributors"
@@ -59,6 +60,12 @@ class OPDSForDistributorsAPI(BaseCirculationAPI):
         (type, DeliveryMechanism.NO_DRM): type for type in SUPPORTED_MEDIA_TYPES
     }
 
+    TOKEN_TYPE = "OPDS For Distributors Bearer Token"
+
+    # Bearer tokens are shared by every OPDSForDistributorsAPI in
+    # the process.
+    bearer_tokens = TokenCache()
+
     def __init__(self, _db, collection):
         self.collection_id = collection.id
         self.data_source_name = collection.external_integration.setting(Collection.DATA_SOURCE_NAME_SETTING).value
@@ -71,60 +78,82 @@ class OPDSForDistributorsAPI(BaseCirculationAPI):
         """Wrapper around HTTP.request_with_timeout to be overridden for tests."""
         return HTTP.request_with_timeout(method, url, *args, **kwargs)
 
+    @property
+    def _token_key(self):
+        return (self.collection_id, self.TOKEN_TYPE)
+
     def _get_token(self, _db):
+        return self.bearer_tokens.credential_token(
+            self._token_key, _db,
+            self.data_source_name, self.TOKEN_TYPE, self._refresh_token
+        )
+
+    def _replace_token(self, _db, rejected_token):
+        """Get a new bearer token after the distributor rejected one
+        that hadn't expired yet.
+        """
+        def refresh():
+            credential = Credential.lookup(
+                _db, self.data_source_name, self.TOKEN_TYPE, None,
+                self._refresh_token
+            )
+            if credential.credential == rejected_token:
+                self._refresh_token(credential)
+            return credential.credential, credential.expires
+        return self.bearer_tokens.replace(
+            self._token_key, rejected_token, refresh
+        )
+
+    def _find_auth_url(self):
+        """Find the authenticate url in the OPDS authentication document."""
+        response = self._request_with_timeout('GET', self.feed_url)
+
+        if response.status_code != 401:
+            # This feed doesn't require authentication, so
+            # we need to find a link to the authentication document.
+            feed = feedparser.parse(response.content)
+            links = feed.get('feed', {}).get('links', [])
+            auth_doc_links = [l for l in links if l['rel'] == "http://opds-spec.org/auth/document"]
+            if not auth_doc_links:
+                raise LibraryAuthorizationFailedException()
+            auth_doc_link = auth_doc_links[0].get("href")
+
+            response = self._request_with_timeout('GET', auth_doc_link)
+
+        try:
+            auth_doc = json.loads(response.content)
+        except Exception, e:
+            raise LibraryAuthorizationFailedException()
+        auth_types = auth_doc.get('authentication', [])
+        credentials_types = [t for t in auth_types if t['type'] == "http://opds-spec.org/auth/oauth/client_credentials"]
+        if not credentials_types:
+            raise LibraryAuthorizationFailedException()
+
+        links = credentials_types[0].get('links', [])
+        auth_links = [l for l in links if l.get("rel") == "authenticate"]
+        if not auth_links:
+            raise LibraryAuthorizationFailedException()
+        return auth_links[0].get("href")
+
+    def _refresh_token(self, credential):
         # If this is the first time we're getting a token, we
-        # need to find the authenticate url in the OPDS
-        # authentication document.
+        # need to find the authenticate url.
         if not self.auth_url:
-            response = self._request_with_timeout('GET', self.feed_url)
-
-            if response.status_code != 401:
-                # This feed doesn't require authentication, so
-                # we need to find a link to the authentication document.
-                feed = feedparser.parse(response.content)
-                links = feed.get('feed', {}).get('links', [])
-                auth_doc_links = [l for l in links if l['rel'] == "http://opds-spec.org/auth/document"]
-                if not auth_doc_links:
-                    raise LibraryAuthorizationFailedException()
-                auth_doc_link = auth_doc_links[0].get("href")
-
-                response = self._request_with_timeout('GET', auth_doc_link)
-
-            try:
-                auth_doc = json.loads(response.content)
-            except Exception, e:
-                raise LibraryAuthorizationFailedException()
-            auth_types = auth_doc.get('authentication', [])
-            credentials_types = [t for t in auth_types if t['type'] == "http://opds-spec.org/auth/oauth/client_credentials"]
-            if not credentials_types:
-                raise LibraryAuthorizationFailedException()
+            self.auth_url = self._find_auth_url()
 
-            links = credentials_types[0].get('links', [])
-            auth_links = [l for l in links if l.get("rel") == "authenticate"]
-            if not auth_links:
-                raise LibraryAuthorizationFailedException()
-            self.auth_url = auth_links[0].get("href")
-
-        def refresh(credential):
-            headers = dict()
-            auth_header = "Basic %s" % base64.b64encode("%s:%s" % (self.username, self.password))
-            headers['Authorization'] = auth_header
-            headers['Content-Type'] = "application/x-www-form-urlencoded"
-            body = dict(grant_type='client_credentials')
-            token_response = self._request_with_timeout('POST', self.auth_url, data=body, headers=headers)
-            token = json.loads(token_response.content)
-            access_token = token.get("access_token")
-            expires_in = token.get("expires_in")
-            if not access_token or not expires_in:
-                raise LibraryAuthorizationFailedException()
-            credential.credential = access_token
-            expires_in = expires_in
-            credential.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
-        return Credential.lookup(_db, self.data_source_name,
-                                 "OPDS For Distributors Bearer Token",
-                                 patron=None,
-                                 refresher_method=refresh,
-                                 ).credential
+        headers = dict()
+        auth_header = "Basic %s" % base64.b64encode("%s:%s" % (self.username, self.password))
+        headers['Authorization'] = auth_header
+        headers['Content-Type'] = "application/x-www-form-urlencoded"
+        body = dict(grant_type='client_credentials')
+        token_response = self._request_with_timeout('POST', self.auth_url, data=body, headers=headers)
+        token = json.loads(token_response.content)
+        access_token = token.get("access_token")
+        expires_in = token.get("expires_in")
+        if not access_token or not expires_in:
+            raise LibraryAuthorizationFailedException()
+        credential.credential = access_token
+        credential.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
 
     def checkin(self, patron, pin, licensepool):
         # Delete the patron's loan for this licensepool.
@@ -170,6 +199,15 @@ class OPDSForDistributorsAPI(BaseCirculationAPI):
                 auth_header = "Bearer %s" % token
                 headers['Authorization'] = auth_header
                 response = self._request_with_timeout('GET', url, headers=headers)
+                if response.status_code == 401:
+                    # The distributor stopped accepting the token
+                    # before it expired. Get a new one and try again,
+                    # once.
+                    token = self._replace_token(_db, token)
+                    headers['Authorization'] = "Bearer %s" % token
+                    response = self._request_with_timeout(
+                        'GET', url, headers=headers
+                    )
 
                 return FulfillmentInfo(
                     licensepool.collection,
@@ -1,7 +1,9 @@
 from nose.tools import set_trace
 import datetime
+import itertools
 import json
 import requests
+from multiprocessing.pool import ThreadPool
 import flask
 from flask.ext.babel import lazy_gettext as _
 
@@ -45,6 +47,7 @@ from core.metadata_layer import ReplacementPolicy
 from core.scripts import Script
 
 from circulation_exceptions import *
+from token_cache import TokenCache
 from core.analytics import Analytics
 
 class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
@@ -93,6 +96,14 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
     # displayed to a patron, so it doesn't matter much.
     DEFAULT_ERROR_URL = "http://librarysimplified.org/"
 
+    PATRON_TOKEN_TYPE = "OAuth Token"
+
+    # Keep the OAuth tokens of this many patrons in memory.
+    PATRON_TOKEN_CACHE_SIZE = 10000
+
+    # Patron tokens are shared by every OverdriveAPI in the process.
+    patron_tokens = TokenCache(max_size=PATRON_TOKEN_CACHE_SIZE)
+
     def __init__(self, _db, collection):
         super(OverdriveAPI, self).__init__(_db, collection)
         self.overdrive_bibliographic_coverage_provider = (
@@ -107,8 +118,8 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
 
         The results are never cached.
         """
-        patron_credential = self.get_patron_credential(patron, pin)
-        headers = dict(Authorization="Bearer %s" % patron_credential.credential)
+        token = self.patron_token(patron, pin)
+        headers = dict(Authorization="Bearer %s" % token)
         headers.update(extra_headers)
         if method and method.lower() in ('get', 'post', 'put', 'delete'):
             method = method.lower()
@@ -126,8 +137,7 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
                 raise Exception("Something's wrong with the patron OAuth Bearer Token!")
             else:
                 # Refresh the token and try again.
-                self.refresh_patron_access_token(
-                    patron_credential, patron, pin)
+                self.replace_patron_token(patron, pin, token)
                 return self.patron_request(
                     patron, pin, url, extra_headers, data, True)
         else:
@@ -143,7 +153,43 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
             return self.refresh_patron_access_token(
                 credential, patron, pin)
         return Credential.lookup(
-            self._db, DataSource.OVERDRIVE, "OAuth Token", patron, refresh)
+            self._db, DataSource.OVERDRIVE, self.PATRON_TOKEN_TYPE, patron,
+            refresh
+        )
+
+    def patron_token(self, patron, pin):
+        """Find a usable OAuth token for the given patron.
+
+        The token is kept in memory, so most requests don't need to
+        look at the Credential table, let alone ask Overdrive for a
+        new token.
+        """
+        def refresh(credential):
+            return self.refresh_patron_access_token(
+                credential, patron, pin)
+        return self.patron_tokens.credential_token(
+            self.patron_token_key(patron), self._db, DataSource.OVERDRIVE, self.PATRON_TOKEN_TYPE,
+            refresh, patron=patron
+        )
+
+    def replace_patron_token(self, patron, pin, rejected_token):
+        """Get a new OAuth token for a patron whose token was rejected."""
+        def refresh():
+            credential = self.get_patron_credential(patron, pin)
+            if credential.credential == rejected_token:
+                self.refresh_patron_access_token(credential, patron, pin)
+            return credential.credential, credential.expires
+        return self.patron_tokens.replace(
+            self.patron_token_key(patron), rejected_token, refresh
+        )
+
+    def patron_token_key(self, patron):
+        """The key a patron's token is kept under in patron_tokens.
+
+        This matches the patron's Credential, which isn't tied to any
+        one collection.
+        """
+        return patron.id
 
     def refresh_patron_access_token(self, credential, patron, pin):
         """Request an OAuth bearer token that allows us to act on
@@ -444,6 +490,7 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
         try:
             loans = self.get_patron_checkouts(patron, pin)
             holds = self.get_patron_holds(patron, pin)
+            self.patron_tokens.log_stats(self.log, "Overdrive patron token")
         except PatronAuthorizationFailedException, e:
             # This frequently happens because Overdrive performs
             # checks for blocked or expired accounts upon initial
@@ -636,7 +683,13 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
             return True
         raise CannotReleaseHold(response.content)
 
-    def circulation_lookup(self, book):
+    def circulation_lookup(self, book, refresh_token=True):
+        """Ask Overdrive about a book's circulation.
+
+        :param refresh_token: If this is False and Overdrive rejects
+        the bearer token, the response is returned as-is instead of
+        refreshing the token and trying again.
+        """
         if isinstance(book, basestring):
             book_id = book
             circulation_link = self.AVAILABILITY_ENDPOINT % dict(
@@ -647,7 +700,10 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
         else:
             book_id = book['id']
             circulation_link = book['availability_link']
-        return book, self.get(circulation_link, {})
+        if refresh_token:
+            return book, self.get(circulation_link, {})
+        headers = dict(Authorization="Bearer %s" % self.token)
+        return book, self._do_get(circulation_link, headers)
 
     def update_formats(self, licensepool):
         """Update the format information for a single book.
@@ -681,17 +737,39 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
         created for the LicensePool and set as presentation-ready.
         """
         # Retrieve current circulation information about this book
+        book, status_code, content = self.lookup_circulation(book_id)
+        return self.update_licensepool_from_lookup(
+            book_id, book, status_code, content
+        )
+
+    def lookup_circulation(self, book_id, refresh_token=True):
+        """Retrieve current circulation information about a book.
+
+        :param refresh_token: If this is False, a rejected bearer
+        token is not refreshed; the lookup fails with status code 401
+        instead. The lookup then doesn't use the database, so it can
+        be run in a separate thread.
+
+        :return: A 3-tuple (book, status_code, content). If the
+        lookup failed, status_code is None.
+        """
         try:
             book, (status_code, headers, content) = self.circulation_lookup(
-                book_id
+                book_id, refresh_token
             )
         except Exception, e:
-            status_code = None
             self.log.error(
                 "HTTP exception communicating with Overdrive",
                 exc_info=e
             )
+            return None, None, None
+        return book, status_code, content
 
+    def update_licensepool_from_lookup(self, book_id, book, status_code,
+                                       content):
+        """Update a book's LicensePool with the output of
+        lookup_circulation().
+        """
         if status_code != 200:
             self.log.error(
                 "Could not get availability for %s: status code %s",
@@ -845,14 +923,23 @@ class OverdriveCirculationMonitor(CollectionMonitor):
     # strict chronological order, but if you see 100 consecutive books
     # that haven't changed, you're probably done.
     MAXIMUM_CONSECUTIVE_UNCHANGED_BOOKS = None
-    
-    def __init__(self, _db, collection, api_class=OverdriveAPI):
+
+    # Look up the circulation of this many books at once. If this is
+    # 1, books are looked up one at a time as they're processed.
+    LOOKUP_CONCURRENCY = 1
+
+    # Commit the database session after processing this many books.
+    BATCH_SIZE = 50
+
+    def __init__(self, _db, collection, api_class=OverdriveAPI,
+                 concurrency=None):
         """Constructor."""
         super(OverdriveCirculationMonitor, self).__init__(_db, collection)
         self.api = api_class(_db, collection)
         self.maximum_consecutive_unchanged_books = (
             self.MAXIMUM_CONSECUTIVE_UNCHANGED_BOOKS
         )
+        self.concurrency = concurrency or self.LOOKUP_CONCURRENCY
         self.analytics = Analytics(_db)
         
     def recently_changed_ids(self, start, cutoff):
@@ -860,45 +947,102 @@ class OverdriveCirculationMonitor(CollectionMonitor):
 
     def run_once(self, start, cutoff):
         _db = self._db
-        added_books = 0
-        overdrive_data_source = DataSource.lookup(
-            _db, DataSource.OVERDRIVE)
-
         total_books = 0
         consecutive_unchanged_books = 0
-        for i, book in enumerate(self.recently_changed_ids(start, cutoff)):
-            total_books += 1
-            if not total_books % 100:
-                self.log.info("%s books processed", total_books)
-            if not book:
-                continue
-            license_pool, is_new, is_changed = self.api.update_licensepool(book)
-            # Log a circulation event for this work.
-            if is_new:
-                for library in self.collection.libraries:
-                    self.analytics.collect_event(
-                        library, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked)
-
-            _db.commit()
-
-            if is_changed:
-                consecutive_unchanged_books = 0
-            else:
-                consecutive_unchanged_books += 1
-                if (self.maximum_consecutive_unchanged_books
-                    and consecutive_unchanged_books >= 
-                    self.maximum_consecutive_unchanged_books):
-                    # We're supposed to stop this run after finding a
-                    # run of books that have not changed, and we have
-                    # in fact seen that many consecutive unchanged
-                    # books.
-                    self.log.info("Stopping at %d unchanged books.",
-                                  consecutive_unchanged_books)
+        if self.concurrency > 1:
+            pool = ThreadPool(self.concurrency)
+        else:
+            pool = None
+        try:
+            books = iter(self.recently_changed_ids(start, cutoff))
+            while True:
+                batch = list(itertools.islice(books, self.BATCH_SIZE))
+                if not batch:
+                    break
+                stop = False
+                for book, lookup in self.lookups(batch, pool):
+                    total_books += 1
+                    if not total_books % 100:
+                        self.log.info("%s books processed", total_books)
+                    if not book:
+                        continue
+                    license_pool, is_new, is_changed = (
+                        self.api.update_licensepool_from_lookup(book, *lookup)
+                    )
+                    # Log a circulation event for this work.
+                    if is_new:
+                        for library in self.collection.libraries:
+                            self.analytics.collect_event(
+                                library, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked)
+
+                    if is_changed:
+                        consecutive_unchanged_books = 0
+                    else:
+                        consecutive_unchanged_books += 1
+                        if (self.maximum_consecutive_unchanged_books
+                            and consecutive_unchanged_books >= 
+                            self.maximum_consecutive_unchanged_books):
+                            # We're supposed to stop this run after finding a
+                            # run of books that have not changed, and we have
+                            # in fact seen that many consecutive unchanged
+                            # books.
+                            self.log.info("Stopping at %d unchanged books.",
+                                          consecutive_unchanged_books)
+                            stop = True
+                            break
+                _db.commit()
+                if stop:
                     break
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
 
         if total_books:
             self.log.info("Processed %d books total.", total_books)
 
+    def lookups(self, batch, pool=None):
+        """Look up the circulation of a batch of books.
+
+        :param pool: A ThreadPool for looking up books in parallel. If
+        this is None, each book is looked up just before it's needed.
+        :yield: A 2-tuple (book, lookup) for each book in the
+        batch, in order. `lookup` is the output of
+        OverdriveAPI.lookup_circulation.
+        """
+        if pool is None:
+            for book in batch:
+                if book:
+                    yield book, self.api.lookup_circulation(book)
+                else:
+                    yield book, None
+            return
+
+        # The lookup threads share the API's bearer token and must
+        # not refresh it themselves, so make sure it's fresh first.
+        self.api.check_creds()
+        def lookup(book):
+            return self.api.lookup_circulation(book, refresh_token=False)
+        books = [book for book in batch if book]
+        results = pool.map(lookup, books)
+
+        rejected = [i for i, (b, status_code, content) in enumerate(results)
+                    if status_code == 401]
+        if rejected:
+            # The token expired partway through the batch. Get a new
+            # one here, once, and look those books up again.
+            self.api.check_creds(True)
+            retried = pool.map(lookup, [books[i] for i in rejected])
+            for i, result in zip(rejected, retried):
+                results[i] = result
+
+        results = iter(results)
+        for book in batch:
+            if book:
+                yield book, next(results)
+            else:
+                yield book, None
+
 
 class FullOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     """Monitor every single book in the Overdrive collection.
@@ -908,6 +1052,7 @@ class FullOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     """
     SERVICE_NAME = "Overdrive Collection Overview"
     INTERVAL_SECONDS = 3600*4
+    LOOKUP_CONCURRENCY = 8
     
     def recently_changed_ids(self, start, cutoff):
         """Ignore the dates and return all IDs."""
@@ -5,7 +5,10 @@ from api.authenticator import (
     BasicAuthenticationProvider,
     PatronData,
 )
-from api.sip.client import SIPClient
+from api.sip.client import (
+    SIPClient,
+    SIPClientPool,
+)
 from core.util.http import RemoteIntegrationException
 from core.util import MoneyUtility
 from core.model import ExternalIntegration
@@ -20,6 +23,10 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
     PORT = "port"
     LOCATION_CODE = "location code"
     FIELD_SEPARATOR = "field separator"
+    CONNECTION_POOL_SIZE = "connection pool size"
+    CONNECT_TIMEOUT = "connect timeout"
+    READ_TIMEOUT = "read timeout"
+    TOTAL_TIMEOUT = "total timeout"
     
     SETTINGS = [
         { "key": ExternalIntegration.URL, "label": _("URL") },
@@ -28,6 +35,26 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         { "key": ExternalIntegration.PASSWORD, "label": _("Login Password") },
         { "key": LOCATION_CODE, "label": _("Location Code") },
         { "key": FIELD_SEPARATOR, "label": _("Field Separator") },
+        { "key": CONNECTION_POOL_SIZE,
+          "label": _("Maximum number of simultaneous connections to the SIP2 server"),
+          "type": "number",
+          "optional": True,
+        },
+        { "key": CONNECT_TIMEOUT,
+          "label": _("Seconds to wait when connecting to the SIP2 server"),
+          "type": "number",
+          "optional": True,
+        },
+        { "key": READ_TIMEOUT,
+          "label": _("Seconds to wait for the SIP2 server to send data"),
+          "type": "number",
+          "optional": True,
+        },
+        { "key": TOTAL_TIMEOUT,
+          "label": _("Seconds to wait for a complete response from the SIP2 server"),
+          "type": "number",
+          "optional": True,
+        },
     ] + BasicAuthenticationProvider.SETTINGS
     
     # Map the reasons why SIP2 might report a patron is blocked to the
@@ -73,7 +100,9 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         specified, the default (the pipe character) will be used.
 
         :param client: A drop-in replacement for the SIPClient
-        object. Only intended for use during testing.
+        object. Only intended for use during testing. If this is a
+        callable, it will be used to create every connection in the
+        pool; otherwise the pool will only contain this one client.
 
         :param connect: If this is false, the generated SIPClient will
         not attempt to connect to the server. Only intended for use
@@ -82,10 +111,13 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         super(SIP2AuthenticationProvider, self).__init__(
             library, integration, analytics
         )
+        pool_size = integration.setting(self.CONNECTION_POOL_SIZE).int_value
+        client_factory = None
         try:
             server = None
             if client:
                 if callable(client):
+                    client_factory = client
                     client = client()
             else:
                 server = integration.url
@@ -95,17 +127,34 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
                 location_code = integration.setting(self.LOCATION_CODE).value
                 field_separator = integration.setting(
                     self.FIELD_SEPARATOR).value or '|'
-                client = SIPClient(
-                    target_server=server, target_port=port,
-                    login_user_id=login_user_id, login_password=login_password,
-                    location_code=location_code, separator=field_separator,
-                    connect=connect
-                )
+                connect_timeout = integration.setting(
+                    self.CONNECT_TIMEOUT).int_value
+                read_timeout = integration.setting(self.READ_TIMEOUT).int_value
+                total_timeout = integration.setting(
+                    self.TOTAL_TIMEOUT).int_value
+                def client_factory():
+                    return SIPClient(
+                        target_server=server, target_port=port,
+                        login_user_id=login_user_id,
+                        login_password=login_password,
+                        location_code=location_code,
+                        separator=field_separator, connect=connect,
+                        connect_timeout=connect_timeout,
+                        read_timeout=read_timeout,
+                        total_timeout=total_timeout
+                    )
+                client = client_factory()
         except IOError, e:
             raise RemoteIntegrationException(
                 server or 'unknown server', e.message
             )
+
+        # This client is the first connection in the pool. More
+        # connections will be created as needed.
         self.client = client
+        self.client_pool = SIPClientPool(
+            client_factory, max_size=pool_size, clients=[client]
+        )
 
     def remote_authenticate(self, username, password):
         """Authenticate a patron with the SIP2 server.
@@ -115,7 +164,8 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         :param password: The patron's password/pin/access code.
         """
         try:
-            info = self.client.patron_information(username, password)
+            with self.client_pool.connection() as client:
+                info = client.patron_information(username, password)
         except IOError, e:
             raise RemoteIntegrationException(
                 self.client.target_server or 'unknown server',
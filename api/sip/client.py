@@ -25,11 +25,13 @@ limitations under the License.
 
 """
 
+import contextlib
 import datetime
 import logging
 from nose.tools import set_trace
 import re
 import socket
+from collections import defaultdict
 import sys
 import threading
 import time
@@ -76,6 +78,16 @@ fixed._add('fine_items_count', 4)
 fixed._add('recall_items_count', 4)
 fixed._add('unavailable_holds_count', 4)
 fixed._add('login_ok', 1)
+fixed._add('online_status', 1)
+fixed._add('checkin_ok', 1)
+fixed._add('checkout_ok', 1)
+fixed._add('acs_renewal_policy', 1)
+fixed._add('status_update_ok', 1)
+fixed._add('offline_ok', 1)
+fixed._add('timeout_period', 3)
+fixed._add('retries_allowed', 3)
+fixed._add('date_time_sync', 18)
+fixed._add('protocol_version', 4)
 
 class named(object):
     """A variable-length field in a SIP2 response."""
@@ -148,6 +160,9 @@ named._add("home_address", "BD")
 named._add("email_address", "BE")
 named._add("phone_number", "BF")
 named._add("sequence_number", "AY")
+named._add("library_name", "AM")
+named._add("supported_messages", "BX")
+named._add("terminal_location", "AN")
 
 # The spec doesn't say there can be more than one screen message,
 # but I have seen it happen.
@@ -232,10 +247,23 @@ class SIPClient(Constants):
         RECALL_OVERDUE,
         TOO_MANY_ITEMS_BILLED
     ]
-    
+
+    # By default, give up on connecting to the SIP server after this
+    # many seconds.
+    DEFAULT_CONNECT_TIMEOUT = 10
+
+    # By default, give up if the SIP server goes this many seconds
+    # without sending any data.
+    DEFAULT_READ_TIMEOUT = 10
+
+    # By default, give up if a complete response hasn't arrived this
+    # many seconds after we start reading it.
+    DEFAULT_TOTAL_TIMEOUT = 30
+
     def __init__(self, target_server, target_port, login_user_id=None,
                  login_password=None, location_code=None, separator=None,
-                 connect=True):
+                 connect=True, connect_timeout=None, read_timeout=None,
+                 total_timeout=None):
         self.target_server = target_server
         if not target_port:
             target_port = 6001
@@ -252,6 +280,21 @@ class SIPClient(Constants):
             escaped = self.separator
         self.separator_re = re.compile(escaped + "([A-Z][A-Z])")
 
+        self.connect_timeout = connect_timeout or self.DEFAULT_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or self.DEFAULT_READ_TIMEOUT
+        self.total_timeout = total_timeout or self.DEFAULT_TOTAL_TIMEOUT
+
+        # Data we've read from the socket but haven't yet returned
+        # as part of a message.
+        self.read_buffer = ""
+
+        # Statistics about the requests we've made, keyed by the
+        # two-character code of the request message.
+        self.stats = defaultdict(
+            lambda: dict(requests=0, bytes_read=0, total_time=0.0,
+                         max_time=0.0)
+        )
+
         self.login_user_id = login_user_id
         self.login_password = login_password
         if login_user_id and login_password:
@@ -290,12 +333,24 @@ class SIPClient(Constants):
             self.patron_information_request, self.patron_information_parser,
             *args, **kwargs
         )
+
+    def sc_status(self, *args, **kwargs):
+        """Ask the SIP server about its status.
+
+        This is a cheap way of making sure the connection still works.
+        """
+        return self.make_request(
+            self.sc_status_message, self.acs_status_parser,
+            *args, **kwargs
+        )
             
     def connect(self):
         """Create a socket connection to a SIP server."""
         with self.socket_lock:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.target_server, self.target_port))
+            sock = socket.create_connection(
+                (self.target_server, self.target_port), self.connect_timeout
+            )
+            sock.settimeout(self.read_timeout)
 
             # Since this is a new socket connection, reset the message count
             # and, potentially, logged_in.
@@ -303,6 +358,16 @@ class SIPClient(Constants):
             self.socket = sock
         return sock
 
+    def disconnect(self):
+        """Close the socket connection to the SIP server."""
+        sock = getattr(self, 'socket', None)
+        if sock:
+            try:
+                sock.close()
+            except socket.error, e:
+                self.log.warn("Error closing SIP2 socket: %s", e)
+            self.socket = None
+
     def reset_connection_state(self):
         """Reset connection-specific state.
 
@@ -310,6 +375,7 @@ class SIPClient(Constants):
         whether we're logged in.
         """
         self.sequence_number = 0
+        self.read_buffer = ""
         if self.must_log_in:
             self.logged_in = False
     
@@ -349,8 +415,10 @@ class SIPClient(Constants):
         parsed = None
         while not parsed:
             try:
+                before = time.time()
                 self.send(message_with_checksum)
                 response = self.read_message()
+                self.record_stats(original_message[:2], response, before)
             except (IOError, socket.error), e:
                 # Most likely there was a problem with the
                 # socket. Create a fresh socket connection and try
@@ -396,6 +464,41 @@ class SIPClient(Constants):
             fixed.login_ok
         )
 
+    def sc_status_message(self, status_code="0", max_print_width="000",
+                          protocol_version="2.00"):
+        """Generate a message asking for the status of the SIP server.
+
+        Format of message to send to ILS:
+        99<status code><max print width><protocol version>
+        status code: 1-char, required (0 means 'SC ok')
+        max print width: 3-char, required
+        protocol version: 4-char, required
+        """
+        return "99" + status_code + max_print_width + protocol_version
+
+    def acs_status_parser(self, message):
+        """Parse the response to an SC status message."""
+        return self.parse_response(
+            message,
+            98,
+            fixed.online_status,
+            fixed.checkin_ok,
+            fixed.checkout_ok,
+            fixed.acs_renewal_policy,
+            fixed.status_update_ok,
+            fixed.offline_ok,
+            fixed.timeout_period,
+            fixed.retries_allowed,
+            fixed.date_time_sync,
+            fixed.protocol_version,
+            named.institution_id.required,
+            named.library_name,
+            named.supported_messages.required,
+            named.terminal_location,
+            named.screen_message,
+            named.print_line,
+        )
+
     def patron_information_request(
             self, patron_identifier, patron_password="", institution_id="",
             terminal_password="",
@@ -692,22 +795,55 @@ class SIPClient(Constants):
     def read_message(self, max_size=1024*1024):
         """Read a SIP2 message from the socket connection.
 
-        A SIP2 message ends with a \r character.
+        A SIP2 message ends with a \r character. If we read any data
+        past the end of the message, it's kept around to be the start
+        of the next message.
+
+        :raise socket.timeout: If the server goes quiet for longer
+        than self.read_timeout, or the whole message takes longer than
+        self.total_timeout to arrive.
         """
-        done = False
-        data = ""
-        tmp = ""
-        while not done:
+        deadline = time.time() + self.total_timeout
+        chunks = []
+        size = 0
+        tmp = self.read_buffer
+        self.read_buffer = ""
+        while True:
+            end = tmp.find('\r')
+            if end != -1:
+                # We found the end of the message.
+                chunks.append(tmp[:end+1])
+                self.read_buffer = tmp[end+1:]
+                break
+            chunks.append(tmp)
+            size += len(tmp)
+            if size > max_size:
+                raise IOError("SIP2 response too large.")
+            if time.time() > deadline:
+                raise socket.timeout(
+                    "Timed out waiting for a complete SIP2 response."
+                )
             tmp = self.socket.recv(4096)
-            data = data + tmp
-            if not data:
+            if not tmp:
+                if size:
+                    raise IOError("Socket closed in the middle of a SIP2 response.")
                 raise IOError("No data read from socket.")
-            if ord(data[-1]) == 13:
-                done = True
-            if len(data) > max_size:
-                raise IOError("SIP2 response too large.")
+        return "".join(chunks)
 
-        return data
+    def record_stats(self, message_type, response, start_time):
+        """Keep track of how long requests of a given type take and how
+        much data comes back.
+        """
+        elapsed = time.time() - start_time
+        stats = self.stats[message_type]
+        stats['requests'] += 1
+        stats['bytes_read'] += len(response)
+        stats['total_time'] += elapsed
+        stats['max_time'] = max(stats['max_time'], elapsed)
+        self.log.debug(
+            "SIP2 %s request: %d bytes in %.3f sec", message_type,
+            len(response), elapsed
+        )
   
     def append_checksum(self, text, include_sequence_number=True):
         """Calculates checksum for passed-in message, and returns the message
@@ -751,6 +887,172 @@ class SIPClient(Constants):
         return text      
 
 
+class SIPClientPool(object):
+    """A pool of SIPClients, each with its own (logged in) connection
+    to the SIP server.
+
+    A single SIPClient can only carry on one conversation at a time,
+    so sharing one between every request means that patrons can only
+    be authenticated one at a time. A pool lets several conversations
+    happen at once.
+    """
+
+    log = logging.getLogger("SIPClientPool")
+
+    # By default, keep no more than this many connections open to
+    # the SIP server.
+    DEFAULT_MAX_SIZE = 5
+
+    # Close connections that haven't been used in this many seconds.
+    MAX_IDLE_TIME = 5 * 60
+
+    # Before reusing a connection that hasn't been used in this many
+    # seconds, make sure it still works.
+    HEALTH_CHECK_INTERVAL = 60
+
+    # Wait this many seconds for a connection to become available
+    # before giving up.
+    ACQUIRE_TIMEOUT = 30
+
+    def __init__(self, client_factory=None, max_size=None, clients=None):
+        """Constructor.
+
+        :param client_factory: A function that creates and connects a
+        new SIPClient. If this is None, the pool can only hand out the
+        clients in `clients`.
+
+        :param max_size: The maximum number of clients that may exist
+        at once.
+
+        :param clients: A list of already-connected SIPClients to
+        put in the pool.
+        """
+        self.client_factory = client_factory
+        self.max_size = max_size or self.DEFAULT_MAX_SIZE
+        self.condition = threading.Condition()
+
+        # Each idle client is stored alongside the time it was last used.
+        self.idle = []
+        self.size = 0
+        now = time.time()
+        for client in clients or []:
+            self.idle.append((client, now))
+            self.size += 1
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a SIPClient for the duration of a `with` block."""
+        client = self.acquire()
+        broken = False
+        try:
+            yield client
+        except (IOError, socket.error), e:
+            broken = True
+            raise
+        finally:
+            self.release(client, broken)
+
+    def acquire(self, timeout=None):
+        """Check out a SIPClient, creating one if necessary.
+
+        :raise IOError: If no client becomes available within
+        `timeout` seconds.
+        """
+        if timeout is None:
+            timeout = self.ACQUIRE_TIMEOUT
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                self.reap(now)
+                if self.idle:
+                    client, last_used = self.idle.pop()
+                    break
+                if self.client_factory and self.size < self.max_size:
+                    # We'll create a new client once we've released
+                    # the lock.
+                    self.size += 1
+                    client = last_used = None
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise IOError(
+                        "Timed out waiting for a connection to the SIP server."
+                    )
+                self.condition.wait(remaining)
+
+        if client is None:
+            return self._create()
+        if (self.client_factory
+            and time.time() - last_used > self.HEALTH_CHECK_INTERVAL
+            and not self.healthy(client)):
+            self._discard(client)
+            with self.condition:
+                self.size += 1
+            return self._create()
+        return client
+
+    def release(self, client, broken=False):
+        """Return a SIPClient to the pool.
+
+        :param broken: If this is True, there was a problem talking to
+        the server, and the client should be thrown away rather than
+        reused.
+        """
+        if broken and self.client_factory:
+            self._discard(client)
+            return
+        with self.condition:
+            self.idle.append((client, time.time()))
+            self.condition.notify()
+
+    def healthy(self, client):
+        """Make sure a SIPClient can still talk to the server."""
+        try:
+            response = client.sc_status(fail_on_network_error=True)
+        except (IOError, socket.error), e:
+            self.log.warn("SIP2 connection failed health check: %s", e)
+            return False
+        return response.get('online_status') == 'Y'
+
+    def reap(self, now):
+        """Close connections that have been idle for too long.
+
+        The caller must hold self.condition.
+        """
+        keep = []
+        for client, last_used in self.idle:
+            if now - last_used > self.MAX_IDLE_TIME:
+                client.disconnect()
+                self.size -= 1
+            else:
+                keep.append((client, last_used))
+        self.idle = keep
+
+    def close(self):
+        """Close every idle connection."""
+        with self.condition:
+            for client, last_used in self.idle:
+                client.disconnect()
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def _create(self):
+        try:
+            return self.client_factory()
+        except Exception, e:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def _discard(self, client):
+        client.disconnect()
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+
 class MockSIPClient(SIPClient):
     """A SIP client that relies on canned responses rather than a socket
     connection.
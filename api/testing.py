@@ -12,6 +12,7 @@ from core.model import (
     ExternalIntegration,
     Identifier,
     Library,
+    LicensePool,
     Loan,
     Hold,
     Session,
@@ -177,11 +178,21 @@ class MockCirculationAPI(CirculationAPI):
         self.remote_holds = []
         self.remotes = {}
 
-    def local_loans(self, patron):
-        return self._db.query(Loan).filter(Loan.patron==patron)
+    def local_loans(self, patron, collection_ids=None):
+        qu = self._db.query(Loan).filter(Loan.patron==patron)
+        if collection_ids is not None:
+            qu = qu.join(Loan.license_pool).filter(
+                LicensePool.collection_id.in_(collection_ids)
+            )
+        return qu
 
-    def local_holds(self, patron):
-        return self._db.query(Hold).filter(Hold.patron==patron)
+    def local_holds(self, patron, collection_ids=None):
+        qu = self._db.query(Hold).filter(Hold.patron==patron)
+        if collection_ids is not None:
+            qu = qu.join(Hold.license_pool).filter(
+                LicensePool.collection_id.in_(collection_ids)
+            )
+        return qu
 
     def add_remote_loan(self, *args, **kwargs):
         self.remote_loans.append(LoanInfo(*args, **kwargs))
@@ -189,9 +200,14 @@ class MockCirculationAPI(CirculationAPI):
     def add_remote_hold(self, *args, **kwargs):
         self.remote_holds.append(HoldInfo(*args, **kwargs))
 
-    def patron_activity(self, patron, pin):
+    def patron_activity(self, patron, pin, collection_ids=None):
         """Return a 3-tuple (loans, holds, completeness)."""
-        return self.remote_loans, self.remote_holds, True
+        loans = self.remote_loans
+        holds = self.remote_holds
+        if collection_ids is not None:
+            loans = [x for x in loans if x.collection_id in collection_ids]
+            holds = [x for x in holds if x.collection_id in collection_ids]
+        return loans, holds, True
 
     def queue_checkout(self, licensepool, response):
         self._queue('checkout', licensepool, response)
@@ -0,0 +1,198 @@
+from nose.tools import set_trace
+from collections import OrderedDict
+import datetime
+import threading
+import time
+
+from core.model import Credential
+
+
+class TokenCache(object):
+    """Keep the bearer tokens used to talk to vendor APIs in memory, so
+    every API object in a process can share them.
+
+    Each token is stored under a key that identifies the credential,
+    such as a collection ID and a token type. A token is refreshed a
+    little before it expires, so requests don't go out with a token
+    that's about to be rejected. Only one thread at a time refreshes
+    any given token; other threads that need it wait for the result
+    rather than asking the vendor for tokens of their own.
+    """
+
+    # Refresh a token when it's this close to expiring.
+    REFRESH_MARGIN = datetime.timedelta(seconds=30)
+
+    # A refresh callable can return this as the expiration date of a
+    # token that must not be kept.
+    DO_NOT_STORE = object()
+
+    def __init__(self, max_size=None):
+        """Constructor.
+
+        :param max_size: If this is set, only this many tokens are
+        kept. The least recently used tokens are dropped first.
+        """
+        self.max_size = max_size
+
+        # Maps each key to a 2-tuple (token, expires), least recently
+        # used first.
+        self.tokens = OrderedDict()
+        self.refresh_locks = {}
+        self.lock = threading.Lock()
+
+        # How often a token was found in the cache, how often one had
+        # to be obtained, and how long that took in total.
+        self.hits = 0
+        self.misses = 0
+        self.refresh_time = 0.0
+
+    def token(self, key, refresh):
+        """Find a usable token for `key`, getting a new one if necessary.
+
+        :param refresh: A callable that takes no arguments and returns
+        a 2-tuple (token, expires). `expires` is None for a token that
+        never expires, and DO_NOT_STORE for a token that may be used
+        this once but not kept.
+        """
+        token = self._usable(key)
+        if token is None:
+            with self._refresh_lock(key):
+                # Another thread may have refreshed the token while we
+                # were waiting for the lock.
+                token = self._usable(key)
+                if token is None:
+                    start = time.time()
+                    try:
+                        token, expires = refresh()
+                    except Exception:
+                        # Nothing was stored under this key, and there
+                        # may never be, so don't keep its lock around.
+                        with self.lock:
+                            self.refresh_locks.pop(key, None)
+                        raise
+                    if expires is self.DO_NOT_STORE:
+                        with self.lock:
+                            self.refresh_locks.pop(key, None)
+                    else:
+                        self.store(key, token, expires)
+                    with self.lock:
+                        self.misses += 1
+                        self.refresh_time += time.time() - start
+                    return token
+        with self.lock:
+            self.hits += 1
+        return token
+
+    def store(self, key, token, expires):
+        with self.lock:
+            self.tokens.pop(key, None)
+            self.tokens[key] = (token, expires)
+            if self.max_size is not None:
+                while len(self.tokens) > self.max_size:
+                    evicted, ignore = self.tokens.popitem(last=False)
+                    self.refresh_locks.pop(evicted, None)
+
+    def stats(self):
+        """Describe how well the cache is working.
+
+        :return: A dictionary with the number of tokens cached, the
+        number of hits and misses, and the average number of seconds
+        it took to obtain a token.
+        """
+        with self.lock:
+            if self.misses:
+                average = self.refresh_time / self.misses
+            else:
+                average = None
+            return dict(
+                size=len(self.tokens), hits=self.hits, misses=self.misses,
+                average_refresh_time=average,
+            )
+
+    def log_stats(self, log, label):
+        """Log how often tokens have been found in the cache.
+
+        :param log: A logging.Logger.
+        :param label: Says what the cache holds, e.g. "Adobe account ID".
+        """
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        if lookups:
+            log.info(
+                "%s cache: %d of %d lookups were hits (%.1f%%), %d cached.",
+                label, stats['hits'], lookups,
+                100.0 * stats['hits'] / lookups, stats['size']
+            )
+
+    def invalidate(self, key, token=None):
+        """Stop using the token stored under `key`.
+
+        :param token: If this is provided, the stored token is only
+        forgotten if it's this token. A request that was rejected
+        with an old token shouldn't throw away a new token some other
+        thread has already obtained.
+        """
+        with self.lock:
+            stored = self.tokens.get(key)
+            if stored and (token is None or stored[0] == token):
+                del self.tokens[key]
+
+    def replace(self, key, rejected_token, refresh):
+        """Get a new token to use instead of one the vendor rejected.
+
+        If several threads have the same token rejected at once, only
+        one of them gets a new token.
+
+        :param refresh: A callable that returns a 2-tuple (token,
+        expires), as with token().
+        """
+        with self._refresh_lock(key):
+            token = self._usable(key)
+            if token is not None and token != rejected_token:
+                # Another thread has already replaced the token.
+                return token
+            token, expires = refresh()
+            self.store(key, token, expires)
+            return token
+
+    def credential_token(self, key, _db, data_source_name, token_type,
+                         refresher_method, patron=None):
+        """Find a usable token that's also stored as a Credential in the
+        database, so that one process can use a token obtained by
+        another.
+
+        The arguments after `key` are passed into Credential.lookup.
+        """
+        def refresh():
+            credential = Credential.lookup(
+                _db, data_source_name, token_type, patron, refresher_method
+            )
+            if (not credential.credential
+                or self.expires_soon(credential.expires)):
+                # Get a new token now rather than waiting for the
+                # vendor to reject the one in the database.
+                refresher_method(credential)
+            return credential.credential, credential.expires
+        return self.token(key, refresh)
+
+    def expires_soon(self, expires):
+        if not expires:
+            return False
+        return expires - self.REFRESH_MARGIN <= datetime.datetime.utcnow()
+
+    def _usable(self, key):
+        with self.lock:
+            stored = self.tokens.pop(key, None)
+            if stored:
+                # Mark this token as the most recently used.
+                self.tokens[key] = stored
+        if not stored:
+            return None
+        token, expires = stored
+        if self.expires_soon(expires):
+            return None
+        return token
+
+    def _refresh_lock(self, key):
+        with self.lock:
+            return self.refresh_locks.setdefault(key, threading.Lock())
@@ -0,0 +1,154 @@
+from nose.tools import set_trace
+import re
+import urlparse
+
+import flask
+from flask import url_for
+
+
+class URLTemplate(object):
+    """A URL for a route, built once by Flask with a placeholder where
+    each argument goes.
+
+    Making another URL for the same route is then a matter of quoting
+    the arguments and pasting them in, which is a lot cheaper than
+    going through Flask's URL building every time.
+
+    The template doesn't include the scheme, host or script root. Those
+    come from the request each URL is made for, so one template serves
+    every host the app is reached through.
+    """
+
+    # Placeholders are made of characters that no route quotes, and
+    # end in a letter so that no placeholder is part of another one.
+    PLACEHOLDER = "URLTEMPLATEPLACEHOLDER%dX"
+    PLACEHOLDER_RE = re.compile("URLTEMPLATEPLACEHOLDER([0-9]+)X")
+
+    def __init__(self, template, converters):
+        """Constructor.
+
+        :param template: The part of a URL built by Flask that comes
+        after the request's URL root, using PLACEHOLDER % i as the
+        value of the ith argument name, in sorted order.
+        :param converters: A dictionary mapping each argument name to
+        the werkzeug converter the route uses to quote its value.
+        """
+        names = sorted(converters.keys())
+        self.converters = converters
+
+        # Like werkzeug's own representation of a rule, this is a list
+        # of 2-tuples (is_dynamic, data). `data` is an argument name
+        # if is_dynamic is True, and a literal string otherwise.
+        self.trace = []
+        pieces = self.PLACEHOLDER_RE.split(template)
+        for i, piece in enumerate(pieces):
+            if i % 2:
+                self.trace.append((True, names[int(piece)]))
+            elif piece:
+                self.trace.append((False, piece))
+
+    @classmethod
+    def build(cls, endpoint, names):
+        """Have Flask build a template for absolute URLs to the given
+        route.
+
+        :param names: The names of the arguments the URLs will be
+        built with.
+        :return: A URLTemplate, or None if URLs for this route
+        can't be made by simple substitution--for instance, because
+        some of the arguments end up in the query string.
+        """
+        names = sorted(names)
+        values = dict(
+            (name, cls.PLACEHOLDER % i) for i, name in enumerate(names)
+        )
+        rule = cls.rule_for(endpoint, values)
+        if rule is None:
+            return None
+        converters = {}
+        for name in names:
+            if name not in rule.arguments:
+                # This argument goes in the query string.
+                return None
+            converters[name] = rule._converters[name]
+
+        template = url_for(endpoint, _external=True, **values)
+        root = flask.request.url_root
+        if not template.startswith(root):
+            return None
+        template = template[len(root):]
+        path = urlparse.urlsplit(template).path
+        for placeholder in values.values():
+            if template.count(placeholder) != 1 or placeholder not in path:
+                return None
+        return cls(template, converters)
+
+    @classmethod
+    def rule_for(cls, endpoint, values):
+        """Find the rule Flask will use to build a URL for `endpoint`
+        from `values`.
+        """
+        for rule in flask.current_app.url_map.iter_rules(endpoint):
+            if rule.suitable_for(values, None):
+                return rule
+        return None
+
+    def expand(self, values):
+        """Make a URL from the template, for the current request.
+
+        :param values: A dictionary with a value for every argument
+        name in the template.
+        """
+        parts = [flask.request.url_root]
+        for is_dynamic, data in self.trace:
+            if is_dynamic:
+                parts.append(self.converters[data].to_url(values[data]))
+            else:
+                parts.append(data)
+        return "".join(parts)
+
+
+class URLTemplateCache(object):
+    """A drop-in replacement for flask.url_for that keeps a URLTemplate
+    for every combination of route and argument names it's asked
+    about.
+
+    Anything a template can't handle is passed along to url_for.
+    """
+
+    def __init__(self):
+        # Maps (endpoint, argument names) to a URLTemplate, or to
+        # None if url_for has to be used. The request's URL root
+        # isn't part of the key, since it comes from the client's
+        # Host header and would let clients fill up the dictionary.
+        self.templates = {}
+
+    def url_for(self, endpoint, **kwargs):
+        # Flask ignores arguments whose value is None.
+        values = dict(
+            (name, value) for name, value in kwargs.items()
+            if name != '_external' and value is not None
+        )
+
+        # Only absolute URLs are made from templates: werkzeug
+        # resolves '.' and '..' in relative URLs, so substituting
+        # into a relative URL wouldn't always give the same result.
+        # Anchors, methods and schemes are also left to url_for.
+        if (kwargs.get('_external')
+            and flask.has_request_context()
+            and not any(name.startswith('_') for name in values)):
+            template = self.template_for(endpoint, frozenset(values.keys()))
+            if template is not None:
+                return template.expand(values)
+        return url_for(endpoint, **kwargs)
+
+    def template_for(self, endpoint, names):
+        """Find or build the URLTemplate for a route.
+
+        :return: A URLTemplate, or None if url_for has to be called
+        instead.
+        """
+        key = (endpoint, names)
+        if key not in self.templates:
+            self.templates[key] = URLTemplate.build(endpoint, names)
+        return self.templates[key]
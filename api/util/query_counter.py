@@ -0,0 +1,34 @@
+from sqlalchemy import event
+
+
+class QueryCounter(object):
+    """Count the SQL statements sent over a database session's
+    connection while a block of code runs.
+
+    Use it as a context manager:
+
+        with QueryCounter(_db) as queries:
+            do_something(_db)
+        print queries.count
+    """
+
+    def __init__(self, _db):
+        self._db = _db
+        self.connection = None
+        self.count = 0
+
+    def __enter__(self):
+        self.connection = self._db.connection()
+        event.listen(
+            self.connection, "before_cursor_execute", self._increment
+        )
+        return self
+
+    def __exit__(self, type, value, traceback):
+        event.remove(
+            self.connection, "before_cursor_execute", self._increment
+        )
+        self.connection = None
+
+    def _increment(self, *args, **kwargs):
+        self.count += 1
@@ -0,0 +1,58 @@
+from cStringIO import StringIO
+
+from lxml import etree
+
+from core.util.xmlparser import XMLParser
+
+
+class StreamingXMLParser(XMLParser):
+    """An XMLParser that can process a document one tag at a time,
+    without ever holding a tree for the whole document in memory.
+
+    This doesn't keep the document itself out of memory. The HTTP
+    helpers in core read the entire response body before returning,
+    so the Axis 360 and Bibliotheca APIs pass the body in as a string.
+    Only a file-like source that reads from the network as it goes
+    would avoid that.
+    """
+
+    def process_all_streaming(self, source, tag, namespaces={},
+                              handler=None):
+        """Call `handler` on every `tag` in a document as soon as it has
+        been read in full.
+
+        Each tag is thrown away once it has been processed, so the
+        memory used by the parsed tags depends on the size of a single
+        tag rather than the size of the document.
+
+        :param source: The document, as a string or a file-like object.
+        A file-like object is read bit by bit as it's parsed.
+        :param tag: The name of the tag to process. A tag in a
+        namespace is named using Clark notation: "{namespace}name".
+        :param namespaces: Passed into `handler` along with each tag.
+        :param handler: Defaults to self.process_one.
+        """
+        if not handler:
+            handler = self.process_one
+        if isinstance(source, unicode):
+            source = source.encode("utf8")
+        if isinstance(source, str):
+            source = StringIO(source)
+        for event, element in etree.iterparse(
+                source, events=("end",), tag=tag, huge_tree=True
+        ):
+            data = handler(element, namespaces)
+            self.discard(element)
+            if data is not None:
+                yield data
+
+    @classmethod
+    def discard(cls, element):
+        """Free the memory used by a processed tag and by any tags
+        that came before it.
+        """
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
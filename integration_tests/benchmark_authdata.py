@@ -0,0 +1,49 @@
+# encoding: utf-8
+"""Time the encoding and decoding of authdata JWTs and short client
+tokens, with and without the cache of verified tokens.
+"""
+import os
+import sys
+import timeit
+
+package_dir = os.path.join(os.path.split(__file__)[0], "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from api.adobe_vendor_id import AuthdataUtility
+
+iterations = 10000
+
+utility = AuthdataUtility(
+    vendor_id="The Vendor ID",
+    library_uri="http://my-library.org/",
+    library_short_name="MyLibrary",
+    secret="My library secret",
+)
+vendor_id, authdata = utility.encode("Patron identifier")
+vendor_id, token = utility.encode_short_client_token("Patron identifier")
+username, password = token.rsplit("|", 1)
+signature = utility.adobe_base64_decode(password)
+
+benchmarks = [
+    ("Encode authdata",
+     lambda: utility.encode("Patron identifier")),
+    ("Decode authdata, verifying the signature",
+     lambda: utility._verify(authdata)),
+    ("Decode authdata, from the cache",
+     lambda: utility.decode(authdata)),
+    ("Encode short client token",
+     lambda: utility.encode_short_client_token("Patron identifier")),
+    ("Decode short client token, verifying the signature",
+     lambda: utility._decode_short_client_token(username, signature)),
+    ("Decode short client token, from the cache",
+     lambda: utility.decode_two_part_short_client_token(username, password)),
+]
+
+# The Authdata.decode() log message would drown out the results.
+utility.log.disabled = True
+
+for name, f in benchmarks:
+    elapsed = timeit.timeit(f, number=iterations)
+    print "%s: %.1f microseconds per call" % (
+        name, elapsed / iterations * 1000000
+    )
@@ -13,6 +13,7 @@ import time
 import urlparse
 import logging
 import argparse
+import multiprocessing
 
 from sqlalchemy import (
     or_,
@@ -28,6 +29,7 @@ from core import log
 from core.lane import Lane
 from core.classifier import Classifier
 from core.model import (
+    CachedFeed,
     CirculationEvent,
     ConfigurationSetting,
     Contribution,
@@ -88,6 +90,7 @@ from api.adobe_vendor_id import (
 )
 from api.lanes import make_lanes
 from api.controller import CirculationManager
+from api.feed_cache import lane_path
 from api.monitor import SearchIndexMonitor
 from api.overdrive import OverdriveAPI
 from api.circulation import CirculationAPI
@@ -311,20 +314,47 @@ class LaneSweeperScript(LibraryInputScript):
         client = self.app.test_client()
         ctx = self.app.test_request_context(base_url=self.base_url)
         ctx.push()
+        for l in self.lanes_to_process(library):
+            self.process_lane(l)
+            self._db.commit()
+        ctx.pop()
+        end = time.time()
+        self.log.info("Entire process took %.2fsec", (end-begin))
+
+    def lanes_to_process(self, library):
+        """Find the library's lanes that should be processed,
+        breadth-first.
+        """
         queue = [self.app.manager.top_level_lanes[library.id]]
         while queue:
             new_queue = []
             self.log.debug("Beginning of loop: %d lanes to process", len(queue))
             for l in queue:
                 if self.should_process_lane(l):
-                    self.process_lane(l)
-                    self._db.commit()
+                    yield l
                 for sublane in l.sublanes:
                     new_queue.append(sublane)
             queue = new_queue
-        ctx.pop()
-        end = time.time()
-        self.log.info("Entire process took %.2fsec", (end-begin))
+
+    @classmethod
+    def lane_key(cls, library, lane):
+        """A string that identifies a lane across processes and runs.
+
+        Lanes aren't database objects, so this is based on the
+        names of the lane and its parents.
+        """
+        return json.dumps([library.short_name] + lane_path(lane))
+
+    def lane_for_key(self, library, key):
+        """Find the lane identified by lane_key()."""
+        names = json.loads(key)[2:]
+        lane = self.app.manager.top_level_lanes[library.id]
+        for name in names:
+            matches = [x for x in lane.sublanes if x.name == name]
+            if not matches:
+                return None
+            lane = matches[0]
+        return lane
 
     def should_process_lane(self, lane):
         return True
@@ -333,10 +363,59 @@ class LaneSweeperScript(LibraryInputScript):
         pass
 
 
+class LaneCheckpoint(object):
+    """A file that keeps track of which lanes have been processed, so
+    an interrupted run can pick up where it left off.
+
+    Each line in the file is the key of one finished lane.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.finished = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.finished = set(x.strip() for x in f if x.strip())
+
+    def record(self, key):
+        """Note that a lane has been processed."""
+        self.finished.add(key)
+        with open(self.path, 'a') as f:
+            f.write(key + "\n")
+
+    def clear(self):
+        """The run is over; the next one should start from scratch."""
+        self.finished = set()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# The script object used by a worker process to process lanes.
+_lane_worker = None
+
+def _initialize_lane_worker(script_class, cmd_args):
+    """Set up a worker process with its own database session and
+    CirculationManager.
+    """
+    global _lane_worker
+    _lane_worker = script_class(cmd_args=cmd_args)
+    _lane_worker.app.test_request_context(
+        base_url=_lane_worker.base_url
+    ).push()
+
+def _process_lane_in_worker(args):
+    library_id, key = args
+    return _lane_worker.process_lane_key(library_id, key)
+
+
 class CacheRepresentationPerLane(LaneSweeperScript):
 
     name = "Cache one representation per lane"
 
+    # The type of CachedFeed generated by this script. If this is set,
+    # the lanes whose feeds are oldest are processed first.
+    cache_type = None
+
     @classmethod
     def arg_parser(cls, _db):
         parser = LaneSweeperScript.arg_parser(_db)
@@ -357,10 +436,22 @@ class CacheRepresentationPerLane(LaneSweeperScript):
             type=int,
             default=1
         )
+        parser.add_argument(
+            '--workers',
+            help='Process lanes in this many worker processes at once.',
+            type=int,
+            default=1
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Keep track of finished lanes in this file, so that an interrupted run can be resumed.',
+            default=None
+        )
         return parser
 
     def __init__(self, _db=None, cmd_args=None, *args, **kwargs):
         super(CacheRepresentationPerLane, self).__init__(_db, *args, **kwargs)
+        self.cmd_args = cmd_args
         self.parse_args(cmd_args)
         
     def parse_args(self, cmd_args=None):
@@ -376,6 +467,9 @@ class CacheRepresentationPerLane(LaneSweeperScript):
                     self.log.warn("Ignored unrecognized language code %s", alpha)
         self.max_depth = parsed.max_depth
         self.min_depth = parsed.min_depth
+        self.workers = parsed.workers
+        self.checkpoint_path = parsed.checkpoint
+        self.lanes_left_over = False
 
         # Return the parsed arguments in case a subclass needs to
         # process more args.
@@ -411,6 +505,140 @@ class CacheRepresentationPerLane(LaneSweeperScript):
         
         return True
 
+    def process_libraries(self, libraries):
+        self.lanes_left_over = False
+        super(CacheRepresentationPerLane, self).process_libraries(libraries)
+        if self.checkpoint_path and not self.lanes_left_over:
+            # Every lane in every library was processed, so there's
+            # nothing to resume.
+            LaneCheckpoint(self.checkpoint_path).clear()
+
+    def process_library(self, library):
+        begin = time.time()
+        ctx = self.app.test_request_context(base_url=self.base_url)
+        ctx.push()
+        checkpoint = None
+        if self.checkpoint_path:
+            checkpoint = LaneCheckpoint(self.checkpoint_path)
+
+        keys = []
+        for lane in self.prioritize_lanes(
+                library, list(self.lanes_to_process(library))
+        ):
+            key = self.lane_key(library, lane)
+            if checkpoint and key in checkpoint.finished:
+                self.log.info("Skipping %s; already processed.", key)
+                continue
+            keys.append(key)
+
+        if self.workers > 1:
+            processed = self.process_in_workers(library, keys)
+        else:
+            processed = self.process_serially(library, keys)
+        finished = 0
+        for key in processed:
+            finished += 1
+            if checkpoint:
+                checkpoint.record(key)
+        if finished < len(keys):
+            self.lanes_left_over = True
+        ctx.pop()
+        end = time.time()
+        self.log.info("Entire process took %.2fsec", (end-begin))
+
+    def process_serially(self, library, keys):
+        """Process lanes in this process.
+
+        :yield: The key of each lane once it's been processed.
+        """
+        for key in keys:
+            self.process_lane_key(library.id, key)
+            yield key
+
+    def process_in_workers(self, library, keys):
+        """Spread lanes across worker processes, each with its own
+        database session.
+
+        :yield: The key of each lane once it's been processed.
+        """
+        # The workers will open their own connections. Close every
+        # connection this process has open before forking, so that no
+        # worker inherits one--a connection used by two processes is
+        # corrupted as soon as either of them uses or closes it.
+        self._db.commit()
+        self._db.get_bind().engine.dispose()
+        pool = self.worker_pool()
+        try:
+            args = [(library.id, key) for key in keys]
+            for key, error in pool.imap_unordered(
+                    _process_lane_in_worker, args
+            ):
+                if error:
+                    self.log.error("Could not process %s: %s", key, error)
+                else:
+                    yield key
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def worker_pool(self):
+        """Start the worker processes.
+
+        :return: A multiprocessing.Pool.
+        """
+        return multiprocessing.Pool(
+            self.workers, initializer=_initialize_lane_worker,
+            initargs=(self.__class__, self.cmd_args)
+        )
+
+    def process_lane_key(self, library_id, key):
+        """Process the lane identified by lane_key().
+
+        :return: A 2-tuple (key, error). `error` is None if the lane
+        was processed, or a description of what went wrong.
+        """
+        library = get_one(self._db, Library, id=library_id)
+        lane = self.lane_for_key(library, key)
+        if lane is None:
+            return key, "No such lane."
+        try:
+            self.process_lane(lane)
+            self._db.commit()
+        except Exception, e:
+            self._db.rollback()
+            self.log.error("Error processing %s", key, exc_info=e)
+            if self.workers > 1:
+                return key, repr(e)
+            raise
+        return key, None
+
+    def prioritize_lanes(self, library, lanes):
+        """Put the lanes whose cached feeds are missing or oldest first.
+
+        Lanes with equally old feeds stay in breadth-first order.
+        """
+        if not self.cache_type:
+            return lanes
+        qu = self._db.query(
+            CachedFeed.lane_name, CachedFeed.languages,
+            func.min(CachedFeed.timestamp)
+        ).filter(
+            CachedFeed.library_id==library.id
+        ).filter(
+            CachedFeed.type==self.cache_type
+        ).group_by(
+            CachedFeed.lane_name, CachedFeed.languages
+        )
+        oldest = dict(((name, languages), timestamp)
+                      for name, languages, timestamp in qu)
+        def feed_age(lane):
+            timestamp = oldest.get((lane.name, lane.language_key))
+            if timestamp is None:
+                return (0, None)
+            return (1, timestamp)
+        return sorted(lanes, key=feed_age)
+
     def cache_url(self, annotator, lane, languages):
         raise NotImplementedError()
 
@@ -443,6 +671,8 @@ class CacheFacetListsPerLane(CacheRepresentationPerLane):
     """Cache the first two pages of every relevant facet list for this lane."""
 
     name = "Cache OPDS feeds"
+
+    cache_type = CachedFeed.PAGE_TYPE
     
     @classmethod
     def arg_parser(cls, _db):
@@ -564,6 +794,8 @@ class CacheOPDSGroupFeedPerLane(CacheRepresentationPerLane):
 
     name = "Cache OPDS group feed for each lane"
 
+    cache_type = CachedFeed.GROUPS_TYPE
+
     def should_process_lane(self, lane):
         # OPDS group feeds are only generated for lanes that have sublanes.
         if not lane.sublanes:
@@ -48,6 +48,7 @@ from core.testing import (
     MockRequestsResponse,
 )
 from core.util.http import HTTP
+from api.util.query_counter import QueryCounter
 from core.util.problem_detail import ProblemDetail
 from core.classifier import (
     genres,
@@ -1257,6 +1258,48 @@ class TestDashboardController(AdminControllerTest):
             eq_(1, vendor_data.get('bibliotheca'))
             eq_(1, vendor_data.get('axis360'))
 
+    def test_stats_uses_few_queries(self):
+        for data_source_name in (DataSource.OVERDRIVE, DataSource.BIBLIOTHECA,
+                                 DataSource.AXIS_360):
+            edition, pool = self._edition(
+                with_license_pool=True, with_open_access_download=False,
+                data_source_name=data_source_name
+            )
+            pool.open_access = False
+            pool.licenses_owned = 1
+
+        with self.app.test_request_context("/"):
+            with QueryCounter(self._db) as queries:
+                self.manager.admin_dashboard_controller.calculate_stats()
+            # One query for patrons, one for the inventory, and one
+            # for the vendors, no matter how many vendors there are.
+            eq_(3, queries.count)
+
+    def test_stats_reused_if_configured(self):
+        controller = self.manager.admin_dashboard_controller
+        with self.app.test_request_context("/"):
+            response = controller.stats()
+            eq_(1, response['patrons']['total'])
+            assert 'as_of' in response
+
+            # By default, statistics are calculated every time.
+            self._patron()
+            eq_(2, controller.stats()['patrons']['total'])
+
+            # But they can be reused for a while.
+            ConfigurationSetting.sitewide(
+                self._db, Configuration.DASHBOARD_STATS_MAX_AGE).value = 3600
+            response = controller.stats()
+            eq_(2, response['patrons']['total'])
+            self._patron()
+            reused = controller.stats()
+            eq_(2, reused['patrons']['total'])
+            eq_(response['as_of'], reused['as_of'])
+
+            # Once they're too old, they're calculated again.
+            controller._stats_calculated -= timedelta(seconds=3601)
+            eq_(3, controller.stats()['patrons']['total'])
+
 class TestSettingsController(AdminControllerTest):
 
     def setup(self):
@@ -63,6 +63,22 @@ class TestSIP2AuthenticationProvider(DatabaseTest):
         integration.setting(p.PORT).value = "1234"
         provider = p(self._default_library, integration, connect=False)
         eq_(1234, provider.client.target_port)
+
+        # The client is the first connection in a pool of connections.
+        pool = provider.client_pool
+        eq_([provider.client], [x for x, last_used in pool.idle])
+        eq_(pool.DEFAULT_MAX_SIZE, pool.max_size)
+
+        # More connections can be created to the same server.
+        client2 = pool.client_factory()
+        assert client2 != provider.client
+        eq_(1234, client2.target_port)
+        eq_("user1", client2.login_user_id)
+
+        # The maximum size of the pool can be configured.
+        integration.setting(p.CONNECTION_POOL_SIZE).value = "10"
+        provider = p(self._default_library, integration, connect=False)
+        eq_(10, provider.client_pool.max_size)
         
     def test_remote_authenticate(self):
         integration = self._external_integration(self._str)
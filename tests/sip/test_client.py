@@ -4,14 +4,80 @@ from nose.tools import (
     eq_,
     set_trace,
     assert_raises,
+    assert_raises_regexp,
 )
 import socket
+import SocketServer
+import threading
+import time
 from api.sip.client import (
     CannotReceiveMockSIPClient,
     CannotSendMockSIPClient,
     MockSIPClient,
+    SIPClient,
+    SIPClientPool,
 )
 
+
+class FakeSIPServer(SocketServer.ThreadingTCPServer):
+    """A very small SIP2 server that runs on localhost.
+
+    It knows how to respond to login, SC status and patron information
+    requests, and keeps track of how many connections it's seen.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    PATRON_INFORMATION = "64              000201610210000142637000000000000000000000000AOnypl |AA12345|AESHELDON, ALICE|BZ0030|CA0050|CB0050|BLY|CQY|BV0|CC15.00|BEfoo@example.com|AY1AZD1B7"
+    ACS_STATUS = "98YYYNYN01000320161021    1426372.00AOnypl |BXYYYYYYYYYYYYYYYY|AY1AZ0000"
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), FakeSIPHandler
+        )
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSIPHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        buf = ""
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            buf += data
+            while '\r' in buf:
+                message, buf = buf.split('\r', 1)
+                code = message[:2]
+                if code == '93':
+                    response = '941'
+                elif code == '99':
+                    response = self.server.ACS_STATUS
+                elif code == '63':
+                    # Take a little time, so that simultaneous
+                    # requests overlap.
+                    time.sleep(0.05)
+                    response = self.server.PATRON_INFORMATION
+                else:
+                    response = '96'
+                self.request.sendall(response + '\r')
+
 class TestBasicProtocol(object):
 
     def test_login_message(self):
@@ -93,6 +159,108 @@ class TestNetworkError(object):
         eq_(expect, sip.status)
 
 
+class TestReadMessage(object):
+
+    class FakeSocket(object):
+        """Hands out canned chunks of data, as if from a socket."""
+        def __init__(self, *chunks):
+            self.chunks = list(chunks)
+
+        def recv(self, size):
+            if not self.chunks:
+                return ""
+            return self.chunks.pop(0)
+
+    def client(self, *chunks):
+        sip = SIPClient('server.com', None, connect=False)
+        sip.socket = self.FakeSocket(*chunks)
+        return sip
+
+    def test_message_split_across_reads(self):
+        sip = self.client("64Y  ", "AOnypl |AA", "12345|AY1AZ0000\r")
+        eq_("64Y  AOnypl |AA12345|AY1AZ0000\r", sip.read_message())
+
+    def test_leftover_data_is_kept(self):
+        sip = self.client("941\r98", "YYY\r", "941\r")
+        eq_("941\r", sip.read_message())
+        eq_("98", sip.read_buffer)
+        eq_("98YYY\r", sip.read_message())
+        eq_("941\r", sip.read_message())
+        eq_("", sip.read_buffer)
+
+        # Reconnecting throws away any leftover data.
+        sip.read_buffer = "leftover"
+        sip.reset_connection_state()
+        eq_("", sip.read_buffer)
+
+    def test_no_data(self):
+        sip = self.client()
+        assert_raises_regexp(
+            IOError, "No data read from socket.", sip.read_message
+        )
+
+        sip = self.client("941")
+        assert_raises_regexp(
+            IOError, "Socket closed in the middle", sip.read_message
+        )
+
+    def test_response_too_large(self):
+        sip = self.client("a" * 10, "a" * 10)
+        assert_raises_regexp(
+            IOError, "SIP2 response too large.", sip.read_message, 15
+        )
+
+    def test_total_timeout(self):
+        class SlowSocket(object):
+            def recv(self, size):
+                time.sleep(0.02)
+                return "a"
+        sip = SIPClient('server.com', None, connect=False, total_timeout=0.05)
+        sip.socket = SlowSocket()
+        assert_raises(socket.timeout, sip.read_message)
+
+    def test_timeouts(self):
+        sip = SIPClient('server.com', None, connect=False)
+        eq_(SIPClient.DEFAULT_CONNECT_TIMEOUT, sip.connect_timeout)
+        eq_(SIPClient.DEFAULT_READ_TIMEOUT, sip.read_timeout)
+        eq_(SIPClient.DEFAULT_TOTAL_TIMEOUT, sip.total_timeout)
+
+        sip = SIPClient('server.com', None, connect=False, connect_timeout=1,
+                        read_timeout=2, total_timeout=3)
+        eq_(1, sip.connect_timeout)
+        eq_(2, sip.read_timeout)
+        eq_(3, sip.total_timeout)
+
+    def test_read_timeout(self):
+        # This server accepts connections but never says anything.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        try:
+            sip = SIPClient(
+                '127.0.0.1', listener.getsockname()[1], read_timeout=0.05
+            )
+            eq_(0.05, sip.socket.gettimeout())
+            assert_raises(socket.timeout, sip.login, 'user', 'pass')
+        finally:
+            listener.close()
+
+    def test_stats(self):
+        sip = MockSIPClient('user_id', 'password')
+        sip.queue_response('941')
+        sip.queue_response(FakeSIPServer.PATRON_INFORMATION)
+        sip.patron_information('patron_identifier')
+
+        login = sip.stats['93']
+        eq_(1, login['requests'])
+        eq_(3, login['bytes_read'])
+        assert login['total_time'] >= login['max_time'] >= 0
+
+        patron = sip.stats['63']
+        eq_(1, patron['requests'])
+        eq_(len(FakeSIPServer.PATRON_INFORMATION), patron['bytes_read'])
+
+
 class TestLogin(object):
        
     def test_login_success(self):
@@ -285,3 +453,137 @@ class TestPatronResponse(object):
                 'too many items billed',
         ]:
             eq_(parsed[no], False)
+
+
+class TestSIPClientPool(object):
+
+    def test_clients_are_reused(self):
+        created = []
+        def factory():
+            client = MockSIPClient()
+            created.append(client)
+            return client
+        pool = SIPClientPool(factory, max_size=2)
+
+        with pool.connection() as client:
+            eq_([client], created)
+        with pool.connection() as client2:
+            eq_(client, client2)
+        eq_(1, pool.size)
+
+    def test_initial_clients(self):
+        client = MockSIPClient()
+        pool = SIPClientPool(clients=[client])
+        eq_(1, pool.size)
+        eq_(client, pool.acquire())
+
+        # Without a client factory, the pool can't create any more
+        # clients, so another request has to wait for the first one.
+        assert_raises(IOError, pool.acquire, 0.01)
+        pool.release(client)
+        eq_(client, pool.acquire())
+
+    def test_maximum_size(self):
+        pool = SIPClientPool(MockSIPClient, max_size=2)
+        c1 = pool.acquire()
+        c2 = pool.acquire()
+        assert c1 != c2
+        eq_(2, pool.size)
+        assert_raises(IOError, pool.acquire, 0.01)
+
+        # Once a client is released, it can be acquired again.
+        pool.release(c2)
+        eq_(c2, pool.acquire(0.01))
+
+    def test_broken_client_is_discarded(self):
+        pool = SIPClientPool(MockSIPClient, max_size=2)
+        try:
+            with pool.connection() as client:
+                raise IOError("Doom!")
+        except IOError:
+            pass
+        eq_(0, pool.size)
+        eq_([], pool.idle)
+
+        # Other exceptions don't mean the connection is broken.
+        try:
+            with pool.connection() as client:
+                raise ValueError()
+        except ValueError:
+            pass
+        eq_([client], [x for x, last_used in pool.idle])
+
+    def test_idle_clients_are_reaped(self):
+        class Client(MockSIPClient):
+            disconnected = False
+            def disconnect(self):
+                self.disconnected = True
+
+        pool = SIPClientPool(Client, max_size=2)
+        old = pool.acquire()
+        pool.release(old)
+        pool.idle = [(old, time.time() - pool.MAX_IDLE_TIME - 1)]
+
+        new = pool.acquire()
+        assert new != old
+        eq_(True, old.disconnected)
+        eq_(1, pool.size)
+
+    def test_health_check(self):
+        pool = SIPClientPool(MockSIPClient, max_size=2)
+        client = pool.acquire()
+        pool.release(client)
+
+        # This client hasn't been used in a while, so it's checked
+        # before being handed out.
+        long_ago = time.time() - pool.HEALTH_CHECK_INTERVAL - 1
+        pool.idle = [(client, long_ago)]
+        client.queue_response(FakeSIPServer.ACS_STATUS)
+        eq_(client, pool.acquire())
+        assert client.requests[-1].startswith("99")
+        pool.release(client)
+
+        # If the check fails, the client is replaced.
+        pool.idle = [(client, long_ago)]
+        client.queue_response("something else")
+        new = pool.acquire()
+        assert new != client
+        eq_(1, pool.size)
+
+    def test_simultaneous_connections_to_server(self):
+        server = FakeSIPServer()
+        try:
+            def factory():
+                return SIPClient(
+                    '127.0.0.1', server.port, login_user_id='user',
+                    login_password='pass'
+                )
+            pool = SIPClientPool(factory, max_size=3)
+
+            results = []
+            def authenticate():
+                with pool.connection() as client:
+                    response = client.patron_information('12345', 'pin')
+                results.append(response['patron_identifier'])
+
+            threads = [threading.Thread(target=authenticate) for i in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Every request succeeded, but no more than three
+            # connections were ever made to the server.
+            eq_(['12345'] * 6, results)
+            assert pool.size <= 3
+            assert server.connections <= 3
+
+            # Each connection logged in separately and has its own
+            # sequence number.
+            for client, last_used in pool.idle:
+                eq_(True, client.logged_in)
+                assert client.sequence_number > 0
+            pool.close()
+            eq_(0, pool.size)
+        finally:
+            server.stop()
@@ -28,6 +28,7 @@ from api.adobe_vendor_id import (
 
 from api.opds import CirculationManagerAnnotator
 from api.testing import VendorIDTest
+from api.util.query_counter import QueryCounter
 
 from core.model import (
     ConfigurationSetting,
@@ -96,6 +97,32 @@ class TestVendorIDModel(VendorIDTest):
         assert u.startswith('urn:uuid:0')
         assert u.endswith('685b35c00f05')
 
+    def test_authdata_utility(self):
+        # By default, an AuthdataUtility is created from the library's
+        # configuration.
+        utility = self.model.authdata_utility(self._default_library)
+        assert isinstance(utility, AuthdataUtility)
+
+        # But the model can be given a function that finds an
+        # AuthdataUtility some other way.
+        libraries = []
+        def authdata_utility(library):
+            libraries.append(library)
+            return utility
+        model = AdobeVendorIDModel(
+            self._db, self._default_library, self.authenticator,
+            TEST_NODE_VALUE, authdata_utility=authdata_utility
+        )
+        eq_(utility, model.authdata_utility(self._default_library))
+        eq_([self._default_library], libraries)
+
+        # That function is used to decode incoming short client tokens.
+        vendor_id, token = utility.encode_short_client_token("patron")
+        token, signature = token.rsplit("|", 1)
+        uuid, label = model.short_client_token_lookup(token, signature)
+        assert uuid.startswith("urn:uuid:0")
+        eq_([self._default_library] * 2, libraries)
+
     def test_uuid_and_label_respects_existing_id(self):
         uuid, label = self.model.uuid_and_label(self.bob_patron)
         uuid2, label2 = self.model.uuid_and_label(self.bob_patron)
@@ -198,6 +225,59 @@ class TestVendorIDModel(VendorIDTest):
         ).all()
         eq_(uuid, dpi.delegated_identifier)
 
+    def test_to_delegated_patron_identifier_uuid_cache(self):
+        foreign_uri = "http://your-library/"
+        foreign_identifier = "foreign ID"
+        lookup = lambda: self.model.to_delegated_patron_identifier_uuid(
+            foreign_uri, foreign_identifier
+        )
+
+        # A brand new DelegatedPatronIdentifier isn't cached, since
+        # it hasn't been committed yet.
+        cache = self.model.delegated_identifiers
+        key = (foreign_uri, foreign_identifier)
+        uuid, label = lookup()
+        eq_(1, cache.misses)
+        eq_(0, cache.stats()['size'])
+
+        # Even though this session can now find it in the database,
+        # it's still not cached, since it could be rolled back. The
+        # cache isn't consulted at all.
+        eq_((uuid, label), lookup())
+        eq_(1, cache.misses)
+        eq_(0, cache.hits)
+        eq_(0, cache.stats()['size'])
+
+        # Once it's committed, it's cached, and no database access is
+        # necessary.
+        self._db.commit()
+        eq_(1, cache.stats()['size'])
+        eq_(uuid, cache._usable(key))
+        eq_({}, self.model.uncommitted_identifiers)
+        with QueryCounter(self._db) as queries:
+            eq_((uuid, label), lookup())
+        eq_(0, queries.count)
+        eq_(1, cache.hits)
+
+    def test_to_delegated_patron_identifier_uuid_not_cached_after_rollback(self):
+        foreign_uri = "http://your-library/"
+        lookup = lambda: self.model.to_delegated_patron_identifier_uuid(
+            foreign_uri, "foreign ID"
+        )
+        uuid, label = lookup()
+        eq_(1, len(self.model.uncommitted_identifiers))
+
+        # Simulate the transaction being rolled back. (Actually
+        # rolling back would undo the test's own setup.)
+        self._db.dispatch.after_rollback(self._db)
+        eq_({}, self.model.uncommitted_identifiers)
+
+        # A later commit doesn't put the identifier in the cache.
+        self._db.commit()
+        eq_(None, self.model.delegated_identifiers._usable(
+            (foreign_uri, "foreign ID")
+        ))
+
     def test_authdata_lookup_delegated_patron_identifier_success(self):
         """Test that one library can perform an authdata lookup on a JWT
         generated by a different library.
@@ -894,6 +974,41 @@ class TestAuthdataUtility(VendorIDTest):
             self.authdata.decode_short_client_token, token
         )
 
+    def test_verified_tokens_are_cached(self):
+        vendor_id, token = self.authdata.encode_short_client_token("a patron")
+        vendor_id, authdata = self.authdata.encode("a patron")
+        expect = (self.authdata.library_uri, "a patron")
+        eq_(expect, self.authdata.decode_short_client_token(token))
+        eq_(expect, self.authdata.decode(authdata))
+
+        # Tokens that have been verified once aren't verified again,
+        # so they can still be decoded even if the secret changes.
+        self.authdata.secrets_by_library_uri[self.authdata.library_uri] = (
+            "A new secret"
+        )
+        eq_(expect, self.authdata.decode_short_client_token(token))
+        eq_(expect, self.authdata.decode(authdata))
+        eq_(2, self.authdata.verified_tokens.hits)
+
+        # But a token that's about to expire is verified every time.
+        expires = self.authdata.numericdate(
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=10)
+        )
+        self.authdata.secrets_by_library_uri[self.authdata.library_uri] = (
+            self.authdata.secret
+        )
+        token = self.authdata._encode_short_client_token(
+            self.authdata.short_name, "a patron", expires
+        )
+        eq_(expect, self.authdata.decode_short_client_token(token))
+        self.authdata.secrets_by_library_uri[self.authdata.library_uri] = (
+            "A new secret"
+        )
+        assert_raises_regexp(
+            ValueError, "Invalid signature for",
+            self.authdata.decode_short_client_token, token
+        )
+
     def test_decode_client_token_errors(self):
         """Test various token errors"""
         m = self.authdata._decode_short_client_token
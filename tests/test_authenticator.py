@@ -16,6 +16,7 @@ from money import Money
 import re
 import urllib
 import urlparse
+import time
 import flask
 from flask import url_for
 
@@ -50,6 +51,7 @@ from api.authenticator import (
     LibraryAuthenticator,
     AuthenticationProvider,
     BasicAuthenticationProvider,
+    CredentialCache,
     OAuthController,
     OAuthAuthenticationProvider,
     PatronData,
@@ -1645,6 +1647,55 @@ class TestBasicAuthenticationProviderAuthenticate(AuthenticatorTest):
             self._db, dict(username="food", password="barbecue"))
         )
 
+    def test_credential_cache(self):
+        patron = self._patron()
+        patrondata = PatronData(permanent_id=patron.external_identifier)
+
+        # By default, there is no credential cache and every request
+        # goes to the source of truth.
+        provider = self.mock_basic(patrondata=patrondata)
+        eq_(None, provider.credential_cache)
+
+        integration = self._external_integration(self._str)
+        integration.setting(MockBasic.CREDENTIAL_CACHE_TIME).value = 60
+        provider = MockBasic(
+            self._default_library, integration, patrondata=patrondata
+        )
+        eq_(60, provider.credential_cache.ttl)
+
+        class Counter(object):
+            calls = 0
+        counter = Counter()
+        original = provider.remote_authenticate
+        def remote_authenticate(username, password):
+            counter.calls += 1
+            return original(username, password)
+        provider.remote_authenticate = remote_authenticate
+
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(1, counter.calls)
+
+        # The second time, the source of truth isn't consulted.
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(1, counter.calls)
+
+        # A different password for the same username is checked with
+        # the source of truth, which rejects it. That removes the
+        # username from the cache.
+        provider.patrondata = None
+        eq_(None, provider.authenticate(
+            self._db, dict(username="user", password="wrong"))
+        )
+        eq_(2, counter.calls)
+        eq_(None, provider.authenticate(self._db, self.credentials))
+        eq_(3, counter.calls)
+
+        # The cache never holds the password itself.
+        provider.patrondata = patrondata
+        provider.authenticate(self._db, self.credentials)
+        [entry] = provider.credential_cache.entries.values()
+        assert self.credentials['password'] not in entry
+
     def test_authentication_succeeds_but_patronlookup_fails(self):
         """This case should never happen--it indicates a malfunctioning 
         authentication provider. But we handle it.
@@ -2073,3 +2124,41 @@ class TestOAuthController(AuthenticatorTest):
         eq_(None, fragments.get('access_token'))
         error = json.loads(fragments.get('error')[0])
         eq_(UNKNOWN_OAUTH_PROVIDER.uri, error.get('type'))
+
+
+class TestCredentialCache(object):
+
+    def test_lookup(self):
+        cache = CredentialCache(60)
+        now = time.time()
+        cache.store(1, "user", "pass", 100, now=now)
+
+        eq_(100, cache.lookup(1, "user", "pass", now=now))
+        eq_(100, cache.lookup(1, "user", "pass", now=now+59))
+
+        # A different password, username, or library doesn't match.
+        eq_(None, cache.lookup(1, "user", "wrong", now=now))
+        eq_(None, cache.lookup(1, "other", "pass", now=now))
+        eq_(None, cache.lookup(2, "user", "pass", now=now))
+
+        # Once the entry expires, it's removed.
+        eq_(None, cache.lookup(1, "user", "pass", now=now+61))
+        eq_({}, cache.entries)
+
+    def test_remove(self):
+        cache = CredentialCache(60)
+        cache.store(1, "user", "pass", 100)
+        cache.remove(1, "user")
+        eq_(None, cache.lookup(1, "user", "pass"))
+
+        # Removing an entry that isn't there is fine.
+        cache.remove(1, "user")
+
+    def test_store_prunes_expired_entries(self):
+        cache = CredentialCache(60)
+        cache.MAX_ENTRIES = 2
+        now = time.time()
+        cache.store(1, "a", "pass", 1, now=now)
+        cache.store(1, "b", "pass", 2, now=now+30)
+        cache.store(1, "c", "pass", 3, now=now+70)
+        eq_(set([(1, "b"), (1, "c")]), set(cache.entries.keys()))
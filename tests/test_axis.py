@@ -10,6 +10,7 @@ from nose.tools import (
 
 from core.model import (
     ConfigurationSetting,
+    CoverageRecord,
     DataSource,
     Edition,
     ExternalIntegration,
@@ -274,6 +275,98 @@ class TestCirculationMonitor(Axis360Test):
         eq_(9, licensepool.licenses_owned)
 
 
+    def test_process_batch(self):
+        monitor = Axis360CirculationMonitor(
+            self._db, self.collection, api_class=MockAxis360API,
+            metadata_client=MockMetadataWranglerOPDSLookup('url')
+        )
+        other_identifier = IdentifierData(
+            type=Identifier.AXIS_360_ID, identifier=u'0012164897'
+        )
+        other_bibliographic = Metadata(
+            DataSource.AXIS_360, title=u"Another Book",
+            primary_identifier=other_identifier
+        )
+        other_availability = CirculationData(
+            data_source=DataSource.AXIS_360,
+            primary_identifier=other_identifier,
+            licenses_owned=1, licenses_available=1,
+        )
+        batch = [
+            (self.BIBLIOGRAPHIC_DATA, self.AVAILABILITY_DATA),
+            (other_bibliographic, other_availability),
+        ]
+        [(edition1, pool1), (edition2, pool2)] = monitor.process_batch(batch)
+        eq_(u'0003642860', pool1.identifier.identifier)
+        eq_(u'0012164897', pool2.identifier.identifier)
+        eq_(u"Another Book", edition2.title)
+
+        # Both books got a CoverageRecord.
+        def axis_records(pool):
+            return [x for x in pool.identifier.coverage_records
+                    if x.data_source.name == DataSource.AXIS_360
+                    and x.operation is None]
+        [record1] = axis_records(pool1)
+        [record2] = axis_records(pool2)
+
+        # The LicensePools and Editions that now exist are found with
+        # a bulk lookup.
+        pools, editions = monitor.existing_records(
+            [self.BIBLIOGRAPHIC_DATA, other_bibliographic]
+        )
+        eq_(dict([(u'0003642860', pool1), (u'0012164897', pool2)]), pools)
+        eq_(dict([(u'0003642860', edition1), (u'0012164897', edition2)]),
+            editions)
+
+        # Processing the batch again updates the existing objects
+        # rather than creating new ones.
+        other_availability.licenses_owned = 5
+        [(e1, p1), (e2, p2)] = monitor.process_batch(batch)
+        eq_((edition1, pool1, edition2, pool2), (e1, p1, e2, p2))
+        eq_(5, pool2.licenses_owned)
+        eq_([record1], axis_records(pool1))
+        eq_([record2], axis_records(pool2))
+
+    def test_add_coverage_records_for(self):
+        monitor = Axis360CirculationMonitor(
+            self._db, self.collection, api_class=MockAxis360API,
+            metadata_client=MockMetadataWranglerOPDSLookup('url')
+        )
+        axis = DataSource.lookup(self._db, DataSource.AXIS_360)
+        covered = self._identifier()
+        uncovered = self._identifier()
+
+        # One of the Identifiers has a failed CoverageRecord.
+        failure = self._coverage_record(
+            covered, axis, status=CoverageRecord.TRANSIENT_FAILURE
+        )
+        failure.exception = "oops"
+
+        monitor.add_coverage_records_for([covered, uncovered])
+
+        # The failure was turned into a success.
+        eq_(CoverageRecord.SUCCESS, failure.status)
+        eq_(None, failure.exception)
+
+        # A new record was created for the other Identifier.
+        [record] = uncovered.coverage_records
+        eq_(axis, record.data_source)
+        eq_(None, record.operation)
+        eq_(CoverageRecord.SUCCESS, record.status)
+        provider = monitor.bibliographic_coverage_provider
+        eq_(provider.collection_or_not, record.collection)
+
+        # If the provider's coverage only counts for its own
+        # Collection, the records are tied to that Collection.
+        provider.COVERAGE_COUNTS_FOR_EVERY_COLLECTION = False
+        eq_(self.collection, provider.collection_or_not)
+        other = self._identifier()
+        monitor.add_coverage_records_for([other])
+        [record] = other.coverage_records
+        eq_(self.collection, record.collection)
+        eq_(CoverageRecord.SUCCESS, record.status)
+
+
 class TestReaper(Axis360Test):
 
     def test_instantiate(self):
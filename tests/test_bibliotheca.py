@@ -3,7 +3,9 @@ from nose.tools import (
     set_trace, 
     eq_,
     assert_raises,
+    assert_raises_regexp,
 )
+from StringIO import StringIO
 import datetime
 import os
 import pkgutil
@@ -15,6 +17,7 @@ from . import (
 
 from core.mock_analytics_provider import MockAnalyticsProvider
 from core.model import (
+    get_one,
     CirculationEvent,
     Collection,
     Contributor,
@@ -271,6 +274,55 @@ class TestBibliothecaCirculationSweep(BibliothecaAPITest):
         ]),
             sorted(types))
 
+    def test_process_items_uses_existing_pools(self):
+        # One book is mentioned by Bibliotheca; the other isn't.
+        mentioned = self._edition(
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_id="d5rf89", with_license_pool=True,
+            collection=self.collection
+        )[1]
+        gone = self._edition(
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            data_source_name=DataSource.BIBLIOTHECA,
+            with_license_pool=True, collection=self.collection
+        )[1]
+        gone.licenses_owned = 5
+        gone.licenses_available = 5
+
+        monitor = BibliothecaCirculationSweep(
+            self._db, self.collection, api_class=self.api
+        )
+        pools = monitor.license_pools_for(
+            [mentioned.identifier, gone.identifier]
+        )
+        eq_({mentioned.identifier.id: mentioned, gone.identifier.id: gone},
+            pools)
+
+        self.api.queue_response(
+            200, content=self.sample_data("item_circulation_single.xml")
+        )
+        monitor.process_items([mentioned.identifier, gone.identifier])
+
+        # No new LicensePools were created.
+        eq_([mentioned], mentioned.identifier.licensed_through)
+        eq_(1, mentioned.licenses_owned)
+
+        # The book Bibliotheca didn't mention was taken out of
+        # circulation.
+        eq_(0, gone.licenses_owned)
+        eq_(0, gone.licenses_available)
+
+    def test_get_circulation_for_splits_large_batches(self):
+        self.api.MAX_CIRCULATION_ITEMS_PER_REQUEST = 1
+        data = self.sample_data("item_circulation_single.xml")
+        self.api.queue_response(200, content=data)
+        self.api.queue_response(200, content=data)
+        circs = list(self.api.get_circulation_for(["a", "b"]))
+        eq_(2, len(circs))
+        eq_(2, len(self.api.requests))
+
+
 
 # Tests of the various parser classes.
 #
@@ -485,6 +537,12 @@ class Test3MEventParser(object):
         eq_(correct_start, start_time)
         eq_(correct_end, end_time)
 
+    def test_parse_file_like_object(self):
+        # The parser can read events from a stream such as an HTTP
+        # response body, rather than a string.
+        events = EventParser().process_all(StringIO(self.TWO_EVENTS))
+        eq_(["theitem1", "theitem2"], [x[0] for x in events])
+
 
 class Test3MCirculationParser(object):
 
@@ -705,6 +763,64 @@ class TestBibliothecaEventMonitor(BibliothecaAPITest):
         eq_(new_timestamp, yesterday)
 
 
+    def test_run_once_prefetches_slices(self):
+        class Mock(BibliothecaEventMonitor):
+            fail_on = None
+            def __init__(self, *args, **kwargs):
+                super(Mock, self).__init__(*args, **kwargs)
+                self.fetched = []
+                self.handled = []
+            def _fetch_and_parse_events(self, start, cutoff):
+                self.fetched.append(start)
+                event_time = start + datetime.timedelta(hours=1)
+                return [("id", "isbn", None, event_time, None, "event")]
+            def handle_event(self, bibliotheca_id, isbn, foreign_patron_id,
+                             start_time, end_time, internal_event_type):
+                if start_time == self.fail_on:
+                    raise Exception("oops")
+                self.handled.append(start_time)
+                return start_time
+
+        monitor = Mock(
+            self._db, self.collection, api_class=MockBibliothecaAPI,
+            prefetch_slices=2
+        )
+        start = datetime.datetime(2016, 1, 1)
+        cutoff = start + datetime.timedelta(days=3)
+        new_timestamp = monitor.run_once(start, cutoff)
+
+        # Every day was fetched in the background, and the events
+        # were handled in order.
+        days = [start + datetime.timedelta(days=x) for x in range(3)]
+        eq_(days, sorted(monitor.fetched))
+        expect = [day + datetime.timedelta(hours=1) for day in days]
+        eq_(expect, monitor.handled)
+        eq_(expect[-1], new_timestamp)
+
+        # Progress was recorded after each day.
+        timestamp = get_one(
+            self._db, Timestamp, service=monitor.service_name,
+            collection=self.collection
+        )
+        eq_(expect[-1], timestamp.timestamp)
+
+        # If handling the third day's events fails, the recorded
+        # progress reflects the first two days.
+        monitor = Mock(
+            self._db, self.collection, api_class=MockBibliothecaAPI,
+            prefetch_slices=2
+        )
+        monitor.fail_on = expect[2]
+        assert_raises_regexp(
+            Exception, "oops", monitor.run_once, start, cutoff
+        )
+        eq_(expect[:2], monitor.handled)
+        timestamp = get_one(
+            self._db, Timestamp, service=monitor.service_name,
+            collection=self.collection
+        )
+        eq_(expect[1], timestamp.timestamp)
+
     def test_handle_event(self):
         api = MockBibliothecaAPI(self._db, self.collection)
         api.queue_response(
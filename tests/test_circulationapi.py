@@ -15,13 +15,18 @@ from datetime import (
     datetime, 
     timedelta,
 )
+from threading import Event
+import time
 
 from api.circulation_exceptions import *
 from api.circulation import (
+    BaseCirculationAPI,
+    BookshelfSyncCache,
     CirculationAPI,
     FulfillmentInfo,
     LoanInfo,
     HoldInfo,
+    PatronActivityPool,
 )
 
 from core.config import CannotLoadConfiguration
@@ -42,6 +47,7 @@ from core.mock_analytics_provider import MockAnalyticsProvider
 from . import DatabaseTest, sample_data
 from api.testing import MockCirculationAPI
 from api.bibliotheca import MockBibliothecaAPI
+from api.util.query_counter import QueryCounter
 
 
 class TestCirculationAPI(DatabaseTest):
@@ -591,7 +597,7 @@ class TestCirculationAPI(DatabaseTest):
         loan.start = self.YESTERDAY
 
         class IncompleteCirculationAPI(MockCirculationAPI):
-            def patron_activity(self, patron, pin):
+            def patron_activity(self, patron, pin, collection_ids=None):
                 # A remote API failed, and we don't know if
                 # the patron has any loans or holds.
                 return [], [], False
@@ -608,7 +614,7 @@ class TestCirculationAPI(DatabaseTest):
         eq_([loan], loans)
 
         class CompleteCirculationAPI(MockCirculationAPI):
-            def patron_activity(self, patron, pin):
+            def patron_activity(self, patron, pin, collection_ids=None):
                 # All the remote API calls succeeded, so
                 # now we know the patron has no loans.
                 return [], [], True
@@ -664,6 +670,209 @@ class TestCirculationAPI(DatabaseTest):
         eq_(self.IN_TWO_WEEKS, hold.end)
         eq_(0, hold.position)
         
+    def test_sync_bookshelf_creates_loans_and_holds(self):
+        pools = [self.pool]
+        for i in range(3):
+            edition, pool = self._edition(
+                data_source_name=DataSource.BIBLIOTHECA,
+                identifier_type=Identifier.BIBLIOTHECA_ID,
+                with_license_pool=True, collection=self.collection
+            )
+            pools.append(pool)
+        for pool in pools[:2]:
+            self.circulation.add_remote_loan(
+                pool.collection, pool.data_source, pool.identifier.type,
+                pool.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS
+            )
+        for pool in pools[2:]:
+            self.circulation.add_remote_hold(
+                pool.collection, pool.data_source, pool.identifier.type,
+                pool.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS, 3
+            )
+
+        # The remote mentions a book we've never heard of.
+        self.circulation.add_remote_loan(
+            self.collection, DataSource.BIBLIOTHECA, Identifier.BIBLIOTHECA_ID,
+            "new-identifier", self.TODAY, self.IN_TWO_WEEKS
+        )
+
+        loans, holds = self.sync_bookshelf()
+
+        # Every remote loan and hold now has a local counterpart.
+        eq_(set(pools[:2]),
+            set([x.license_pool for x in self._db.query(Loan)
+                 if x.license_pool.identifier.identifier != "new-identifier"]))
+        eq_(set(pools[2:]), set([x.license_pool for x in self._db.query(Hold)]))
+        for hold in holds:
+            eq_(3, hold.position)
+
+        # A LicensePool was created for the book we'd never heard of.
+        [new_loan] = [x for x in loans
+                      if x.license_pool.identifier.identifier == "new-identifier"]
+        eq_(self.collection, new_loan.license_pool.collection)
+        eq_(3, len(loans))
+
+        # Syncing again changes nothing.
+        loans2, holds2 = self.sync_bookshelf()
+        eq_(set(loans), set(loans2))
+        eq_(set(holds), set(holds2))
+        eq_(3, self._db.query(Loan).count())
+        eq_(2, self._db.query(Hold).count())
+
+    def test_sync_bookshelf_query_count_does_not_grow_with_bookshelf(self):
+        def sync_with_queries(how_many):
+            """Give a new patron `how_many` loans and holds, then sync
+            their bookshelf again and count the queries.
+            """
+            patron = self._patron()
+            circulation = MockCirculationAPI(
+                self._db, self._default_library, api_map = {
+                    ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI
+                }
+            )
+            for i in range(how_many):
+                for add in (circulation.add_remote_loan,
+                            circulation.add_remote_hold):
+                    edition, pool = self._edition(
+                        data_source_name=DataSource.BIBLIOTHECA,
+                        identifier_type=Identifier.BIBLIOTHECA_ID,
+                        with_license_pool=True, collection=self.collection
+                    )
+                    args = [pool.collection, pool.data_source,
+                            pool.identifier.type, pool.identifier.identifier,
+                            self.TODAY, self.IN_TWO_WEEKS]
+                    if add == circulation.add_remote_hold:
+                        args.append(1)
+                    add(*args)
+
+            # The first sync creates the local loans and holds.
+            loans, holds = circulation.sync_bookshelf(patron, "1234")
+            eq_(how_many, len(loans))
+            eq_(how_many, len(holds))
+            self._db.commit()
+
+            with QueryCounter(self._db) as queries:
+                loans, holds = circulation.sync_bookshelf(patron, "1234")
+            eq_(how_many, len(loans))
+            eq_(how_many, len(holds))
+            return queries.count
+
+        # Once the loans and holds exist locally, keeping them in sync
+        # takes the same number of queries no matter how many there
+        # are.
+        eq_(sync_with_queries(1), sync_with_queries(5))
+
+    def test_sync_bookshelf_limited_to_collections(self):
+        # The patron has an old loan from our collection, which the
+        # remote doesn't know about.
+        loan, ignore = self.pool.loan_to(self.patron)
+        loan.start = self.YESTERDAY
+
+        # Syncing some other collection leaves that loan alone.
+        other = self._collection()
+        loans, holds = self.circulation.sync_bookshelf(
+            self.patron, "1234", collection_ids=[other.id]
+        )
+        eq_([], loans)
+        eq_([loan], self._db.query(Loan).all())
+
+        # Syncing our collection deletes it.
+        self.circulation.sync_bookshelf(
+            self.patron, "1234", collection_ids=[self.collection.id]
+        )
+        eq_([], self._db.query(Loan).all())
+
+    def test_patron_activity_limited_to_collections(self):
+        circulation = CirculationAPI(
+            self._db, self._default_library, api_map={
+            ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI
+        })
+        class RecordingAPI(object):
+            called = False
+            def patron_activity(self, patron, pin):
+                self.called = True
+                return []
+        api = RecordingAPI()
+        circulation.api_for_collection[self.collection.id] = api
+
+        # If the Bibliotheca collection isn't one of the ones we're
+        # interested in, it's not asked about the patron's activity.
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234", collection_ids=[]
+        )
+        eq_(([], [], True), (loans, holds, complete))
+        eq_(False, api.called)
+
+        # If it is, it is.
+        circulation.patron_activity(
+            self.patron, "1234", collection_ids=[self.collection.id]
+        )
+        eq_(True, api.called)
+
+    def test_sync_bookshelf_uses_cache(self):
+        class CountingCirculationAPI(MockCirculationAPI):
+            calls = 0
+            def patron_activity(self, patron, pin, collection_ids=None):
+                self.calls += 1
+                return super(CountingCirculationAPI, self).patron_activity(
+                    patron, pin, collection_ids
+                )
+        circulation = CountingCirculationAPI(
+            self._db, self._default_library,
+            api_map={ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI})
+        eq_(CirculationAPI.DEFAULT_BOOKSHELF_SYNC_FRESHNESS,
+            circulation.bookshelf_sync_cache.freshness)
+        circulation.add_remote_loan(
+            self.pool.collection, self.pool.data_source, self.identifier.type,
+            self.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS
+        )
+
+        # The first sync goes to the remote APIs.
+        loans, holds = circulation.sync_bookshelf(
+            self.patron, "1234", use_cache=True
+        )
+        eq_(1, circulation.calls)
+        eq_([self.pool], [x.license_pool for x in loans])
+
+        # The second sync is served from the database, since the
+        # bookshelf is still fresh.
+        loans, holds = circulation.sync_bookshelf(
+            self.patron, "1234", use_cache=True
+        )
+        eq_(1, circulation.calls)
+        eq_([self.pool], [x.license_pool for x in loans])
+
+        # A sync that doesn't use the cache always goes to the remote APIs.
+        circulation.sync_bookshelf(self.patron, "1234")
+        eq_(2, circulation.calls)
+
+        # Revoking a loan invalidates the cache.
+        circulation.queue_checkin(self.pool, True)
+        circulation.revoke_loan(self.patron, "1234", self.pool)
+        circulation.sync_bookshelf(self.patron, "1234", use_cache=True)
+        eq_(3, circulation.calls)
+
+        # If another thread is syncing the bookshelf and doesn't
+        # finish in time, we stop waiting and sync it ourselves.
+        circulation.bookshelf_sync_cache.invalidate(
+            self.patron, self.collection.id
+        )
+        leader, in_progress = circulation.bookshelf_sync_cache.start_sync(
+            self.patron
+        )
+        eq_(True, leader)
+        circulation.BOOKSHELF_SYNC_WAIT_TIMEOUT = 0.01
+        loans, holds = circulation.sync_bookshelf(
+            self.patron, "1234", use_cache=True
+        )
+        eq_(4, circulation.calls)
+        eq_([self.pool], [x.license_pool for x in loans])
+
+        # The other thread is still considered to be in charge of
+        # the sync.
+        eq_(False, in_progress.is_set())
+        circulation.bookshelf_sync_cache.finish_sync(self.patron)
+
     def test_patron_activity(self):
         # Get a CirculationAPI that doesn't mock out its API's patron activity.
         circulation = CirculationAPI(
@@ -686,7 +895,196 @@ class TestCirculationAPI(DatabaseTest):
         eq_(0, len(loans))
         eq_(0, len(holds))
         eq_(False, complete)        
-        
+
+    def test_patron_activity_gives_up_on_slow_api(self):
+        pool = PatronActivityPool(size=2)
+        circulation = CirculationAPI(
+            self._db, self._default_library, api_map={
+            ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI
+        }, patron_activity_pool=pool)
+        eq_(pool, circulation.patron_activity_pool)
+
+        # By default, we're willing to wait a while for the API.
+        eq_(CirculationAPI.DEFAULT_PATRON_ACTIVITY_TIMEOUT,
+            circulation.patron_activity_timeout_for_collection[
+                self.collection.id
+            ])
+
+        finished = Event()
+        class SlowAPI(object):
+            def patron_activity(self, patron, pin):
+                finished.wait(5)
+                return []
+        circulation.api_for_collection[self.collection.id] = SlowAPI()
+        circulation.patron_activity_timeout_for_collection[
+            self.collection.id] = 0.1
+
+        # The API didn't answer in time, so we don't have a complete
+        # picture of the patron's activity.
+        loans, holds, complete = circulation.patron_activity(self.patron, "1234")
+        eq_([], loans)
+        eq_([], holds)
+        eq_(False, complete)
+        finished.set()
+
+    def test_patron_activity_timeout(self):
+        circulation = CirculationAPI(
+            self._db, self._default_library, api_map={
+            ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI
+        })
+        # The process-wide pool is used if no other pool is specified.
+        eq_(PatronActivityPool.shared(), circulation.patron_activity_pool)
+
+        self.collection.external_integration.setting(
+            BaseCirculationAPI.PATRON_ACTIVITY_TIMEOUT
+        ).value = 3
+        eq_(3, circulation.patron_activity_timeout(self.collection))
+
+
+class TestPatronActivityPool(object):
+
+    class BlockingAPI(object):
+        """Doesn't answer until it's told to."""
+        def __init__(self):
+            self.answer = Event()
+            self.calls = 0
+
+        def patron_activity(self, patron, pin):
+            self.calls += 1
+            self.answer.wait(5)
+            return []
+
+    def test_full_pool_fails_fast(self):
+        pool = PatronActivityPool(size=1, queue_size=1)
+        api = self.BlockingAPI()
+
+        # The first task ties up the only worker, and the second one
+        # takes the only place in the queue.
+        busy = pool.submit(api, None, None)
+        while not api.calls:
+            time.sleep(0.01)
+        queued = pool.submit(api, None, None)
+
+        # There's no room for a third task, so it fails immediately.
+        rejected = pool.submit(api, None, None)
+        eq_(True, rejected.finished)
+        assert isinstance(rejected.exception, PatronActivityPoolFull)
+
+        api.answer.set()
+        eq_(True, busy.wait(5))
+        eq_(True, queued.wait(5))
+        eq_(None, queued.exception)
+
+    def test_task_past_deadline_is_not_run(self):
+        pool = PatronActivityPool(size=1)
+        api = self.BlockingAPI()
+        api.answer.set()
+        task = pool.submit(api, None, None, deadline=time.time() - 1)
+        eq_(True, task.wait(5))
+        eq_(0, api.calls)
+        assert task.exception is not None
+
+    def test_worker_session_is_cleaned_up(self):
+        class MockScopedSession(object):
+            def __init__(self):
+                self.calls = []
+                self.done = Event()
+            def commit(self):
+                self.calls.append("commit")
+            def rollback(self):
+                self.calls.append("rollback")
+            def remove(self):
+                self.calls.append("remove")
+                self.done.set()
+
+        class MockAPI(object):
+            def __init__(self, exception=None):
+                self._db = MockScopedSession()
+                self.exception = exception
+            def patron_activity(self, patron, pin):
+                if self.exception:
+                    raise self.exception
+                return []
+
+        pool = PatronActivityPool(size=1)
+
+        # After a task runs, the worker commits its work and gives
+        # back its session.
+        api = MockAPI()
+        pool.submit(api, None, None)
+        api._db.done.wait(5)
+        eq_(["commit", "remove"], api._db.calls)
+
+        # That happens even if the task failed.
+        api = MockAPI(Exception("oops"))
+        task = pool.submit(api, None, None)
+        api._db.done.wait(5)
+        eq_(["commit", "remove"], api._db.calls)
+        eq_("oops", task.exception.message)
+
+    def test_shared(self):
+        eq_(PatronActivityPool.shared(), PatronActivityPool.shared())
+
+    def test_size(self):
+        pool = PatronActivityPool(size=3)
+        eq_(3, len(pool.workers))
+        eq_(3 * PatronActivityPool.DEFAULT_QUEUE_SIZE_PER_WORKER,
+            pool.queue_size)
+
+        pool = PatronActivityPool()
+        eq_(PatronActivityPool.DEFAULT_SIZE, len(pool.workers))
+
+
+class TestBookshelfSyncCache(DatabaseTest):
+
+    def test_freshness(self):
+        patron = self._patron()
+        cache = BookshelfSyncCache(60)
+        eq_(False, cache.is_fresh(patron, [1, 2]))
+
+        now = time.time()
+        cache.record_sync(patron, [1, 2], now)
+        eq_(True, cache.is_fresh(patron, [1, 2]))
+        eq_(False, cache.is_fresh(patron, [1, 2, 3]))
+        eq_(False, cache.is_fresh(patron, [1], now=now+61))
+
+        cache.invalidate(patron, 2)
+        eq_(True, cache.is_fresh(patron, [1]))
+        eq_(False, cache.is_fresh(patron, [1, 2]))
+
+        # A sync that started before the invalidation doesn't make the
+        # collection fresh again.
+        cache.record_sync(patron, [2], now)
+        eq_(False, cache.is_fresh(patron, [2]))
+
+        # But a sync that started afterwards does.
+        cache.record_sync(patron, [2], time.time() + 1)
+        eq_(True, cache.is_fresh(patron, [2]))
+
+        # A cache with no freshness window never considers anything fresh.
+        cache = BookshelfSyncCache(0)
+        cache.record_sync(patron, [1], now)
+        eq_(False, cache.is_fresh(patron, [1]))
+
+    def test_single_flight(self):
+        patron = self._patron()
+        cache = BookshelfSyncCache(60)
+        leader, event = cache.start_sync(patron)
+        eq_(True, leader)
+
+        # A second caller is told to wait for the first.
+        leader2, event2 = cache.start_sync(patron)
+        eq_(False, leader2)
+        eq_(event, event2)
+        eq_(False, event.is_set())
+
+        cache.finish_sync(patron)
+        eq_(True, event.is_set())
+
+        # Now a new sync can start.
+        leader, event = cache.start_sync(patron)
+        eq_(True, leader)
+
 
 class TestConfigurationFailures(DatabaseTest):
 
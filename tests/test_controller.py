@@ -350,10 +350,32 @@ class TestCirculationManager(CirculationControllerTest):
         assert isinstance(manager.adobe_device_management,
                           DeviceManagementProtocolController)
 
+        # The new library's AuthdataUtility was created, and will be
+        # reused until the configuration is reloaded again.
+        utility = manager.authdata_utilities[library.id]
+        assert isinstance(utility, AuthdataUtility)
+        eq_(utility, manager.authdata_utility(library))
+        manager.load_settings()
+        assert utility != manager.authdata_utility(library)
+
         # Controllers that don't depend on site configuration
         # have not been reloaded.
         eq_(index_controller, manager.index_controller)
 
+    def test_authdata_utility(self):
+        # The default library has no Short Client Token configuration.
+        eq_(None, self.manager.authdata_utilities[self._default_library.id])
+        eq_(None, self.manager.authdata_utility(self._default_library))
+
+        # A library created since the configuration was loaded gets
+        # an AuthdataUtility straight from its configuration.
+        library = self._library()
+        self.initialize_adobe(library, [library])
+        assert library.id not in self.manager.authdata_utilities
+        assert isinstance(
+            self.manager.authdata_utility(library), AuthdataUtility
+        )
+
     def test_exception_during_external_search_initialization_is_stored(self):
 
         class BadSearch(CirculationManager):
@@ -2338,6 +2360,75 @@ class TestFeedController(CirculationControllerTest):
             eq_(2, counter['English'])
             eq_(1, counter['Other Languages'])
 
+    def test_groups_serves_stale_feed_while_regenerating(self):
+        ConfigurationSetting.sitewide(
+            self._db, AcquisitionFeed.GROUPED_MAX_AGE_POLICY).value = 3600
+        library = self._default_library
+        ConfigurationSetting.for_library(
+            Configuration.STALE_FEED_MAX_AGE, library).value = 7 * 24 * 3600
+        SessionManager.refresh_materialized_views(self._db)
+
+        class MockRegenerator(object):
+            def __init__(self):
+                self.scheduled = []
+            def schedule(self, _db, cached_feed_id, regenerate):
+                self.scheduled.append((cached_feed_id, regenerate))
+            def failing(self, cached_feed_id):
+                return False
+        regenerator = MockRegenerator()
+        self.manager.feed_regenerator = regenerator
+        stats = self.manager.feed_cache_stats
+
+        # The first time, there's nothing in the cache and the feed
+        # is generated while we wait.
+        with self.request_context_with_library("/"):
+            lane = self.manager.opds_feeds.load_lane(None, None)
+            response = self.manager.opds_feeds.groups(None, None)
+            assert self.english_1.title in response.data
+        eq_(dict(hit=0, miss=1, stale=0), stats.for_lane(library, lane))
+
+        # The second time, the cached feed is used.
+        with self.request_context_with_library("/"):
+            response = self.manager.opds_feeds.groups(None, None)
+            assert self.english_1.title in response.data
+        eq_(dict(hit=1, miss=1, stale=0), stats.for_lane(library, lane))
+
+        # Now the cached feed is out of date, but not so out of date
+        # that it can't be served.
+        [cached] = self._db.query(CachedFeed).all()
+        cached.content = "stale content"
+        cached.timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+
+        with self.request_context_with_library("/"):
+            response = self.manager.opds_feeds.groups(None, None)
+        eq_("stale content", response.data)
+        eq_(dict(hit=1, miss=1, stale=1), stats.for_lane(library, lane))
+
+        # A regeneration of the feed was scheduled.
+        [(cached_feed_id, regenerate)] = regenerator.scheduled
+        eq_(cached.id, cached_feed_id)
+
+        # Running it outside of the request, with a different
+        # database session, brings the cached feed up to date.
+        session = Session(bind=self._db.get_bind())
+        try:
+            regenerate(session)
+            session.commit()
+        finally:
+            session.close()
+        self._db.expire(cached)
+        assert self.english_1.title in cached.content
+        assert cached.timestamp > datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+
+        # Once the feed is too old to be served, the client waits for
+        # it to be regenerated.
+        cached.timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=8)
+        with self.request_context_with_library("/"):
+            response = self.manager.opds_feeds.groups(None, None)
+            assert self.english_1.title in response.data
+        eq_(dict(hit=1, miss=2, stale=1), stats.for_lane(library, lane))
+        eq_(1, len(regenerator.scheduled))
+
     def test_search(self):
         # Put two works into the search index
         self.english_1.update_external_index(self.manager.external_search)  # english_1 is "Quite British" by John Bull
@@ -30,10 +30,14 @@ from api.enki import (
     MockEnkiAPI,
     EnkiBibliographicCoverageProvider,
     EnkiImport,
+    EnkiCollectionReaper,
     BibliographicParser,
 )
 from core.scripts import RunCollectionCoverageProviderScript
-from core.util.http import BadResponseException
+from core.util.http import (
+    BadResponseException,
+    RemoteIntegrationException,
+)
 from core.testing import MockRequestsResponse
 
 class BaseEnkiTest(object):
@@ -176,6 +180,76 @@ class TestBibliographicCoverageProvider(TestEnkiAPI):
         eq_("1984", pool.work.title)
         eq_(True, pool.work.presentation_ready)
 
+class MockPagingEnkiImport(EnkiImport):
+    """Pretend the collection has three pages of titles, without
+    making any HTTP requests.
+    """
+    def fetch_page(self, since, strt):
+        if strt >= self.page_size * 3:
+            return []
+        return [strt]
+
+
+class TestEnkiImport(TestEnkiAPI):
+
+    def test_run_once(self):
+        collection = self.api.collection
+        self.api.queue_response(
+            200, content=self.get_data("item_metadata_single.json")
+        )
+        self.api.queue_response(200, content='{"result":{"titles":[]}}')
+
+        importer = EnkiImport(
+            self._db, collection, api_class=self.api, page_size=10,
+            prefetch_pages=1
+        )
+        importer.run_once(datetime.datetime.utcnow(), None)
+
+        # Pages were requested until one came back empty.
+        eq_([0, 10], [x[2]['params']['strt'] for x in self.api.requests])
+        eq_([10, 10], [x[2]['params']['qty'] for x in self.api.requests])
+
+        # The title on the first page was imported.
+        [pool] = collection.licensepools
+        eq_("econtentRecord1", pool.identifier.identifier)
+        eq_(999, pool.licenses_owned)
+        eq_(997, pool.licenses_available)
+
+    def test_pages(self):
+        importer = MockPagingEnkiImport(
+            self._db, self.api.collection, api_class=self.api, page_size=5,
+            prefetch_pages=4
+        )
+        # Several pages are fetched at once, but they come out in
+        # order.
+        eq_([[0], [5], [10]], list(importer.pages(None)))
+
+    def test_fetch_page_retries_failures(self):
+        importer = EnkiImport(
+            self._db, self.api.collection, api_class=self.api, page_size=10
+        )
+        importer.BACKOFF_SECONDS = 0
+
+        # The first request fails, but the second one succeeds.
+        self.api.queue_response(500, content="error")
+        self.api.queue_response(
+            200, content=self.get_data("item_metadata_single.json")
+        )
+        [(bibliographic, circulation)] = importer.fetch_page(None, 0)
+        eq_(u"1984", bibliographic.title)
+        eq_(2, len(self.api.requests))
+
+        # If every attempt fails, the page is not treated as empty --
+        # the import stops with an error.
+        for i in range(importer.MAX_PAGE_ATTEMPTS):
+            self.api.queue_response(500, content="error")
+        assert_raises_regexp(
+            RemoteIntegrationException, "after 4 attempts",
+            importer.fetch_page, None, 0
+        )
+        eq_([], self.api.responses)
+
+
 class TestEnkiCollectionReaper(TestEnkiAPI):
 
     def test_reaped_book_has_zero_licenses(self):
@@ -211,3 +285,63 @@ class TestEnkiCollectionReaper(TestEnkiAPI):
         eq_(0, circulationdata.licenses_available)
         eq_(0, circulationdata.patrons_in_hold_queue)
 
+    def test_run_once_removes_books_missing_from_listing(self):
+        collection = self.api.collection
+
+        def pool_for(enki_id):
+            edition = self._edition(
+                identifier_type=Identifier.ENKI_ID,
+                data_source_name=DataSource.ENKI,
+                identifier_id=enki_id
+            )
+            pool = self._licensepool(
+                edition, open_access=False, data_source_name=DataSource.ENKI,
+                collection=collection
+            )
+            pool.licenses_owned = 10
+            pool.licenses_available = 5
+            return pool
+
+        # Enki still has econtentRecord1, but not econtentRecord0.
+        kept = pool_for("econtentRecord1")
+        removed = pool_for("econtentRecord0")
+
+        # Enki's listing of the collection takes two pages; the second
+        # is empty.
+        self.api.queue_response(
+            200, content=self.get_data("item_metadata_single.json")
+        )
+        self.api.queue_response(200, content='{"result":{"titles":[]}}')
+
+        reaper = EnkiCollectionReaper(self._db, collection, api_class=self.api)
+        reaper.run_once(None, None)
+
+        # Two requests were made, no matter how many books are in the
+        # collection.
+        eq_(2, len(self.api.requests))
+        eq_(0, removed.licenses_owned)
+        eq_(0, removed.licenses_available)
+        eq_(10, kept.licenses_owned)
+
+    def test_run_once_does_nothing_without_complete_listing(self):
+        collection = self.api.collection
+        edition = self._edition(
+            identifier_type=Identifier.ENKI_ID,
+            data_source_name=DataSource.ENKI,
+        )
+        pool = self._licensepool(
+            edition, open_access=False, data_source_name=DataSource.ENKI,
+            collection=collection
+        )
+        pool.licenses_owned = 10
+        reaper = EnkiCollectionReaper(self._db, collection, api_class=self.api)
+
+        # The listing couldn't be retrieved.
+        self.api.queue_response(500, content="error")
+        reaper.run_once(None, None)
+        eq_(10, pool.licenses_owned)
+
+        # The listing is suspiciously empty.
+        self.api.queue_response(200, content='{"result":{"titles":[]}}')
+        reaper.run_once(None, None)
+        eq_(10, pool.licenses_owned)
@@ -0,0 +1,169 @@
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from threading import Event
+
+from . import DatabaseTest
+
+from api.feed_cache import (
+    FeedCacheStats,
+    FeedRegenerator,
+    lane_path,
+)
+
+
+class MockLane(object):
+    def __init__(self, name, parent=None, language_key="eng"):
+        self.name = name
+        self.display_name = name
+        self.parent = parent
+        self.language_key = language_key
+
+
+class TestFeedCacheStats(DatabaseTest):
+
+    def test_record(self):
+        stats = FeedCacheStats()
+        library = self._default_library
+        lane = MockLane("Fantasy", MockLane("Adult Fiction"))
+        eq_(dict(hit=0, miss=0, stale=0), stats.for_lane(library, lane))
+
+        stats.record(library, lane, stats.HIT)
+        stats.record(library, lane, stats.HIT)
+        stats.record(library, lane, stats.STALE)
+        eq_(dict(hit=2, miss=0, stale=1), stats.for_lane(library, lane))
+
+        # Lanes in different libraries are counted separately.
+        other_library = self._library()
+        eq_(dict(hit=0, miss=0, stale=0), stats.for_lane(other_library, lane))
+
+        # So are different lanes with the same name, and the same lane
+        # in different languages.
+        ya_lane = MockLane("Fantasy", MockLane("Young Adult Fiction"))
+        eq_(dict(hit=0, miss=0, stale=0), stats.for_lane(library, ya_lane))
+        french_lane = MockLane(
+            "Fantasy", MockLane("Adult Fiction"), language_key="fre"
+        )
+        eq_(dict(hit=0, miss=0, stale=0), stats.for_lane(library, french_lane))
+
+    def test_lane_path(self):
+        lane = MockLane("Fantasy", MockLane("Adult Fiction", MockLane("All")))
+        eq_(["All", "Adult Fiction", "Fantasy"], lane_path(lane))
+
+
+class MockFeedRegenerator(FeedRegenerator):
+    """Keep track of the work that would be handed to the worker
+    threads, instead of handing it over.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MockFeedRegenerator, self).__init__(*args, **kwargs)
+        self.started = []
+
+    def start(self, target, *args):
+        self.started.append(args)
+
+
+class TestFeedRegenerator(DatabaseTest):
+
+    def test_schedule(self):
+        regenerator = MockFeedRegenerator()
+        calls = []
+        regenerate = lambda _db: calls.append(_db)
+
+        eq_(True, regenerator.schedule(self._db, 1, regenerate))
+        eq_(set([1]), regenerator.in_progress)
+
+        # A feed that's already being regenerated isn't scheduled
+        # again, but a different feed is.
+        eq_(False, regenerator.schedule(self._db, 1, regenerate))
+        eq_(True, regenerator.schedule(self._db, 2, regenerate))
+        eq_(2, len(regenerator.started))
+
+        # Running the regeneration calls the callable and clears the
+        # feed's in-progress status.
+        bind, cached_feed_id, ignore = regenerator.started[0]
+        regenerator.run(bind, cached_feed_id, regenerate)
+        eq_(set([2]), regenerator.in_progress)
+        eq_(True, regenerator.schedule(self._db, 1, regenerate))
+
+        # The callable was given a database session of its own.
+        [_db] = calls
+        assert _db is not self._db
+
+    def test_schedule_with_full_queue(self):
+        regenerator = FeedRegenerator(workers=1, queue_size=1)
+        started = Event()
+        finish = Event()
+        def regenerate(_db):
+            started.set()
+            finish.wait(5)
+        # Don't bother with the database.
+        regenerator.run = lambda bind, cached_feed_id, regenerate: regenerate(None)
+
+        # The first feed ties up the only worker, and the second one
+        # takes the only place in the queue.
+        eq_(True, regenerator.schedule(self._db, 1, regenerate))
+        started.wait(5)
+        eq_(True, regenerator.schedule(self._db, 2, regenerate))
+
+        # There's no room for the third.
+        eq_(False, regenerator.schedule(self._db, 3, regenerate))
+        eq_(set([1, 2]), regenerator.in_progress)
+        finish.set()
+
+    def test_scheduled_work_is_done(self):
+        regenerator = FeedRegenerator(workers=1)
+        done = Event()
+        calls = []
+        def regenerate(_db):
+            calls.append(_db)
+            done.set()
+        eq_(True, regenerator.schedule(self._db, 4, regenerate))
+        eq_(True, done.wait(5))
+        assert calls[0] is not self._db
+
+    def test_run_skips_feed_locked_elsewhere(self):
+        regenerator = MockFeedRegenerator()
+        calls = []
+        regenerate = lambda _db: calls.append(1)
+
+        # Some other process is regenerating this feed.
+        connection = self._db.get_bind().engine.connect()
+        connection.execute(
+            "select pg_advisory_lock(%s, %s)",
+            (regenerator.LOCK_NAMESPACE, 5)
+        )
+        try:
+            regenerator.in_progress.add(5)
+            regenerator.run(self._db.get_bind(), 5, regenerate)
+        finally:
+            connection.execute(
+                "select pg_advisory_unlock(%s, %s)",
+                (regenerator.LOCK_NAMESPACE, 5)
+            )
+            connection.close()
+
+        # The feed wasn't regenerated, and it's no longer in progress
+        # here.
+        eq_([], calls)
+        eq_(set(), regenerator.in_progress)
+
+    def test_run_handles_exceptions(self):
+        regenerator = MockFeedRegenerator()
+        def regenerate(_db):
+            raise Exception("oops")
+        for i in range(regenerator.MAX_FAILURES):
+            eq_(False, regenerator.failing(3))
+            regenerator.in_progress.add(3)
+            regenerator.run(self._db.get_bind(), 3, regenerate)
+            eq_(set(), regenerator.in_progress)
+
+        # After failing several times in a row, the feed is no longer
+        # regenerated in the background.
+        eq_(True, regenerator.failing(3))
+
+        # A success resets the count.
+        regenerator.run(self._db.get_bind(), 3, lambda _db: None)
+        eq_(False, regenerator.failing(3))
@@ -7,7 +7,10 @@ from api.config import (
     CannotLoadConfiguration,
 )
 from core.analytics import Analytics
-from api.google_analytics_provider import GoogleAnalyticsProvider
+from api.google_analytics_provider import (
+    EventDispatcher,
+    GoogleAnalyticsProvider,
+)
 from . import DatabaseTest
 from core.model import (
     get_one_or_create,
@@ -30,6 +33,64 @@ class MockGoogleAnalyticsProvider(GoogleAnalyticsProvider):
         self.url = url
         self.params = params
 
+class MockEventDispatcher(EventDispatcher):
+    """Send hits only when told to, and keep track of them instead
+    of sending them to Google.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MockEventDispatcher, self).__init__(*args, **kwargs)
+        self.posts = []
+
+    def start(self):
+        pass
+
+    def post(self, url, body):
+        self.posts.append((url, body))
+
+
+class TestEventDispatcher(object):
+
+    def test_hits_are_sent_in_batches(self):
+        dispatcher = MockEventDispatcher()
+        url = GoogleAnalyticsProvider.DEFAULT_URL
+        for i in range(25):
+            dispatcher.add(url, "hit=%d" % i)
+
+        # Nothing is sent until the hits are taken off the queue.
+        eq_([], dispatcher.posts)
+        dispatcher.flush()
+
+        # Google accepts at most 20 hits in one request, so two
+        # requests were made to the batch endpoint.
+        [(url1, body1), (url2, body2)] = dispatcher.posts
+        eq_("http://www.google-analytics.com/batch", url1)
+        eq_(url1, url2)
+        eq_(["hit=%d" % i for i in range(20)], body1.split("\n"))
+        eq_(["hit=%d" % i for i in range(20, 25)], body2.split("\n"))
+
+    def test_batch_bodies_are_limited_in_size(self):
+        dispatcher = MockEventDispatcher()
+        dispatcher.MAX_BATCH_BYTES = 10
+        eq_(["aaaa\nbbbb", "cccc"],
+            list(dispatcher.batch_bodies(["aaaa", "bbbb", "cccc"])))
+
+    def test_hits_for_custom_url_are_sent_individually(self):
+        dispatcher = MockEventDispatcher()
+        dispatcher.add("http://analytics/", "hit=1")
+        dispatcher.add("http://analytics/", "hit=2")
+        dispatcher.flush()
+        eq_([("http://analytics/", "hit=1"), ("http://analytics/", "hit=2")],
+            dispatcher.posts)
+
+    def test_hits_are_dropped_when_queue_is_full(self):
+        dispatcher = MockEventDispatcher(max_queue_size=2)
+        for i in range(3):
+            dispatcher.add("http://analytics/", "hit=%d" % i)
+        eq_(1, dispatcher.dropped)
+        dispatcher.flush()
+        eq_(["hit=0", "hit=1"], [body for url, body in dispatcher.posts])
+
+
 class TestGoogleAnalyticsProvider(DatabaseTest):
 
     def test_init(self):
@@ -63,6 +124,27 @@ class TestGoogleAnalyticsProvider(DatabaseTest):
         eq_(integration.url, ga.url)
         eq_("faketrackingid", ga.tracking_id)
 
+    def test_post_queues_hit(self):
+        integration, ignore = create(
+            self._db, ExternalIntegration,
+            goal=ExternalIntegration.ANALYTICS_GOAL,
+            protocol="api.google_analytics_provider",
+        )
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, GoogleAnalyticsProvider.TRACKING_ID, self._default_library, integration
+        ).value = "faketrackingid"
+        ga = GoogleAnalyticsProvider(integration, self._default_library)
+        ga.dispatcher = MockEventDispatcher()
+
+        # Collecting an event doesn't send anything to Google; it
+        # queues the hit to be sent in the background.
+        ga.collect_event(self._default_library, None, CirculationEvent.NEW_PATRON, datetime.datetime.utcnow())
+        eq_([], ga.dispatcher.posts)
+        ga.dispatcher.flush()
+        [(url, body)] = ga.dispatcher.posts
+        eq_("http://www.google-analytics.com/batch", url)
+        eq_("faketrackingid", urlparse.parse_qs(body)['tid'][0])
+
     def test_collect_event_with_work(self):
         integration, ignore = create(
             self._db, ExternalIntegration,
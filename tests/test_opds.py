@@ -67,6 +67,7 @@ from api.opds import (
 from api.testing import VendorIDTest
 from api.adobe_vendor_id import AuthdataUtility
 from api.novelist import NoveListAPI
+from api.util.query_counter import QueryCounter
 from api.lanes import ContributorLane
 import jwt
 
@@ -243,6 +244,36 @@ class TestCirculationManagerAnnotator(VendorIDTest):
         [expect] = self.annotator.adobe_id_tags(adobe_id_identifier.credential)
         eq_(etree.tostring(expect), etree.tostring(licensor))
 
+    def test_library_configuration_is_looked_up_once(self):
+        self.initialize_adobe(self._default_library)
+        self._external_integration(
+            ExternalIntegration.NOVELIST,
+            goal=ExternalIntegration.METADATA_GOAL, username=u'library',
+            password=u'sure', libraries=[self._default_library]
+        )
+        NoveListAPI.IS_CONFIGURED = None
+        eq_(True, self.annotator.novelist_configured)
+        allow_holds = self.annotator.allow_holds
+        authdata = self.annotator.authdata
+        assert authdata is not None
+
+        # Once the configuration has been looked up, it's reused
+        # without going to the database.
+        with QueryCounter(self._db) as queries:
+            eq_(True, self.annotator.novelist_configured)
+            eq_(allow_holds, self.annotator.allow_holds)
+            eq_(authdata, self.annotator.authdata)
+        eq_(0, queries.count)
+
+        # The absence of configuration is also remembered.
+        annotator = CirculationManagerAnnotator(
+            None, Fantasy, self._library(), test_mode=True
+        )
+        eq_(None, annotator.authdata)
+        with QueryCounter(self._db) as queries:
+            eq_(None, annotator.authdata)
+        eq_(0, queries.count)
+
     def test_no_adobe_id_tags_when_vendor_id_not_configured(self):
         """When vendor ID delegation is not configured, adobe_id_tags()
         returns an empty list.
@@ -3,6 +3,7 @@ from nose.tools import (
     eq_,
     assert_raises,
 )
+import datetime
 import os
 import json
 
@@ -76,7 +77,17 @@ class TestOPDSForDistributorsAPI(DatabaseTest):
         # If we call _get_token again, it uses the existing credential.
         eq_(token, self.api._get_token(self._db))
 
+        # Another API object for the same collection uses the token
+        # without going to the database.
+        other_api = MockOPDSForDistributorsAPI(self._db, self.collection)
         self._db.delete(credential)
+        eq_(token, other_api._get_token(self._db))
+        eq_([], other_api.requests)
+
+        # Forget the token entirely.
+        self.api.bearer_tokens.invalidate(
+            (self.collection.id, self.api.TOKEN_TYPE)
+        )
 
         # Create a new API that doesn't have an auth url yet.
         self.api = MockOPDSForDistributorsAPI(self._db, self.collection)
@@ -98,6 +109,27 @@ class TestOPDSForDistributorsAPI(DatabaseTest):
 
         eq_(token, self.api._get_token(self._db))
 
+    def test_get_token_refreshes_before_expiration(self):
+        self.api.auth_url = "http://authenticate"
+        old_token = json.dumps({"access_token": "old", "expires_in": 60})
+        self.api.queue_response(200, content=old_token)
+        eq_("old", self.api._get_token(self._db))
+
+        # The token is about to expire, though it hasn't expired yet.
+        [credential] = self._db.query(Credential).all()
+        credential.expires = (
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=10)
+        )
+        key = (self.collection.id, self.api.TOKEN_TYPE)
+        self.api.bearer_tokens.store(key, "old", credential.expires)
+
+        # A new token is obtained instead of sending a request that
+        # would be rejected.
+        new_token = json.dumps({"access_token": "new", "expires_in": 3600})
+        self.api.queue_response(200, content=new_token)
+        eq_("new", self.api._get_token(self._db))
+        eq_("new", credential.credential)
+
     def test_get_token_errors(self):
         no_auth_document = '<feed></feed>'
         self.api.queue_response(200, content=no_auth_document)
@@ -233,6 +265,26 @@ class TestOPDSForDistributorsAPI(DatabaseTest):
         eq_("a book", fulfillment_info.content)
         eq_(None, fulfillment_info.content_expires)
 
+        # The distributor rejects the token before it expires. A new
+        # token is obtained, and the request is tried again.
+        self.api.requests = []
+        self.api.queue_response(401, content="expired")
+        new_token = json.dumps({"access_token": "new token", "expires_in": 60})
+        self.api.queue_response(200, content=new_token)
+        self.api.queue_response(200, content="a book")
+        fulfillment_info = self.api.fulfill(patron, "1234", pool, Representation.EPUB_MEDIA_TYPE)
+        eq_("a book", fulfillment_info.content)
+        [first, refresh, second] = self.api.requests
+        eq_("Bearer token", first[3]['headers']['Authorization'])
+        eq_("http://auth", refresh[1])
+        eq_("Bearer new token", second[3]['headers']['Authorization'])
+
+        # The new token replaced the old one, in memory and in the
+        # database.
+        eq_("new token", self.api._get_token(self._db))
+        [credential] = self._db.query(Credential).all()
+        eq_("new token", credential.credential)
+
     def test_patron_activity(self):
         # The patron has two loans from this API's collection and
         # one from a different collection.
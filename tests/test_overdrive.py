@@ -11,6 +11,7 @@ from datetime import (
 )
 from api.overdrive import (
     MockOverdriveAPI,
+    OverdriveCirculationMonitor,
     OverdriveCollectionReaper,
     OverdriveFormatSweep,
 )
@@ -29,6 +30,7 @@ from . import (
 from core.model import (
     Collection,
     ConfigurationSetting,
+    Credential,
     DataSource,
     DeliveryMechanism,
     ExternalIntegration,
@@ -505,6 +507,42 @@ class TestOverdriveAPI(OverdriveAPITest):
         eq_("false", payload['password_required'])
         eq_("[ignore]", payload['password'])
         
+    def test_patron_token(self):
+        patron = self._patron()
+        patron.authorization_identifier = 'barcode'
+
+        # The first time a patron needs a token, one is obtained from
+        # Overdrive and stored in the database.
+        token = self.api.patron_token(patron, "a pin")
+        [credential] = self._db.query(Credential).filter(
+            Credential.patron==patron
+        ).all()
+        eq_(credential.credential, token)
+        requests = len(self.api.access_token_requests)
+
+        # After that, the token is found in memory, even by a
+        # different OverdriveAPI.
+        eq_(token, self.api.patron_token(patron, "a pin"))
+        eq_(requests, len(self.api.access_token_requests))
+        other_api = MockOverdriveAPI(self._db, self.collection)
+        other_requests = len(other_api.access_token_requests)
+        eq_(token, other_api.patron_token(patron, "a pin"))
+        eq_(other_requests, len(other_api.access_token_requests))
+
+        # If Overdrive rejects the token, a new one is obtained.
+        credential.credential = "rejected token"
+        key = self.api.patron_token_key(patron)
+        eq_(patron.id, key)
+        self.api.patron_tokens.store(
+            key, "rejected token", credential.expires
+        )
+        new_token = self.api.replace_patron_token(
+            patron, "a pin", "rejected token"
+        )
+        eq_(requests+1, len(self.api.access_token_requests))
+        assert new_token != "rejected token"
+        eq_(new_token, self.api.patron_token(patron, "a pin"))
+
 class TestExtractData(OverdriveAPITest):
 
     def test_get_download_link(self):
@@ -720,6 +758,102 @@ class TestOverdriveFormatSweep(OverdriveAPITest):
         monitor.process_item(pool.identifier)
 
 
+class TestOverdriveCirculationMonitor(OverdriveAPITest):
+
+    def test_run_once(self):
+        class MockAPI(object):
+            """Pretend every book with an even-numbered ID has changed."""
+            def __init__(self, _db, collection):
+                self.creds_checked = 0
+                self.looked_up = []
+                self.applied = []
+
+            def check_creds(self, force_refresh=False):
+                self.creds_checked += 1
+
+            def lookup_circulation(self, book, refresh_token=True):
+                self.looked_up.append(book['id'])
+                return book, 200, {}
+
+            def update_licensepool_from_lookup(self, book_id, book,
+                                               status_code, content):
+                self.applied.append(book['id'])
+                return None, False, (book['id'] % 2 == 0)
+
+        class Mock(OverdriveCirculationMonitor):
+            BATCH_SIZE = 3
+            def recently_changed_ids(self, start, cutoff):
+                return [dict(id=0), None, dict(id=1), dict(id=2),
+                        dict(id=3), dict(id=5), dict(id=7), dict(id=9)]
+
+        for concurrency in (1, 3):
+            monitor = Mock(
+                self._db, self.collection, api_class=MockAPI,
+                concurrency=concurrency
+            )
+            monitor.run_once(None, None)
+            # Every book was applied, in order.
+            eq_([0, 1, 2, 3, 5, 7, 9], monitor.api.applied)
+            eq_(sorted(monitor.api.applied), sorted(monitor.api.looked_up))
+
+            # In concurrent mode, the bearer token is checked before
+            # each batch.
+            if concurrency == 1:
+                eq_(0, monitor.api.creds_checked)
+            else:
+                eq_(3, monitor.api.creds_checked)
+
+            # The run stops after a streak of unchanged books, even if
+            # more books in the batch have already been looked up.
+            monitor = Mock(
+                self._db, self.collection, api_class=MockAPI,
+                concurrency=concurrency
+            )
+            monitor.maximum_consecutive_unchanged_books = 2
+            monitor.run_once(None, None)
+            eq_([0, 1, 2, 3, 5], monitor.api.applied)
+
+    def test_token_rejected_during_concurrent_lookups(self):
+        class MockAPI(object):
+            """Reject the bearer token until it's been refreshed."""
+            def __init__(self, _db, collection):
+                self.refreshed = 0
+                self.lookups = []
+                self.applied = []
+
+            def check_creds(self, force_refresh=False):
+                if force_refresh:
+                    self.refreshed += 1
+
+            def lookup_circulation(self, book, refresh_token=True):
+                # The lookup threads must never refresh the token.
+                eq_(False, refresh_token)
+                self.lookups.append(book['id'])
+                if not self.refreshed and book['id'] % 2:
+                    return book, 401, None
+                return book, 200, {}
+
+            def update_licensepool_from_lookup(self, book_id, book,
+                                               status_code, content):
+                self.applied.append((book['id'], status_code))
+                return None, False, True
+
+        class Mock(OverdriveCirculationMonitor):
+            def recently_changed_ids(self, start, cutoff):
+                return [dict(id=x) for x in range(4)]
+
+        monitor = Mock(
+            self._db, self.collection, api_class=MockAPI, concurrency=3
+        )
+        monitor.run_once(None, None)
+
+        # The token was refreshed once, on the main thread, and the
+        # books whose lookups were rejected were looked up again.
+        eq_(1, monitor.api.refreshed)
+        eq_([0, 1, 1, 2, 3, 3], sorted(monitor.api.lookups))
+        eq_([(0, 200), (1, 200), (2, 200), (3, 200)], monitor.api.applied)
+
+
 class TestReaper(OverdriveAPITest):
 
     def test_instantiate(self):
@@ -0,0 +1,22 @@
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from . import DatabaseTest
+
+from core.model import Patron
+from api.util.query_counter import QueryCounter
+
+
+class TestQueryCounter(DatabaseTest):
+
+    def test_count(self):
+        with QueryCounter(self._db) as queries:
+            self._db.query(Patron).all()
+            self._db.query(Patron).count()
+        eq_(2, queries.count)
+
+        # Once the block is over, queries are no longer counted.
+        self._db.query(Patron).all()
+        eq_(2, queries.count)
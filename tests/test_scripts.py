@@ -1,4 +1,5 @@
 from nose.tools import (
+    assert_raises_regexp,
     set_trace,
     eq_,
 )
@@ -7,6 +8,10 @@ import contextlib
 import datetime
 import flask
 import json
+import multiprocessing.dummy
+import os
+import shutil
+import tempfile
 
 from api.adobe_vendor_id import (
     AdobeVendorIDModel,
@@ -24,9 +29,11 @@ from core.lane import (
 )
 
 from core.model import (
+    CachedFeed,
     ConfigurationSetting,
     Credential,
     DataSource,
+    create,
     get_one,
     Timestamp,
 )
@@ -35,11 +42,13 @@ from . import (
     DatabaseTest,
 )
 
+import scripts
 from scripts import (
     AdobeAccountIDResetScript,
     CacheRepresentationPerLane,
     CacheFacetListsPerLane,
     InstanceInitializationScript,
+    LaneCheckpoint,
     LanguageListScript,
     LoanReaperScript,
 )
@@ -147,6 +156,146 @@ class TestRepresentationPerLane(TestLaneScript):
         eq_(False, script.should_process_lane(parent))
         eq_(True, script.should_process_lane(child))
 
+    def test_lane_key(self):
+        script = CacheRepresentationPerLane(
+            self._db, ["--min-depth=0"], testing=True
+        )
+        library = self._default_library
+        top = script.app.manager.top_level_lanes[library.id]
+        lanes = list(script.lanes_to_process(library))
+        assert len(lanes) > 1
+        for lane in lanes:
+            key = script.lane_key(library, lane)
+            eq_(lane, script.lane_for_key(library, key))
+        eq_(top, script.lane_for_key(library, script.lane_key(library, top)))
+        eq_(None, script.lane_for_key(
+            library, json.dumps([library.short_name, top.name, "No such lane"])
+        ))
+
+    def test_process_library_resumes_from_checkpoint(self):
+        class Mock(CacheRepresentationPerLane):
+            fail_on = None
+            def process_lane(self, lane):
+                if lane is self.fail_on:
+                    raise Exception("oops")
+                self.processed.append(lane)
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "checkpoint")
+            script = Mock(
+                self._db, ["--min-depth=0", "--checkpoint=%s" % path],
+                testing=True
+            )
+            eq_(1, script.workers)
+            eq_(path, script.checkpoint_path)
+            library = self._default_library
+            lanes = list(script.lanes_to_process(library))
+            first, second = lanes[:2]
+
+            # The run is interrupted on the second lane.
+            script.processed = []
+            script.fail_on = second
+            assert_raises_regexp(
+                Exception, "oops", script.process_library, library
+            )
+            eq_([first], script.processed)
+            eq_(set([script.lane_key(library, first)]),
+                LaneCheckpoint(path).finished)
+
+            # The next run picks up where the last one left off.
+            script.processed = []
+            script.fail_on = None
+            script.process_library(library)
+            eq_(lanes[1:], script.processed)
+
+            # Finishing one library doesn't clear the checkpoint,
+            # since the run may have other libraries to get through.
+            eq_(True, os.path.exists(path))
+
+            # Once every library has been processed, the checkpoint
+            # is gone.
+            script.processed = []
+            script.process_libraries([library])
+            eq_([], script.processed)
+            eq_(False, os.path.exists(path))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_process_in_workers(self):
+        class Mock(CacheRepresentationPerLane):
+            fail_on = None
+            def process_lane(self, lane):
+                if lane is self.fail_on:
+                    raise Exception("oops")
+                self.processed.append(lane)
+
+            def worker_pool(self):
+                # Use a single thread instead of processes, so the
+                # worker can share this test's database session.
+                def initialize():
+                    scripts._lane_worker = self
+                return multiprocessing.dummy.Pool(1, initializer=initialize)
+
+        script = Mock(
+            self._db, ["--min-depth=0", "--workers=2"], testing=True
+        )
+        eq_(2, script.workers)
+        library = self._default_library
+        lanes = list(script.lanes_to_process(library))
+        keys = [script.lane_key(library, lane) for lane in lanes]
+        script.processed = []
+        script.fail_on = lanes[0]
+
+        # Every lane is sent to a worker. The ones that were processed
+        # are yielded; the one that failed isn't, and doesn't stop
+        # the others.
+        processed = list(script.process_in_workers(library, keys))
+        eq_(set(keys[1:]), set(processed))
+        eq_(set(lanes[1:]), set(script.processed))
+
+    def test_prioritize_lanes(self):
+        script = CacheFacetListsPerLane(self._db, [], testing=True)
+        library = self._default_library
+        old, new, uncached = [
+            Lane(self._db, library, name) for name in ("old", "new", "none")
+        ]
+        now = datetime.datetime.utcnow()
+        for lane, timestamp in (
+                (old, now - datetime.timedelta(days=1)),
+                (new, now),
+        ):
+            feed, ignore = create(
+                self._db, CachedFeed, lane_name=lane.name,
+                languages=lane.language_key, library=library,
+                type=CachedFeed.PAGE_TYPE, facets=u"", pagination=u""
+            )
+            feed.timestamp = timestamp
+
+        # Lanes that have never been cached come first, then the ones
+        # whose feeds are oldest.
+        eq_([uncached, old, new],
+            script.prioritize_lanes(library, [new, old, uncached]))
+
+
+class TestLaneCheckpoint(object):
+
+    def test_record_and_clear(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "checkpoint")
+            checkpoint = LaneCheckpoint(path)
+            eq_(set(), checkpoint.finished)
+            checkpoint.record("a")
+            checkpoint.record("b")
+            eq_(set(["a", "b"]), LaneCheckpoint(path).finished)
+
+            checkpoint.clear()
+            eq_(set(), checkpoint.finished)
+            eq_(False, os.path.exists(path))
+        finally:
+            shutil.rmtree(tempdir)
+
             
 class TestCacheFacetListsPerLane(TestLaneScript):
 
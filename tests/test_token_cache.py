@@ -0,0 +1,162 @@
+import datetime
+import threading
+
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from api.token_cache import TokenCache
+
+
+class TestTokenCache(object):
+
+    def setup(self):
+        self.cache = TokenCache()
+        self.refreshes = []
+
+    def refresher(self, token, expires_in=3600):
+        def refresh():
+            self.refreshes.append(token)
+            expires = (
+                datetime.datetime.utcnow() +
+                datetime.timedelta(seconds=expires_in)
+            )
+            return token, expires
+        return refresh
+
+    def test_token(self):
+        eq_("a", self.cache.token("key", self.refresher("a")))
+
+        # The token is reused until it's about to expire.
+        eq_("a", self.cache.token("key", self.refresher("b")))
+        eq_(["a"], self.refreshes)
+
+        # Different keys have different tokens.
+        eq_("c", self.cache.token("other key", self.refresher("c")))
+
+        # A token that's about to expire is replaced.
+        eq_("d", self.cache.token("expiring", self.refresher("d", 10)))
+        eq_("e", self.cache.token("expiring", self.refresher("e")))
+
+        # A token without an expiration date is kept forever.
+        self.cache.store("forever", "f", None)
+        eq_("f", self.cache.token("forever", self.refresher("g")))
+
+    def test_max_size(self):
+        cache = TokenCache(max_size=2)
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        cache.store(1, "a", expires)
+        cache.store(2, "b", expires)
+        eq_("a", cache.token(1, self.refresher("new a")))
+        cache.store(3, "c", expires)
+
+        # Token 2 was the least recently used, so it was dropped.
+        eq_([1, 3], sorted(cache.tokens.keys()))
+
+    def test_stats(self):
+        eq_(dict(size=0, hits=0, misses=0, average_refresh_time=None),
+            self.cache.stats())
+        self.cache.token("key", self.refresher("a"))
+        self.cache.token("key", self.refresher("b"))
+        self.cache.token("key", self.refresher("c"))
+        stats = self.cache.stats()
+        eq_(1, stats['size'])
+        eq_(2, stats['hits'])
+        eq_(1, stats['misses'])
+        assert stats['average_refresh_time'] >= 0
+
+    def test_log_stats(self):
+        class MockLog(object):
+            def __init__(self):
+                self.messages = []
+            def info(self, message, *args):
+                self.messages.append(message % args)
+        log = MockLog()
+
+        # Nothing is logged until the cache has been used.
+        self.cache.log_stats(log, "Test token")
+        eq_([], log.messages)
+
+        self.cache.token("key", self.refresher("a"))
+        self.cache.token("key", self.refresher("a"))
+        self.cache.log_stats(log, "Test token")
+        eq_(["Test token cache: 1 of 2 lookups were hits (50.0%), 1 cached."],
+            log.messages)
+
+    def test_failed_refresh(self):
+        def refresh():
+            raise ValueError("no token for you")
+        try:
+            self.cache.token("key", refresh)
+            raise AssertionError("The exception should have propagated.")
+        except ValueError:
+            pass
+
+        # Nothing was cached, not even the lock used during the refresh.
+        eq_({}, self.cache.tokens)
+        eq_({}, self.cache.refresh_locks)
+
+    def test_invalidate(self):
+        self.cache.token("key", self.refresher("a"))
+
+        # Invalidating some other token has no effect.
+        self.cache.invalidate("key", "not a")
+        eq_("a", self.cache.token("key", self.refresher("b")))
+
+        self.cache.invalidate("key", "a")
+        eq_("b", self.cache.token("key", self.refresher("b")))
+
+        self.cache.invalidate("key")
+        eq_("c", self.cache.token("key", self.refresher("c")))
+
+    def test_replace(self):
+        self.cache.token("key", self.refresher("a"))
+        eq_("b", self.cache.replace("key", "a", self.refresher("b")))
+
+        # By the time a request using token "a" is rejected, the token
+        # has already been replaced, so it's not replaced again.
+        eq_("b", self.cache.replace("key", "a", self.refresher("c")))
+        eq_(["a", "b"], self.refreshes)
+
+    def test_do_not_store(self):
+        def refresh():
+            return "a", TokenCache.DO_NOT_STORE
+        eq_("a", self.cache.token("key", refresh))
+        eq_(0, self.cache.stats()['size'])
+        eq_({}, self.cache.refresh_locks)
+        eq_(1, self.cache.misses)
+
+    def test_refresh_happens_once(self):
+        # A thread starts refreshing a token, and takes a while.
+        started = threading.Event()
+        proceed = threading.Event()
+        refresh = self.refresher("a")
+        def slow_refresh():
+            started.set()
+            proceed.wait()
+            return refresh()
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(
+                self.cache.token("key", slow_refresh)
+            )
+        )
+        first.start()
+        started.wait()
+
+        # Meanwhile, another thread needs the same token.
+        second = threading.Thread(
+            target=lambda: results.append(
+                self.cache.token("key", self.refresher("b"))
+            )
+        )
+        second.start()
+        proceed.set()
+        first.join()
+        second.join()
+
+        # The second thread waited for the first thread's token
+        # instead of getting one of its own.
+        eq_(["a", "a"], results)
+        eq_(["a"], self.refreshes)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+from flask import url_for
+
+from test_controller import ControllerTest
+
+from api.url_templates import (
+    URLTemplate,
+    URLTemplateCache,
+)
+
+
+class TestURLTemplateCache(ControllerTest):
+
+    # Every route api/opds.py makes URLs for, with the arguments it
+    # uses.
+    ROUTES = [
+        ('permalink', ['identifier_type', 'identifier']),
+        ('report', ['identifier_type', 'identifier']),
+        ('recommendations', ['identifier_type', 'identifier']),
+        ('related_books', ['identifier_type', 'identifier']),
+        ('annotations_for_work', ['identifier_type', 'identifier']),
+        ('borrow', ['identifier_type', 'identifier', 'mechanism_id']),
+        ('fulfill', ['license_pool_id', 'mechanism_id']),
+        ('revoke_loan_or_hold', ['license_pool_id']),
+        ('loan_or_hold_detail', ['identifier_type', 'identifier']),
+        ('contributor', ['contributor_name', 'languages', 'audiences']),
+        ('series', ['series_name', 'languages', 'audiences']),
+        ('lane_search', ['lane_name', 'languages']),
+        ('acquisition_groups', ['lane_name', 'languages']),
+        ('active_loans', []),
+        ('annotations', []),
+        ('adobe_drm_devices', []),
+        ('patron_profile', []),
+        ('authentication_document', []),
+    ]
+
+    # Values that need various kinds of quoting, or none at all.
+    VALUES = [
+        "simple",
+        u"Jos\xe9 Saramago",
+        "http://example.com/a book?id=1&x=y#z",
+        "../../..",
+        "100%",
+        u"カード",
+        12,
+        None,
+    ]
+
+    def test_url_for_matches_flask(self):
+        cache = URLTemplateCache()
+        with self.app.test_request_context("/"):
+            for route, names in self.ROUTES:
+                for value in self.VALUES:
+                    kwargs = dict((name, value) for name in names)
+                    kwargs['library_short_name'] = self._default_library.short_name
+                    eq_(url_for(route, _external=True, **kwargs),
+                        cache.url_for(route, _external=True, **kwargs))
+
+                    # Run the test again now that the template is
+                    # in the cache.
+                    eq_(url_for(route, _external=True, **kwargs),
+                        cache.url_for(route, _external=True, **kwargs))
+
+    def test_templates_are_reused(self):
+        cache = URLTemplateCache()
+        with self.app.test_request_context("/"):
+            for identifier in ("a", "b"):
+                cache.url_for(
+                    'permalink', identifier_type="URI",
+                    identifier=identifier, library_short_name="L",
+                    _external=True
+                )
+            [(key, template)] = cache.templates.items()
+            eq_('permalink', key[0])
+            assert isinstance(template, URLTemplate)
+
+            # The same template is used for every host.
+            with self.app.test_request_context(
+                    "/", base_url="https://other-host/"
+            ):
+                url = cache.url_for(
+                    'permalink', identifier_type="URI",
+                    identifier="a", library_short_name="L",
+                    _external=True
+                )
+                eq_("https://other-host/L/works/URI/a", url)
+            eq_(1, len(cache.templates))
+
+            # Including a host with a script root.
+            with self.app.test_request_context(
+                    "/", base_url="http://third-host/circulation/"
+            ):
+                url = cache.url_for(
+                    'permalink', identifier_type="URI",
+                    identifier="a", library_short_name="L",
+                    _external=True
+                )
+                eq_("http://third-host/circulation/L/works/URI/a", url)
+            eq_(1, len(cache.templates))
+
+    def test_query_arguments_are_left_to_flask(self):
+        cache = URLTemplateCache()
+        with self.app.test_request_context("/"):
+            kwargs = dict(
+                library_short_name="L", lane_name="Fiction",
+                languages="eng", q="a search", size=50,
+                _external=True
+            )
+            eq_(url_for('lane_search', **kwargs),
+                cache.url_for('lane_search', **kwargs))
+            eq_([None], cache.templates.values())
+
+            # So are relative URLs.
+            eq_(url_for('permalink', identifier_type="URI",
+                        identifier="a", library_short_name="L"),
+                cache.url_for('permalink', identifier_type="URI",
+                              identifier="a", library_short_name="L"))
+            eq_(1, len(cache.templates))
@@ -0,0 +1,67 @@
+from StringIO import StringIO
+
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from api.util.xmlparser import StreamingXMLParser
+
+
+class MockParser(StreamingXMLParser):
+    """Keep track of how much of the document is still in memory
+    when each tag is processed.
+    """
+
+    def __init__(self):
+        self.preceding_siblings = []
+
+    def process_one(self, tag, namespaces):
+        self.preceding_siblings.append(
+            len(list(tag.itersiblings(preceding=True)))
+        )
+        if tag.get("skip"):
+            return None
+        return self.text_of_subtag(tag, "name", namespaces)
+
+
+class TestStreamingXMLParser(object):
+
+    DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<list>
+  <item><name>first</name></item>
+  <item skip="true"><name>second</name></item>
+  <item><name>third</name></item>
+</list>
+"""
+
+    NAMESPACED_DOCUMENT = """<list xmlns="http://example.com/">
+  <item><name>first</name></item>
+  <item><name>second</name></item>
+</list>
+"""
+
+    def test_process_all_streaming(self):
+        parser = MockParser()
+        names = parser.process_all_streaming(StringIO(self.DOCUMENT), "item")
+        eq_(["first", "third"], list(names))
+
+        # Every tag was processed, but none of the tags processed
+        # earlier were still around.
+        eq_([0, 0, 0], parser.preceding_siblings)
+
+    def test_process_all_streaming_from_string(self):
+        parser = MockParser()
+        eq_(["first", "third"],
+            list(parser.process_all_streaming(self.DOCUMENT, "item")))
+
+    def test_process_all_streaming_with_namespace(self):
+        parser = MockParser()
+        ns = {"ex": "http://example.com/"}
+        names = parser.process_all_streaming(
+            self.NAMESPACED_DOCUMENT, "{http://example.com/}item",
+            ns, handler=lambda tag, namespaces: parser._xpath1(
+                tag, "ex:name", namespaces
+            ).text
+        )
+        eq_(["first", "second"], list(names))